@@ -1 +1,18 @@
-from .empaticae4 import *
\ No newline at end of file
+from .empaticae4 import *
+from .ringbuffer import *
+from .windowing import *
+from .windowarchive import *
+from .consumers import *
+from .gaps import *
+from .features import *
+from .downsampling import *
+from .events import *
+from .asyncempaticae4 import *
+from .devicemanager import *
+from .recorder import *
+from .relay import *
+from .sharedmemory import *
+from .replay import *
+from .profiling import *
+from .timesync import *
+from .mockserver import *
\ No newline at end of file
@@ -0,0 +1,324 @@
+import asyncio
+import time
+from .empaticae4 import EmpaticaProtocol, EmpaticaDevice, EmpaticaServerConnectError
+
+
+class AsyncEmpaticaClient(EmpaticaProtocol):
+    """
+    Client object to handle an asyncio connection to the Empatica Server, no threads are started.
+    """
+
+    def __init__(self):
+        """
+        Initializes the client, the connection is opened with open().
+        """
+        super().__init__()
+        self.reader = None
+        self.writer = None
+        self.reading_task = None
+        self.reading = False
+
+    async def open(self):
+        """
+        Opens the connection to the Empatica Server and starts the reading task.
+        :return: None.
+        """
+        try:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', 28000)
+        except OSError as e:
+            raise EmpaticaServerConnectError(e)
+        self.reading = True
+        self.reading_task = asyncio.ensure_future(self.handle_reading_receive())
+
+    async def close(self):
+        """
+        Stops the reading task and closes the connection.
+        :return: None.
+        """
+        self.reading = False
+        if self.writer:
+            try:
+                self.writer.close()
+            except Exception as e:
+                self.record_error("Other", str(e))
+        if self.reading_task:
+            self.reading_task.cancel()
+            try:
+                await self.reading_task
+            except asyncio.CancelledError:
+                pass
+
+    async def send(self, packet):
+        """
+        Sends a packet to the Empatica Server and waits until it is flushed.
+        :param packet: bytes-like command
+        :return: None.
+        """
+        try:
+            self.writer.write(packet)
+            await self.writer.drain()
+        except Exception as e:
+            self.record_error("Other", str(e))
+
+    async def handle_reading_receive(self):
+        """
+        Reads lines from the Empatica Server and handles them until the connection closes.
+        :return: None.
+        """
+        while self.reading:
+            try:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionResetError("Empatica Server closed the connection")
+                started = time.perf_counter()
+                tokens = line.split()
+                if tokens:
+                    self.handle_line(tokens)
+                self.record_read(len(line), time.perf_counter() - started)
+            except (ConnectionError, asyncio.IncompleteReadError) as ce:
+                self.last_error = str(ce)
+                self.record_error("Other", str(ce))
+                self.reading = False
+                if self.device:
+                    self.device.set_connected(False)
+
+    async def list_connected_devices(self):
+        """
+        Sends the list connected devices command to get the devices auto-connected over BLE.
+        :return: None
+        """
+        await self.send(b'device_list\r\n')
+
+
+class AsyncEmpaticaE4(EmpaticaDevice):
+    """
+    Class to wrap an asyncio connection to the Empatica Server and configure the data streams.
+    Windows are split by an event loop task, so one loop can drive many devices without extra threads.
+    """
+    def __init__(self, device_name, window_size=None, wrist_sensitivity=1, retention=None, wrist_threshold=0.0,
+                 wrist_hysteresis=0.0, window_hop=None, window_lateness=2.0):
+        """
+        Initializes the storage, the Empatica E4 is connected with connect().
+        :param device_name: bytes-like: The Empatica E4 to connect to
+        :param window_size: int: The size of windows in seconds, default None
+        :param wrist_sensitivity: int: The number of samples to determine if E4 is on wrist, default is one
+        :param retention: float: Seconds of samples kept per stream in fixed size ring buffers, default None keeps all
+        :param wrist_threshold: float: GSR at or below which a sample counts as off wrist, default zero
+        :param wrist_hysteresis: float: GSR above the threshold needed to count as back on wrist, default zero
+        :param window_hop: float: seconds between window starts, default None is window_size, a smaller hop gives
+        overlapping windows
+        :param window_lateness: float: seconds a continuous stream may lag behind the newest sample before its
+        windows are saved without its last samples, default 2
+        """
+        super().__init__(window_size, wrist_sensitivity, retention, wrist_threshold, wrist_hysteresis,
+                         window_hop=window_hop, window_lateness=window_lateness)
+        self.device_name = device_name
+        self.client = AsyncEmpaticaClient()
+        self.client.device = self
+        self.state_event = None
+        self.window_task = None
+        self.sample_queues = {}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def notify_state_changed(self):
+        """
+        Wakes every coroutine waiting for a connection or subscription change.
+        :return: None.
+        """
+        super().notify_state_changed()
+        if self.state_event:
+            self.state_event.set()
+
+    async def wait_for_state(self, predicate, timeout):
+        """
+        Waits on the event loop until the predicate is true or the timeout elapses.
+        :param predicate: callable: returns True once the expected state is reached
+        :param timeout: float: seconds to wait
+        :return: bool: the last value of the predicate.
+        """
+        async def wait():
+            while not predicate():
+                self.state_event.clear()
+                await self.state_event.wait()
+        try:
+            await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return predicate()
+
+    def start_window_timer(self):
+        """
+        Starts the window timer task.
+        :return: None.
+        """
+        if self.window_size and not self.window_task:
+            self.window_task = asyncio.ensure_future(self.timer_task())
+
+    async def timer_task(self):
+        """
+        Task that will split window after window elapses.
+        :return: None.
+        """
+        while self.connected:
+            await self.wait_for_state(lambda: not self.connected,
+                                      self.window_hop - time.monotonic() % self.window_hop)
+            self.split_window(final=not self.connected)
+
+    def queue_sample(self, stream, timestamp, values):
+        """
+        Sample listener that puts a sample on every iterator queue of its stream, dropping the oldest sample of a
+        full queue.
+        :param stream: str: stream name
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values
+        :return: None.
+        """
+        for queue in self.sample_queues.get(stream, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((timestamp,) + values)
+
+    async def samples(self, stream, maxsize=0):
+        """
+        Asynchronous iterator over the samples of a stream as they arrive, ends when the device is closed.
+        :param stream: bytes-like or str: stream to iterate, e.g. EmpaticaDataStreams.BVP
+        :param maxsize: int: samples buffered before the oldest is dropped, default 0 is unbounded
+        :return: async iterator of tuples: (timestamp, value, ...).
+        """
+        name = stream.decode("utf-8") if isinstance(stream, bytes) else stream
+        queue = asyncio.Queue(maxsize)
+        if not self.sample_queues:
+            self.sample_listeners.append(self.queue_sample)
+        self.sample_queues.setdefault(name, []).append(queue)
+        try:
+            while True:
+                sample = await queue.get()
+                if sample is None:
+                    return
+                yield sample
+        finally:
+            self.sample_queues[name].remove(queue)
+            if not self.sample_queues[name]:
+                del self.sample_queues[name]
+            if not self.sample_queues:
+                self.sample_listeners.remove(self.queue_sample)
+
+    async def connect(self, timeout=5):
+        """
+        Opens the connection, connects the Empatica E4 and suspends streaming until start_streaming is called.
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :return: None.
+        """
+        self.state_event = asyncio.Event()
+        await self.client.open()
+        await self.send(b'device_connect ' + self.device_name + b'\r\n')
+        if not await self.wait_for_state(lambda: self.connected, timeout):
+            raise EmpaticaServerConnectError(f"Could not connect to {self.device_name}!")
+        await self.suspend_streaming()
+
+    async def disconnect(self, timeout=5):
+        """
+        Sends the disconnect command packet to the Empatica Server.
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :return: None.
+        """
+        await self.send(b'device_disconnect\r\n')
+        if not await self.wait_for_state(lambda: not self.connected, timeout):
+            raise EmpaticaServerConnectError(f"Could not disconnect from {self.device_name}!")
+
+    async def close(self):
+        """
+        Closes the connection, stops the window task and ends every sample iterator.
+        :return: None.
+        """
+        self.set_connected(False)
+        await self.client.close()
+        if self.window_task:
+            await self.window_task
+            self.window_task = None
+        for queues in self.sample_queues.values():
+            for queue in queues:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def send(self, command):
+        """
+        Sends data to the Empatica Server.
+        :param command: bytes-like: data to send
+        :return: None.
+        """
+        await self.client.send(command)
+
+    async def subscribe_to_stream(self, stream, timeout=5):
+        """
+        Subscribes to a data stream, waits until the Empatica Server responds.
+        :param stream: bytes-like: data to stream.
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :return: None.
+        """
+        if await self.request_subscriptions([stream], True, timeout):
+            raise EmpaticaServerConnectError(f"Could not subscribe to {stream}!")
+
+    async def unsubscribe_from_stream(self, stream, timeout=5):
+        """
+        Unsubscribes from a data stream, waits until the Empatica Server responds.
+        :param stream: bytes-like: data to stop streaming.
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :return: None.
+        """
+        if await self.request_subscriptions([stream], False, timeout):
+            raise EmpaticaServerConnectError(f"Could not unsubscribe to {stream}!")
+
+    async def subscribe_many(self, streams, timeout=5):
+        """
+        Subscribes to several data streams with a single send, waits until the Empatica Server responds to all.
+        :param streams: list: bytes-like streams, e.g. EmpaticaDataStreams.ALL_STREAMS
+        :param timeout: int: seconds to wait for every response
+        :return: dict: error message for each stream that could not be subscribed, empty on success.
+        """
+        return await self.request_subscriptions(streams, True, timeout)
+
+    async def unsubscribe_many(self, streams, timeout=5):
+        """
+        Unsubscribes from several data streams with a single send, waits until the Empatica Server responds to all.
+        :param streams: list: bytes-like streams, e.g. EmpaticaDataStreams.ALL_STREAMS
+        :param timeout: int: seconds to wait for every response
+        :return: dict: error message for each stream that could not be unsubscribed, empty on success.
+        """
+        return await self.request_subscriptions(streams, False, timeout)
+
+    async def request_subscriptions(self, streams, subscribe, timeout=5):
+        """
+        Pipelines the subscribe commands for the streams and waits for all the acknowledgements together.
+        :param streams: list: bytes-like streams
+        :param subscribe: bool: True to subscribe, False to unsubscribe
+        :param timeout: int: seconds to wait for every response
+        :return: dict: error message for each stream that failed, empty on success.
+        """
+        names = [stream.decode("utf-8") for stream in streams]
+        await self.send(self.begin_subscriptions(streams, subscribe))
+        await self.wait_for_state(lambda: not any(name in self.pending_subscriptions for name in names), timeout)
+        return self.end_subscriptions(names)
+
+    async def suspend_streaming(self):
+        """
+        Stops the data streaming from the Empatica Server for the Empatica E4.
+        :return: None.
+        """
+        self.streaming = False
+        await self.send(b'pause ON\r\n')
+
+    async def start_streaming(self):
+        """
+        Starts the data streaming from the Empatica Server for the Empatica E4.
+        :return: None.
+        """
+        self.streaming = True
+        await self.send(b'pause OFF\r\n')
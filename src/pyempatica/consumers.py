@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+
+
+class SampleBatcher:
+    """
+    Collects the samples of a stream and hands them on as a list once enough have arrived or the oldest has waited
+    long enough. With a batch interval a timer thread delivers due batches, so the last samples of a stream that slows
+    down or stops are not held back until the next sample.
+    """
+
+    def __init__(self, deliver, batch_size=None, batch_interval=None, name=None, errors=None):
+        """
+        Initializes an empty batch and starts the timer thread if a batch interval is set.
+        :param deliver: callable: takes the list of (timestamp, values) samples of a full batch
+        :param batch_size: int: samples per batch, default None only delivers on the batch interval
+        :param batch_interval: float: most seconds the first sample of a batch waits, default None waits for a full
+        batch
+        :param name: str: stream name used in the saved errors, default None
+        :param errors: list: exceptions raised by deliver on the timer thread are saved to it, default None
+        """
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.name = name
+        self.errors = errors
+        self.samples = []
+        self.deadline = None
+        # Reentrant so deliver may call off, which closes the batcher
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.timer_thread = None
+        if batch_interval is not None:
+            self.timer_thread = threading.Thread(target=self.handle_timer, daemon=True)
+            self.timer_thread.start()
+
+    def add(self, timestamp, values):
+        """
+        Adds a sample and delivers the batch if it is full or due.
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values
+        :return: None.
+        """
+        with self.lock:
+            samples = self.samples
+            samples.append((timestamp, values))
+            if self.batch_size is not None and len(samples) >= self.batch_size:
+                self.flush()
+            elif self.batch_interval is not None:
+                now = time.monotonic()
+                if self.deadline is None:
+                    self.deadline = now + self.batch_interval
+                elif now >= self.deadline:
+                    self.flush()
+
+    def flush(self):
+        """
+        Delivers the pending samples, if any.
+        :return: None.
+        """
+        with self.lock:
+            samples = self.samples
+            if samples:
+                self.samples = []
+                self.deadline = None
+                self.deliver(samples)
+
+    def handle_timer(self):
+        """
+        Thread that delivers the pending samples once the first has waited the batch interval.
+        :return: None.
+        """
+        timeout = self.batch_interval
+        while not self.stopped.wait(timeout):
+            with self.lock:
+                deadline = self.deadline
+                if deadline is not None and time.monotonic() >= deadline:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        if self.errors is not None:
+                            self.errors.append(f"{self.name}: {e!r}")
+                    deadline = None
+                timeout = self.batch_interval if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+    def close(self):
+        """
+        Stops the timer thread and delivers the pending samples.
+        :return: None.
+        """
+        self.stopped.set()
+        if self.timer_thread and self.timer_thread is not threading.current_thread():
+            self.timer_thread.join()
+        self.flush()
+
+
+class SampleQueue(queue.Queue):
+    """
+    Queue of the samples of a stream that drops its oldest item instead of blocking the receiving thread when full.
+    """
+
+    def __init__(self, stream, maxsize=0):
+        """
+        Initializes the queue.
+        :param stream: str: stream name
+        :param maxsize: int: items kept before the oldest is dropped, default 0 is unbounded
+        """
+        super().__init__(maxsize)
+        self.stream = stream
+        self.dropped = 0
+        self.handle = None
+
+    def put_sample(self, timestamp, values):
+        """
+        Puts a single sample as a (timestamp, values) tuple, dropping the oldest item of a full queue.
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values
+        :return: None.
+        """
+        self.put_latest((timestamp, values))
+
+    def put_latest(self, item):
+        """
+        Puts an item without blocking, dropping the oldest item of a full queue.
+        :param item: sample or batch of samples
+        :return: None.
+        """
+        while True:
+            try:
+                self.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
@@ -0,0 +1,187 @@
+import selectors
+import threading
+import time
+from .empaticae4 import EmpaticaClient, EmpaticaE4
+
+
+class EmpaticaDeviceManager:
+    """
+    Connects several Empatica E4s and services all of their server connections from one reading thread.
+    The Empatica Server binds each connection to a single device and its data lines carry no device ID, so each
+    line is routed to the device that owns the connection it arrived on.
+    """
+
+    def __init__(self, buffer_size=4096):
+        """
+        Opens the control connection used to list devices and starts the reading thread.
+        :param buffer_size: int: size in bytes of each connection's receive buffer, default 4096
+        """
+        self.buffer_size = buffer_size
+        self.selector = selectors.DefaultSelector()
+        self.devices = {}
+        self.window_deadlines = {}
+        self.lock = threading.Lock()
+        self.control = EmpaticaClient(buffer_size, start_thread=False)
+        self.register(self.control)
+        self.throughput_time = time.monotonic()
+        self.throughput_readings = {}
+        self.reading = True
+        self.reading_thread = threading.Thread(target=self.handle_reading_receive)
+        self.reading_thread.start()
+
+    @property
+    def device_list(self):
+        """
+        Devices reported by the last list_connected_devices call.
+        :return: list: bytes-like device names.
+        """
+        return self.control.device_list
+
+    def list_connected_devices(self):
+        """
+        Sends the list connected devices command to get the devices auto-connected over BLE.
+        :return: None
+        """
+        self.control.send(b'device_list\r\n')
+
+    def register(self, client):
+        """
+        Adds a client's socket to the ones serviced by the reading thread.
+        :param client: EmpaticaClient: client created with start_thread=False
+        :return: None.
+        """
+        client.manager = self
+        self.selector.register(client.socket_conn, selectors.EVENT_READ, client)
+
+    def unregister(self, client):
+        """
+        Removes a client's socket from the ones serviced by the reading thread.
+        :param client: EmpaticaClient: registered client
+        :return: None.
+        """
+        try:
+            self.selector.unregister(client.socket_conn)
+        except (KeyError, ValueError):
+            pass
+
+    def connect(self, device_name, window_size=None, wrist_sensitivity=1, retention=None, timeout=5, window_hop=None,
+                window_lateness=2.0):
+        """
+        Connects an Empatica E4 over a new server connection serviced by the manager.
+        :param device_name: bytes-like: The Empatica E4 to connect to
+        :param window_size: int: The size of windows in seconds, default None
+        :param wrist_sensitivity: int: The number of samples to determine if E4 is on wrist, default is one
+        :param retention: float: Seconds of samples kept per stream in fixed size ring buffers, default None keeps all
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :param window_hop: float: seconds between window starts, default None is window_size, a smaller hop gives
+        overlapping windows
+        :param window_lateness: float: seconds a continuous stream may lag behind the newest sample before its
+        windows are saved without its last samples, default 2
+        :return: EmpaticaE4: the connected device.
+        """
+        client = EmpaticaClient(self.buffer_size, start_thread=False)
+        self.register(client)
+        try:
+            device = EmpaticaE4(device_name, window_size, wrist_sensitivity, retention, client=client, timeout=timeout,
+                                window_hop=window_hop, window_lateness=window_lateness)
+        except Exception:
+            client.close()
+            raise
+        with self.lock:
+            self.devices[device_name] = device
+            if window_size:
+                self.window_deadlines[device_name] = (time.monotonic() // device.window_hop + 1) * device.window_hop
+        return device
+
+    def disconnect(self, device_name, timeout=5):
+        """
+        Disconnects an Empatica E4 and closes its server connection.
+        :param device_name: bytes-like: The Empatica E4 to disconnect
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :return: None.
+        """
+        with self.lock:
+            device = self.devices.pop(device_name)
+            self.window_deadlines.pop(device_name, None)
+        try:
+            if device.connected:
+                device.disconnect(timeout)
+        finally:
+            if device.window_size:
+                device.split_window(final=True)
+            device.close()
+
+    def close(self):
+        """
+        Disconnects every Empatica E4, stops the reading thread and closes the control connection.
+        :return: None.
+        """
+        for device_name in list(self.devices):
+            try:
+                self.disconnect(device_name)
+            except Exception as e:
+                self.control.record_error("Other", str(e))
+        self.reading = False
+        self.reading_thread.join()
+        self.control.close()
+        self.selector.close()
+
+    def handle_reading_receive(self):
+        """
+        Waits on every registered socket and hands readable ones to their client, splitting windows when due.
+        :return: None.
+        """
+        while self.reading:
+            for key, _ in self.selector.select(self.next_timeout()):
+                client = key.data
+                try:
+                    client.receive_lines()
+                except OSError as e:
+                    self.unregister(client)
+                    client.handle_connection_error(e)
+            self.split_windows()
+
+    def next_timeout(self):
+        """
+        Seconds until the next window is due, capped so the reading flag is checked regularly.
+        :return: float.
+        """
+        with self.lock:
+            deadline = min(self.window_deadlines.values(), default=None)
+        if deadline is None:
+            return 0.1
+        return min(max(deadline - time.monotonic(), 0), 0.1)
+
+    def split_windows(self):
+        """
+        Splits the window of every device whose window has elapsed.
+        :return: None.
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = [self.devices[name] for name, deadline in self.window_deadlines.items() if deadline <= now]
+            for device in due:
+                self.window_deadlines[device.device_name] = (now // device.window_hop + 1) * device.window_hop
+        for device in due:
+            device.split_window()
+
+    def throughput(self):
+        """
+        Data lines handled per second for every device and in total since the previous call.
+        :return: dict: "total" and per device lines per second, "lines" total lines handled.
+        """
+        now = time.monotonic()
+        elapsed = max(now - self.throughput_time, 1e-9)
+        rates = {}
+        with self.lock:
+            devices = dict(self.devices)
+        for name, device in devices.items():
+            readings = device.client.readings
+            rates[name] = (readings - self.throughput_readings.get(name, 0)) / elapsed
+            self.throughput_readings[name] = readings
+        self.throughput_time = now
+        return {
+            "total": sum(rates.values()),
+            "lines": sum(device.client.readings for device in devices.values()),
+            "devices": rates
+        }
@@ -0,0 +1,200 @@
+import math
+from array import array
+from operator import mul
+from .empaticae4 import EmpaticaDataStreams
+from .ringbuffer import RingBuffer
+from .features import ACC_SCALE
+
+
+def lowpass_taps(factor, taps_per_factor=8):
+    """
+    Designs the anti-aliasing filter of a decimation, a Hamming windowed sinc with its cutoff at 80% of the Nyquist
+    frequency of the reduced rate and unity gain at DC.
+    :param factor: int: input samples per output sample
+    :param taps_per_factor: int: filter length in multiples of the factor, longer filters attenuate aliases more
+    :return: list: filter coefficients, an odd number of them.
+    """
+    count = factor * taps_per_factor + 1
+    cutoff = 0.4 / factor
+    middle = (count - 1) / 2
+    taps = []
+    for n in range(count):
+        x = n - middle
+        sinc = 2 * cutoff if x == 0 else math.sin(2 * math.pi * cutoff * x) / (math.pi * x)
+        taps.append(sinc * (0.54 - 0.46 * math.cos(2 * math.pi * n / (count - 1))))
+    total = math.fsum(taps)
+    return [tap / total for tap in taps]
+
+
+class Decimator:
+    """
+    Low-pass filters blocks of samples and keeps every factor-th, carrying the filter history across blocks so a
+    stream decimates the same however its samples are split. Outputs are timestamped with the sample at the middle
+    of the filter, which cancels its delay.
+    """
+
+    def __init__(self, factor, taps_per_factor=8):
+        """
+        Initializes the filter with an empty history.
+        :param factor: int: input samples per output sample
+        :param taps_per_factor: int: filter length in multiples of the factor, default 8
+        """
+        self.factor = factor
+        self.taps = lowpass_taps(factor, taps_per_factor) if factor > 1 else [1.0]
+        self.timestamps = []
+        self.columns = None
+        self.next_output = len(self.taps) - 1
+
+    def process(self, timestamps, columns):
+        """
+        Decimates a block of samples.
+        :param timestamps: list: timestamps of the block
+        :param columns: list: a list of values per channel
+        :return: tuple: list of output timestamps and a list of output values per channel.
+        """
+        if self.columns is None:
+            self.columns = [[] for _ in columns]
+        buffered_timestamps = self.timestamps + list(timestamps)
+        buffered = [history + list(column) for history, column in zip(self.columns, columns)]
+        taps = self.taps
+        count = len(taps)
+        delay = (count - 1) // 2
+        end = self.next_output
+        output_timestamps, outputs = [], [[] for _ in columns]
+        while end < len(buffered_timestamps):
+            start = end - count + 1
+            output_timestamps.append(buffered_timestamps[start + delay])
+            for output, values in zip(outputs, buffered):
+                output.append(math.fsum(map(mul, taps, values[start:end + 1])))
+            end += self.factor
+        # Keep the samples the next outputs still need
+        keep = count - 1
+        drop = max(len(buffered_timestamps) - keep, 0)
+        self.timestamps = buffered_timestamps[drop:]
+        self.columns = [values[drop:] for values in buffered]
+        self.next_output = end - drop
+        return output_timestamps, outputs
+
+
+class Envelope:
+    """
+    Reduces blocks of samples to the minimum and maximum of every factor samples, which keeps the peaks a plot of
+    a decimated stream loses.
+    """
+
+    def __init__(self, factor):
+        """
+        Initializes an empty block.
+        :param factor: int: input samples per output sample
+        """
+        self.factor = factor
+        self.timestamps = []
+        self.columns = None
+
+    def process(self, timestamps, columns):
+        """
+        Reduces a block of samples, samples that don't fill a run of factor are kept for the next block.
+        :param timestamps: list: timestamps of the block
+        :param columns: list: a list of values per channel
+        :return: tuple: list of output timestamps, the first of each run, and a list of minimums and a list of
+        maximums per channel, in channel order.
+        """
+        if self.columns is None:
+            self.columns = [[] for _ in columns]
+        buffered_timestamps = self.timestamps + list(timestamps)
+        buffered = [pending + list(column) for pending, column in zip(self.columns, columns)]
+        factor = self.factor
+        runs = len(buffered_timestamps) // factor * factor
+        output_timestamps = buffered_timestamps[0:runs:factor]
+        outputs = []
+        for values in buffered:
+            outputs.append([min(values[i:i + factor]) for i in range(0, runs, factor)])
+            outputs.append([max(values[i:i + factor]) for i in range(0, runs, factor)])
+        self.timestamps = buffered_timestamps[runs:]
+        self.columns = [values[runs:] for values in buffered]
+        return output_timestamps, outputs
+
+
+class EmpaticaDownsampler:
+    """
+    Reduces a stream of a device to a lower rate as its samples are saved and publishes the reduced samples as a
+    stream of their own to the device's sample listeners, so consumers subscribe to it with the device's on and
+    create_sample_queue, or record and relay it, and never touch the full rate samples. The stream is registered in
+    the device's derived_streams. Samples are reduced in blocks by anti-aliased decimation, or to min/max envelopes for
+    plotting, and ACC can first be reduced to its magnitude in g.
+    """
+
+    def __init__(self, device, stream, rate, envelope=False, magnitude=False, name=None, block_size=None,
+                 retention=None, taps_per_factor=8):
+        """
+        Starts reducing the stream.
+        :param device: EmpaticaDevice: device whose samples are reduced
+        :param stream: bytes-like or str: fixed rate stream, e.g. EmpaticaDataStreams.BVP
+        :param rate: float: reduced samples per second, a whole fraction of the stream rate
+        :param envelope: bool: reduce to the minimum and maximum of every channel instead of decimating
+        :param magnitude: bool: reduce ACC to the magnitude of its three axes in g first
+        :param name: str: stream name of the reduced samples, default e.g. "bvp_8hz" or "acc_magnitude_4hz"
+        :param block_size: int: samples collected before a block is reduced, default one reduced sample's worth
+        :param retention: float: seconds of reduced samples kept in ring buffers, default None keeps all
+        :param taps_per_factor: int: anti-aliasing filter length in multiples of the decimation factor, default 8
+        """
+        stream = stream.decode("utf-8") if isinstance(stream, bytes) else stream
+        if stream not in EmpaticaDataStreams.SAMPLE_RATES or stream in ("ibi", "tag"):
+            raise ValueError(f"{stream} is not a fixed rate stream")
+        if magnitude and stream != "acc":
+            raise ValueError("Only the acc stream has a magnitude")
+        self.factor = int(round(EmpaticaDataStreams.SAMPLE_RATES[stream] / rate))
+        if self.factor < 1 or not math.isclose(EmpaticaDataStreams.SAMPLE_RATES[stream] / self.factor, rate):
+            raise ValueError(f"{rate} Hz is not a whole fraction of the {stream} rate")
+        self.device = device
+        self.stream = stream
+        self.rate = rate
+        self.magnitude = magnitude
+        if name is None:
+            name = (stream + ("_magnitude" if magnitude else "") + ("_envelope" if envelope else "")
+                    + f"_{rate:g}hz")
+        self.name = name
+        self.reducer = Envelope(self.factor) if envelope else Decimator(self.factor, taps_per_factor)
+        channels = 1 if magnitude or stream != "acc" else 3
+        channels *= 2 if envelope else 1
+        if retention:
+            capacity = max(int(rate * retention), 1)
+            self.timestamps = RingBuffer(capacity, rate)
+            self.columns = tuple(RingBuffer(capacity, rate) for _ in range(channels))
+        else:
+            self.timestamps = array('d')
+            self.columns = tuple(array('d') for _ in range(channels))
+        device.derived_streams[name] = (rate, channels)
+        self.handle = device.on(stream, self.add_block, block_size or self.factor)
+
+    def close(self):
+        """
+        Stops reducing the stream, the pending samples are reduced first.
+        :return: None.
+        """
+        self.device.off(self.handle)
+        self.device.derived_streams.pop(self.name, None)
+
+    def add_block(self, samples):
+        """
+        Batch callback that reduces a block of samples, stores the reduced samples and publishes them to the
+        device's sample listeners.
+        :param samples: list: (timestamp, values) samples
+        :return: None.
+        """
+        timestamps = [timestamp for timestamp, _ in samples]
+        if self.magnitude:
+            columns = [[math.sqrt(x * x + y * y + z * z) * ACC_SCALE for _, (x, y, z) in samples]]
+        else:
+            columns = [list(column) for column in zip(*(values for _, values in samples))]
+        timestamps, columns = self.reducer.process(timestamps, columns)
+        if not timestamps:
+            return
+        self.timestamps.extend(timestamps)
+        for storage, column in zip(self.columns, columns):
+            storage.extend(column)
+        if self.device.sample_listeners:
+            publish_sample = self.device.publish_sample
+            name = self.name
+            for timestamp, values in zip(timestamps, zip(*columns)):
+                publish_sample(name, timestamp, values)
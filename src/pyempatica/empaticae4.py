@@ -1,9 +1,26 @@
 import socket
+import sys
 import threading
 import subprocess
 import time
+import math
 import pickle
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
 from datetime import datetime, timezone
+from .ringbuffer import RingBuffer
+from .windowing import WINDOW_FIELDS, StreamView, window_bounds, stream_base
+from .windowarchive import EmpaticaWindowWriter
+from .consumers import SampleBatcher, SampleQueue
+from .gaps import GapDetector
+from .sharedmemory import SharedRingBuffer, STREAM_FIELDS, shared_memory_name
+from .profiling import StageProfiler
 
 
 class EmpaticaServerConnectError(Exception):
@@ -39,6 +56,36 @@ class EmpaticaDataStreams:
     TAG = b'tag'
     TMP = b'tmp'
     ALL_STREAMS = [b'acc', b'bat', b'bvp', b'gsr', b'ibi', b'tag', b'tmp']
+    # Streams that arrive at their nominal rate for as long as they are subscribed
+    CONTINUOUS_STREAMS = ("acc", "bvp", "gsr", "tmp")
+    # Nominal samples per second, irregular streams (ibi, hr, bat, tag) use an upper bound
+    SAMPLE_RATES = {
+        "acc": 32,
+        "bvp": 64,
+        "gsr": 4,
+        "tmp": 4,
+        "ibi": 4,
+        "hr": 4,
+        "bat": 1,
+        "tag": 1
+    }
+    # Stream name and number of values of every data line tag
+    DATA_TAGS = {
+        b'E4_Acc': ("acc", 3),
+        b'E4_Bvp': ("bvp", 1),
+        b'E4_Gsr': ("gsr", 1),
+        b'E4_Temperature': ("tmp", 1),
+        b'E4_Ibi': ("ibi", 1),
+        b'E4_Hr': ("hr", 1),
+        b'E4_Battery': ("bat", 1),
+        b'E4_Tag': ("tag", 1)
+    }
+
+
+# The first six bytes of a data line tell its stream apart, batches are sorted on them
+TAG_PREFIX = itemgetter(slice(0, 6))
+# Tag prefix, tag, stream name and number of values of every data line tag, in prefix order
+BATCH_TAGS = sorted((tag[:6], tag, stream, width) for tag, (stream, width) in EmpaticaDataStreams.DATA_TAGS.items())
 
 
 def start_e4_server(exe_path):
@@ -50,34 +97,319 @@ def start_e4_server(exe_path):
     subprocess.Popen(exe_path)
 
 
-class EmpaticaClient:
+class EmpaticaProtocol:
     """
-    Client object to handle the socket connection to the Empatica Server.
+    Parses and dispatches the lines received from the Empatica Server, shared by the threaded and asyncio clients.
     """
 
-    def __init__(self):
+    def __init__(self, max_errors=100):
         """
-        Initializes the socket connection and starts the data reception thread.
+        Initializes the state shared by every client.
+        :param max_errors: int: most recent error messages kept of each kind, default 100, error_counts counts all
         """
-        self.waiting = False
-        try:
-            self.socket_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket_conn.connect(('127.0.0.1', 28000))
-        except ConnectionError as e:
-            raise EmpaticaServerConnectError(e)
         self.device = None
         self.device_list = []
-        self.reading_thread = None
-        self.reading = True
-        self.start_receive_thread()
         self.readings = 0
         self.last_error = None
+        self.max_errors = max_errors
         self.errors = {
             "EmpaticaServerConnectError": [],
             "EmpaticaCommandError": [],
             "EmpaticaDataError": [],
             "Other": []
         }
+        self.error_counts = {kind: 0 for kind in self.errors}
+        self.malformed_lines = 0
+        self.dropped_lines = 0
+        self.bytes_received = 0
+        self.reads = 0
+        self.full_reads = 0
+        # Reads whose handling took under 2**i microseconds are counted in parse_histogram[i]
+        self.parse_histogram = [0] * 32
+        self.parse_seconds = 0.0
+        self.parse_max = 0.0
+        self.stats_callback = None
+        self.stats_interval = 1.0
+        self.stats_deadline = 0.0
+        self.stats_previous = (time.perf_counter(), 0, 0, {})
+        self.reconnects = 0
+        self.reconnect_failures = 0
+        self.downtime = 0.0
+        self.last_outage = None
+        self.device_connect_result = None
+
+    def record_error(self, kind, message):
+        """
+        Saves an error message and counts it, dropping the oldest message of its kind once max_errors are kept.
+        :param kind: str: key of errors
+        :param message: error message
+        :return: None.
+        """
+        messages = self.errors[kind]
+        messages.append(message)
+        if len(messages) > self.max_errors:
+            del messages[0]
+        self.error_counts[kind] += 1
+
+    def record_read(self, received, elapsed):
+        """
+        Counts a read and the time its lines took to handle, calls the stats callback when it is due.
+        :param received: int: bytes read
+        :param elapsed: float: seconds spent handling the lines
+        :return: None.
+        """
+        self.bytes_received += received
+        self.reads += 1
+        self.parse_histogram[min(int(elapsed * 1e6).bit_length(), 31)] += 1
+        self.parse_seconds += elapsed
+        if elapsed > self.parse_max:
+            self.parse_max = elapsed
+        if self.stats_callback and time.perf_counter() >= self.stats_deadline:
+            self.stats_deadline = time.perf_counter() + self.stats_interval
+            self.stats_callback(self.stats())
+
+    def set_stats_callback(self, callback, interval=1.0):
+        """
+        Calls a function with stats() periodically from the receiving thread, after a read once the interval has
+        elapsed, so it is not called while no data arrives.
+        :param callback: callable: takes the stats dict, None stops the calls
+        :param interval: float: seconds between calls, default one
+        :return: None.
+        """
+        self.stats_interval = interval
+        self.stats_deadline = time.perf_counter() + interval
+        self.stats_callback = callback
+
+    def socket_backlog(self):
+        """
+        Bytes received by the operating system that have not been read yet, a growing backlog means the client is
+        falling behind the Empatica Server.
+        :return: int: bytes queued in the socket, None if the platform can't report it.
+        """
+        return None
+
+    def stream_counts(self):
+        """
+        Samples received and newest device timestamp of every stream of the device.
+        :return: dict: stream name to (samples, newest timestamp or None).
+        """
+        if not self.device:
+            return {}
+
+        def read_counts():
+            return {stream: (stream_base(timestamps) + len(timestamps), timestamps[-1] if len(timestamps) else None)
+                    for stream, (timestamps, _) in self.device.stream_storage.items()}
+        return self.device.read_consistent(read_counts)
+
+    def stats(self):
+        """
+        Snapshot of the receive path, rates are per second since the previous call or since the client was created.
+        :return: dict: bytes and lines received, per stream samples, rates and device timestamp lag behind the wall
+        clock, parse time histogram in microseconds, receive buffer depth, malformed, dropped and error counts and
+        the reconnects, failed reconnect attempts and seconds spent reconnecting.
+        """
+        now, wall = time.perf_counter(), time.time()
+        counts = self.stream_counts()
+        previous_time, previous_bytes, previous_lines, previous_counts = self.stats_previous
+        elapsed = now - previous_time
+        self.stats_previous = (now, self.bytes_received, self.readings, counts)
+
+        def rate(value, previous):
+            return (value - previous) / elapsed if elapsed > 0 else 0.0
+        return {
+            "elapsed": elapsed,
+            "bytes": self.bytes_received,
+            "bytes_per_second": rate(self.bytes_received, previous_bytes),
+            "lines": self.readings,
+            "lines_per_second": rate(self.readings, previous_lines),
+            "streams": {stream: {
+                "samples": samples,
+                "samples_per_second": rate(samples, previous_counts.get(stream, (0,))[0]),
+                "lag": None if newest is None else wall - newest
+            } for stream, (samples, newest) in counts.items()},
+            "reads": self.reads,
+            "parse_time": {
+                "mean": self.parse_seconds / self.reads * 1e6 if self.reads else 0.0,
+                "max": self.parse_max * 1e6,
+                "histogram": {2 ** i: count for i, count in enumerate(self.parse_histogram) if count}
+            },
+            "receive_buffer": {
+                "carried_bytes": getattr(self, "buffered_bytes", 0),
+                "socket_bytes": self.socket_backlog(),
+                "full_reads": self.full_reads
+            },
+            "malformed_lines": self.malformed_lines,
+            "dropped_lines": self.dropped_lines,
+            "errors": dict(self.error_counts),
+            "reconnect": {
+                "reconnects": self.reconnects,
+                "failed_attempts": self.reconnect_failures,
+                "downtime": self.downtime,
+                "last_outage": self.last_outage
+            }
+        }
+
+    def handle_line(self, return_bytes):
+        """
+        Handles a single line received from the Empatica Server.
+        :param return_bytes: list: whitespace separated tokens of the line.
+        :return: None.
+        """
+        if return_bytes[0] == b'R':
+            if b'ERR' in return_bytes:
+                self.handle_error_code(return_bytes)
+                if return_bytes[1] == b'device_connect':
+                    self.device_connect_result = False
+                if return_bytes[1] == b'device_subscribe' and len(return_bytes) > 2 and self.device:
+                    self.device.reject_subscription(return_bytes[2].decode("utf-8"), self.last_error)
+            elif b'connection' in return_bytes:
+                self.handle_error_code(return_bytes)
+            elif b'device' in return_bytes:
+                self.handle_error_code(return_bytes)
+            elif b'device_list' in return_bytes:
+                # R device_list <count> | <name> Empatica_E4 | <name> Empatica_E4 ...
+                self.device_list = [return_bytes[i - 1] for i in range(3, len(return_bytes))
+                                    if return_bytes[i] == b'Empatica_E4']
+            elif b'device_connect' in return_bytes:
+                self.device_connect_result = True
+                self.device.set_connected(True)
+                self.device.start_window_timer()
+            elif b'device_disconnect' in return_bytes:
+                self.device.set_connected(False)
+            elif b'device_subscribe' in return_bytes:
+                self.device.confirm_subscription(return_bytes[2].decode("utf-8"))
+        elif return_bytes[0][0:2] == b'E4':
+            self.handle_data_stream(return_bytes)
+
+    def handle_error_code(self, error):
+        """
+        Parses error code for formatting in Exception message.
+        :param error: bytes-like error message.
+        :return: None.
+        """
+        message = ""
+        for err in error:
+            message = message + err.decode("utf-8") + " "
+        self.last_error = "EmpaticaCommandError - " + message
+        self.record_error("EmpaticaCommandError", message)
+
+    def handle_data_stream(self, data):
+        """
+        Parses and saves the data received from the Empatica Server.
+        :param data: bytes-like packet.
+        :return: None.
+        """
+        try:
+            self.readings += 1
+            handler = self.device.data_handlers.get(data[0])
+            if handler:
+                return handler(data)
+            self.malformed_lines += 1
+            self.last_error = "EmpaticaDataError - " + str(data)
+            self.record_error("EmpaticaDataError", data)
+        except Exception as e:
+            self.malformed_lines += 1
+            self.last_error = "EmpaticaDataError - " + str(data) + str(e)
+            self.record_error("EmpaticaDataError", str(data) + str(e))
+
+    def handle_data_batch(self, lines):
+        """
+        Parses and saves many lines at once, decoding the fields of each stream in bulk into lists. The lines are
+        sorted by tag, which keeps the order of each stream's lines, so every stream is a contiguous run found by
+        binary search. Replies, malformed lines and lines of unknown tags are handled one by one first, and an error
+        saving a run is recorded like an error handling a line.
+        :param lines: list: bytes-like lines.
+        :return: None.
+        """
+        lines = sorted(lines, key=TAG_PREFIX)
+        runs = []
+        others = []
+        position = 0
+        for prefix, tag, stream, width in BATCH_TAGS:
+            low = bisect_left(lines, prefix, position)
+            high = bisect_left(lines, prefix + b'\xff', low)
+            if low > position:
+                others += lines[position:low]
+            if high > low:
+                runs.append((tag, stream, width, lines[low:high]))
+            position = high
+        others += lines[position:]
+        if others:
+            self.handle_data_lines(others)
+        for tag, stream, width, stream_lines in runs:
+            fields = width + 2
+            tokens = b' '.join(stream_lines).split()
+            try:
+                if len(tokens) != fields * len(stream_lines) or tokens[::fields].count(tag) != len(stream_lines):
+                    raise ValueError("malformed line")
+                timestamps = list(map(float, tokens[1::fields]))
+                columns = [list(map(float, tokens[i::fields])) for i in range(2, fields)]
+            except ValueError:
+                # One malformed line breaks the column layout, parse the lines one by one to isolate it
+                self.handle_data_lines(stream_lines)
+                continue
+            self.readings += len(stream_lines)
+            try:
+                self.device.store_batch(stream, timestamps, columns)
+            except Exception as e:
+                self.last_error = "EmpaticaDataError - " + stream + " batch " + str(e)
+                self.record_error("EmpaticaDataError", stream + " batch " + str(e))
+
+    def handle_data_lines(self, lines):
+        """
+        Parses and handles lines one by one.
+        :param lines: list: bytes-like lines.
+        :return: None.
+        """
+        for line in lines:
+            tokens = line.split()
+            if tokens:
+                self.handle_line(tokens)
+
+
+class EmpaticaClient(EmpaticaProtocol):
+    """
+    Client object to handle the socket connection to the Empatica Server.
+    """
+
+    def __init__(self, buffer_size=4096, start_thread=True, batch_parsing=True, max_errors=100, reconnect=False,
+                 reconnect_delay=0.5, reconnect_max_delay=30.0, reconnect_attempts=None):
+        """
+        Initializes the socket connection and starts the data reception thread.
+        :param buffer_size: int: size in bytes of the reusable receive buffer, default 4096
+        :param start_thread: bool: start a reading thread, False when an EmpaticaDeviceManager reads the socket
+        :param batch_parsing: bool: frame and decode the lines of each read in bulk with handle_data_batch, default
+        True, False handles the lines one by one so listeners see the samples of different streams in arrival order
+        :param max_errors: int: most recent error messages kept of each kind, default 100
+        :param reconnect: bool: reconnect and resume the session when the connection drops, default False, only
+        done by the client's own reading thread
+        :param reconnect_delay: float: seconds before the first reconnect attempt, doubled after every failure
+        :param reconnect_max_delay: float: longest wait between reconnect attempts, default 30
+        :param reconnect_attempts: int: failed attempts before giving up, default None keeps trying
+        """
+        super().__init__(max_errors)
+        self.batch_parsing = batch_parsing
+        self.waiting = False
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnecting = False
+        self.stopped = threading.Event()
+        self.profiler = None
+        try:
+            self.socket_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket_conn.connect(('127.0.0.1', 28000))
+        except ConnectionError as e:
+            raise EmpaticaServerConnectError(e)
+        self.receive_buffer = bytearray(buffer_size)
+        self.receive_view = memoryview(self.receive_buffer)
+        self.buffered_bytes = 0
+        self.reading_thread = None
+        self.reading = True
+        self.manager = None
+        if start_thread:
+            self.start_receive_thread()
 
     def close(self):
         """
@@ -86,9 +418,13 @@ class EmpaticaClient:
         """
         try:
             self.stop_reading_thread()
+            if self.manager:
+                self.manager.unregister(self)
+            # Shutting down wakes the reading thread if it is blocked in recv_into
+            self.socket_conn.shutdown(socket.SHUT_RDWR)
             self.socket_conn.close()
         except Exception as e:
-            self.errors["Other"].append(str(e))
+            self.record_error("Other", str(e))
 
     def send(self, packet):
         """
@@ -99,7 +435,7 @@ class EmpaticaClient:
         try:
             self.socket_conn.send(packet)
         except Exception as e:
-            self.errors["Other"].append(str(e))
+            self.record_error("Other", str(e))
 
     def recv(self):
         """
@@ -109,7 +445,7 @@ class EmpaticaClient:
         try:
             return self.socket_conn.recv(4096)
         except Exception as e:
-            self.errors["Other"].append(str(e))
+            self.record_error("Other", str(e))
 
     def start_receive_thread(self):
         """
@@ -128,117 +464,198 @@ class EmpaticaClient:
         """
         while self.reading:
             try:
-                return_bytes = self.socket_conn.recv(4096)
-                return_bytes = return_bytes.split()
-                if return_bytes:
-                    if return_bytes[0] == b'R':
-                        if b'ERR' in return_bytes:
-                            self.handle_error_code(return_bytes)
-                        elif b'connection' in return_bytes:
-                            self.handle_error_code(return_bytes)
-                        elif b'device' in return_bytes:
-                            self.handle_error_code(return_bytes)
-                        elif b'device_list' in return_bytes:
-                            self.device_list = []
-                            for i in range(4, len(return_bytes), 2):
-                                if return_bytes[i + 1] == b'Empatica_E4':
-                                    self.device_list.append(return_bytes[i])
-                        elif b'device_connect' in return_bytes:
-                            self.device.connected = True
-                            self.device.start_window_timer()
-                        elif b'device_disconnect' in return_bytes:
-                            self.device.connected = False
-                        elif b'device_subscribe' in return_bytes:
-                            self.device.subscribed_streams[return_bytes[2].decode("utf-8")] = \
-                                not self.device.subscribed_streams.get(return_bytes[2].decode("utf-8"))
-                    elif return_bytes[0][0:2] == b'E4':
-                        self.handle_data_stream(return_bytes)
-            except ConnectionAbortedError as cae:
-                self.last_error = str(cae)
-                self.errors["Other"].append(str(cae))
-                self.reading = False
-                if self.device:
-                    self.device.connected = False
-            except ConnectionResetError as cre:
-                self.last_error = str(cre)
-                self.errors["Other"].append(str(cre))
-                self.reading = False
-                if self.device:
-                    self.device.connected = False
-            except ConnectionError as ce:
-                self.last_error = str(ce)
-                self.errors["Other"].append(str(ce))
-                self.reading = False
-                if self.device:
-                    self.device.connected = False
+                self.receive_lines()
+            except OSError as e:
+                if self.reconnect and self.reading:
+                    self.resume_session(e)
+                else:
+                    self.handle_connection_error(e)
 
-    def stop_reading_thread(self):
+    def resume_session(self, error):
         """
-        Sets the reading thread variable to False to stop the reading thread.
+        Reconnects to the Empatica Server with exponential backoff after the connection drops, then connects the
+        Empatica E4 again, restores its subscriptions and resumes streaming if it was streaming. The device stays
+        connected meanwhile so its windows carry on, and the outage is recorded with EmpaticaDevice.mark_outage.
+        :param error: OSError: error that dropped the connection
         :return: None.
         """
+        self.last_error = str(error)
+        self.record_error("Other", str(error))
+        self.reconnecting = True
+        started = time.monotonic()
+        device = self.device
+        newest = max((timestamp for _, timestamp in self.stream_counts().values() if timestamp is not None),
+                     default=None)
+        streams = [name.encode("utf-8") for name, subscribed in device.subscribed_streams.items()
+                   if subscribed] if device else []
+        delay = self.reconnect_delay
+        failures = 0
+        while self.reading:
+            try:
+                self.socket_conn.close()
+            except OSError:
+                pass
+            if self.reconnect_attempts is not None and failures >= self.reconnect_attempts:
+                self.reconnecting = False
+                self.handle_connection_error(ConnectionAbortedError(f"Gave up reconnecting after {failures} attempts"))
+                return
+            if self.stopped.wait(delay):
+                break
+            try:
+                self.socket_conn = socket.create_connection(('127.0.0.1', 28000), timeout=5)
+                self.buffered_bytes = 0
+                if device is not None and getattr(device, "device_name", None):
+                    # The replies are read here since this is the reading thread, data lines are handled as usual
+                    self.device_connect_result = None
+                    self.socket_conn.sendall(b'device_connect ' + device.device_name + b'\r\n')
+                    while self.device_connect_result is None:
+                        self.receive_lines()
+                    if not self.device_connect_result:
+                        raise ConnectionRefusedError(f"Could not connect to {device.device_name}!")
+                self.socket_conn.settimeout(None)
+            except OSError as e:
+                failures += 1
+                self.reconnect_failures += 1
+                self.record_error("EmpaticaServerConnectError", str(e))
+                delay = min(delay * 2, self.reconnect_max_delay)
+                continue
+            commands = device.begin_subscriptions(streams, True) if streams else b''
+            if device is not None and device.streaming:
+                commands += b'pause OFF\r\n'
+            if commands:
+                self.send(commands)
+            downtime = time.monotonic() - started
+            self.reconnects += 1
+            self.downtime += downtime
+            self.last_outage = downtime
+            if device is not None:
+                device.mark_outage(newest, time.time())
+            break
+        self.reconnecting = False
+
+    def handle_connection_error(self, error):
+        """
+        Records a socket error and marks the connection and device as closed.
+        :param error: OSError: error raised by the socket
+        :return: None.
+        """
+        # close() can release the socket between the reading check and the next read
+        if not self.reading and not isinstance(error, ConnectionError):
+            return
+        self.last_error = str(error)
+        self.record_error("Other", str(error))
         self.reading = False
+        if self.device:
+            self.device.set_connected(False)
 
-    def handle_error_code(self, error):
+    def receive_lines(self):
         """
-        Parses error code for formatting in Exception message.
-        :param error: bytes-like error message.
+        Reads from the socket into the receive buffer and handles every complete line in it.
+        A partial line at the end of the read is carried over to the start of the buffer for the next read.
+        :return: int: number of bytes read from the socket.
+        """
+        received = self.read_socket()
+        if not received:
+            if not self.reading:
+                return 0
+            raise ConnectionResetError("Empatica Server closed the connection")
+        self.handle_received(received)
+        return received
+
+    def read_socket(self):
+        """
+        Reads from the socket into the free end of the receive buffer.
+        :return: int: number of bytes read, zero once the Empatica Server closed the connection.
+        """
+        return self.socket_conn.recv_into(self.receive_view[self.buffered_bytes:])
+
+    def handle_received(self, received):
+        """
+        Handles every complete line in the receive buffer after a read.
+        :param received: int: number of bytes the read added to the buffer
         :return: None.
         """
-        message = ""
-        for err in error:
-            message = message + err.decode("utf-8") + " "
-        self.last_error = "EmpaticaCommandError - " + message
-        self.errors["EmpaticaCommandError"].append(message)
+        started = time.perf_counter()
+        end = self.buffered_bytes + received
+        if end == len(self.receive_buffer):
+            # The read filled the buffer, so more data is probably waiting in the socket
+            self.full_reads += 1
+        start = 0
+        if self.batch_parsing:
+            # Every complete line is framed by one split and handed over together
+            last = self.receive_buffer.rfind(b'\n', 0, end)
+            if last != -1:
+                self.handle_data_batch(bytes(self.receive_view[:last]).split(b'\n'))
+                start = last + 1
+        else:
+            newline = self.receive_buffer.find(b'\n', start, end)
+            while newline != -1:
+                tokens = bytes(self.receive_view[start:newline]).split()
+                if tokens:
+                    self.handle_line(tokens)
+                start = newline + 1
+                newline = self.receive_buffer.find(b'\n', start, end)
+        remaining = end - start
+        if remaining == len(self.receive_buffer):
+            # A line longer than the whole buffer can't be framed, drop it
+            self.last_error = "EmpaticaDataError - line exceeds receive buffer"
+            self.record_error("EmpaticaDataError", bytes(self.receive_view[:64]))
+            self.dropped_lines += 1
+            remaining = 0
+        elif remaining and start:
+            self.receive_view[:remaining] = self.receive_view[start:end]
+        self.buffered_bytes = remaining
+        self.record_read(received, time.perf_counter() - started)
 
-    def handle_data_stream(self, data):
+    def enable_profiling(self, profiler=None, trace_events=0):
         """
-        Parses and saves the data received from the Empatica Server.
-        :param data: bytes-like packet.
+        Times each stage of the receive loop, the socket read (including the wait for data) and the handling of the
+        lines read, and the storage stages of the device, all disabled stages cost nothing.
+        :param profiler: StageProfiler: profiler the timings are recorded to, default None creates one
+        :param trace_events: int: most recent calls kept as trace events by a created profiler, default 0
+        :return: StageProfiler: the profiler, whose stats() returns the percentiles of every stage.
+        """
+        self.disable_profiling()
+        profiler = profiler or StageProfiler(trace_events=trace_events)
+        self.profiler = profiler
+        self.read_socket = profiler.timed("recv", self.read_socket)
+        self.handle_received = profiler.timed("parse", self.handle_received)
+        self.handle_data_batch = profiler.timed("parse_batch", self.handle_data_batch)
+        if self.device:
+            self.device.enable_profiling(profiler)
+        return profiler
+
+    def disable_profiling(self):
+        """
+        Stops timing the stages of the client and its device.
         :return: None.
         """
+        for name in ("read_socket", "handle_received", "handle_data_batch"):
+            self.__dict__.pop(name, None)
+        if getattr(self, "profiler", None) and self.device:
+            self.device.disable_profiling()
+        self.profiler = None
+
+    def socket_backlog(self):
+        """
+        Bytes received by the operating system that have not been read yet, a growing backlog means the client is
+        falling behind the Empatica Server.
+        :return: int: bytes queued in the socket, None if the platform can't report it.
+        """
+        if fcntl is None:
+            return None
         try:
-            self.readings += 1
-            data_type = data[0][3:]
-            if data_type == b'Acc':
-                self.device.acc_3d.append(float(data[2]))
-                self.device.acc_3d.append(float(data[3]))
-                self.device.acc_3d.append(float(data[4]))
-                self.device.acc_x.append(float(data[2]))
-                self.device.acc_y.append(float(data[3]))
-                self.device.acc_z.append(float(data[4]))
-                self.device.acc_timestamps.append(float(data[1]))
-            elif data_type == b'Bvp':
-                self.device.bvp.append(float(data[2]))
-                self.device.bvp_timestamps.append(float(data[1]))
-            elif data_type == b'Gsr':
-                self.device.gsr.append(float(data[2]))
-                self.device.gsr_timestamps.append(float(data[1]))
-                if all(ele == 0 for ele in self.device.gsr[-self.device.wrist_sensitivity:]):
-                    self.device.on_wrist = False
-                else:
-                    self.device.on_wrist = True
-            elif data_type == b'Temperature':
-                self.device.tmp.append(float(data[2]))
-                self.device.tmp_timestamps.append(float(data[1]))
-            elif data_type == b'Ibi':
-                self.device.ibi.append(float(data[2]))
-                self.device.ibi_timestamps.append(float(data[1]))
-            elif data_type == b'Hr':
-                self.device.hr.append(float(data[2]))
-                self.device.hr_timestamps.append(float(data[1]))
-            elif data_type == b'Battery':
-                self.device.bat.append(float(data[2]))
-                self.device.bat_timestamps.append(float(data[1]))
-            elif data_type == b'Tag':
-                self.device.tag.append(float(data[2]))
-                self.device.tag_timestamps.append(float(data[1]))
-            else:
-                self.last_error = "EmpaticaDataError - " + str(data)
-                self.errors["EmpaticaDataError"].append(data)
-        except Exception as e:
-            self.last_error = "EmpaticaDataError - " + str(data) + str(e)
-            self.errors["EmpaticaDataError"].append(str(data) + str(e))
+            return int.from_bytes(fcntl.ioctl(self.socket_conn.fileno(), termios.FIONREAD, bytes(4)), sys.byteorder)
+        except (OSError, ValueError):
+            return None
+
+    def stop_reading_thread(self):
+        """
+        Sets the reading thread variable to False to stop the reading thread.
+        :return: None.
+        """
+        self.reading = False
+        self.stopped.set()
 
     def list_connected_devices(self):
         """
@@ -248,36 +665,95 @@ class EmpaticaClient:
         self.socket_conn.send(b'device_list\r\n')
 
 
-class EmpaticaE4:
+class EmpaticaDevice:
     """
-    Class to wrap the client socket connection and configure the data streams.
+    Per-stream storage, windowing and connection state shared by the threaded and asyncio Empatica E4 interfaces.
+    Windows are cut by device timestamp, window_hop sets the seconds between window starts and defaults to
+    window_size, a smaller hop gives overlapping windows. A window is saved once every continuous stream has passed
+    its end, so a stream that arrives late over BLE is not cut short, unless it lags the newest sample by more than
+    window_lateness. Every callable in window_listeners is called with each window and its start and stop device
+    timestamps as the window is saved.
+    Samples are stored by a single receiving thread that makes sequence odd while it writes and even once the
+    storage is consistent again, so other threads read through read_consistent or snapshot without locking it.
     """
-    def __init__(self, device_name, window_size=None, wrist_sensitivity=1):
+
+    def __init__(self, window_size=None, wrist_sensitivity=1, retention=None, wrist_threshold=0.0,
+                 wrist_hysteresis=0.0, shared_memory=None, window_hop=None, window_lateness=2.0):
         """
-        Initializes the socket connection and connects the Empatica E4 specified.
-        :param device_name: str: The Empatica E4 to connect to
+        Initializes the per-stream storage and the connection state.
         :param window_size: int: The size of windows in seconds, default None
         :param wrist_sensitivity: int: The number of samples to determine if E4 is on wrist, default is one
+        :param retention: float: Seconds of samples kept per stream in fixed size ring buffers, default None keeps all
+        :param wrist_threshold: float: GSR at or below which a sample counts as off wrist, default zero
+        :param wrist_hysteresis: float: GSR above the threshold needed to count as back on wrist, default zero
+        :param shared_memory: bytes-like or str: device name the ring buffers are shared under with other processes,
+        default None keeps them private, needs retention
+        :param window_hop: float: seconds between window starts, default None is window_size, a smaller hop gives
+        overlapping windows
+        :param window_lateness: float: seconds a continuous stream may lag behind the newest sample before its
+        windows are saved without its last samples, default 2
         """
+        if shared_memory is not None and not retention:
+            raise ValueError("Shared memory buffers need a retention")
+        if window_hop is not None and window_hop <= 0:
+            raise ValueError("window_hop must be positive")
         self.wrist_sensitivity = wrist_sensitivity
+        self.wrist_threshold = wrist_threshold
+        self.wrist_hysteresis = wrist_hysteresis
         self.window_size = window_size
+        self.window_hop = window_hop or window_size
+        self.window_lateness = window_lateness
+        self.window_start = None
+        self.retention = retention
+        self.shared_memory = shared_memory
         self.on_wrist = False
-        self.window_thread = threading.Thread(target=self.timer_thread)
-        self.client = EmpaticaClient()
-        self.connected = False
-        self.connect(device_name)
-        while not self.connected:
-            pass
-        self.suspend_streaming()
-        self.acc_3d, self.acc_x, self.acc_y, self.acc_z, self.acc_timestamps = [], [], [], [], []
-        self.bvp, self.bvp_timestamps = [], []
-        self.gsr, self.gsr_timestamps = [], []
-        self.tmp, self.tmp_timestamps = [], []
-        self.tag, self.tag_timestamps = [], []
-        self.ibi, self.ibi_timestamps = [], []
-        self.bat, self.bat_timestamps = [], []
-        self.hr, self.hr_timestamps = [], []
+        self.off_wrist_samples = 0
+        self.wrist_samples = 0
+        self.wrist_listeners = []
+        self.acc_3d = self.create_stream_storage("acc", 3, "acc_3d")
+        self.acc_x, self.acc_y, self.acc_z = [self.create_stream_storage("acc", 1, field)
+                                              for field in ("acc_x", "acc_y", "acc_z")]
+        self.acc_timestamps = self.create_stream_storage("acc", 1, "acc_timestamps")
+        self.bvp, self.bvp_timestamps = [self.create_stream_storage("bvp", 1, field)
+                                         for field in ("bvp", "bvp_timestamps")]
+        self.gsr, self.gsr_timestamps = [self.create_stream_storage("gsr", 1, field)
+                                         for field in ("gsr", "gsr_timestamps")]
+        self.tmp, self.tmp_timestamps = [self.create_stream_storage("tmp", 1, field)
+                                         for field in ("tmp", "tmp_timestamps")]
+        self.tag, self.tag_timestamps = [self.create_stream_storage("tag", 1, field)
+                                         for field in ("tag", "tag_timestamps")]
+        self.ibi, self.ibi_timestamps = [self.create_stream_storage("ibi", 1, field)
+                                         for field in ("ibi", "ibi_timestamps")]
+        self.bat, self.bat_timestamps = [self.create_stream_storage("bat", 1, field)
+                                         for field in ("bat", "bat_timestamps")]
+        self.hr, self.hr_timestamps = [self.create_stream_storage("hr", 1, field)
+                                       for field in ("hr", "hr_timestamps")]
+        # Timestamp storage and value storage of every stream, in the order of the values in a data line
+        self.stream_storage = {
+            "acc": (self.acc_timestamps, (self.acc_x, self.acc_y, self.acc_z)),
+            "bvp": (self.bvp_timestamps, (self.bvp,)),
+            "gsr": (self.gsr_timestamps, (self.gsr,)),
+            "tmp": (self.tmp_timestamps, (self.tmp,)),
+            "tag": (self.tag_timestamps, (self.tag,)),
+            "ibi": (self.ibi_timestamps, (self.ibi,)),
+            "bat": (self.bat_timestamps, (self.bat,)),
+            "hr": (self.hr_timestamps, (self.hr,))
+        }
+        # Rate and channel count of the streams published with publish_sample besides the E4's, e.g. reduced streams
+        self.derived_streams = {}
+        self.sequence = 0
+        self.sample_listeners = []
+        self.stream_callbacks = {}
+        self.callback_errors = []
+        self.callback_lock = threading.Lock()
+        self.gap_detectors = {}
+        self.profiler = None
+        self.outages = []
+        self.streaming = False
+        self.data_handlers = self.create_data_handlers()
         self.windowed_readings = []
+        self.window_times = []
+        self.window_listeners = []
         self.subscribed_streams = {
             "acc": False,
             "bvp": False,
@@ -287,6 +763,474 @@ class EmpaticaE4:
             "ibi": False,
             "bat": False
         }
+        self.pending_subscriptions = {}
+        self.subscription_errors = {}
+        self.state_changed = threading.Condition()
+        self.connected = False
+
+    def create_stream_storage(self, stream, channels=1, field=None):
+        """
+        Creates the storage for a stream, a RingBuffer sized from the stream rate if retention is set, else a list.
+        :param stream: str: stream name in EmpaticaDataStreams.SAMPLE_RATES
+        :param channels: int: values stored per sample, default one
+        :param field: str: storage field in WINDOW_FIELDS, names the shared memory block if shared_memory is set
+        :return: RingBuffer, SharedRingBuffer or list.
+        """
+        if self.retention:
+            sample_rate = EmpaticaDataStreams.SAMPLE_RATES[stream] * channels
+            capacity = max(int(sample_rate * self.retention), 1)
+            if self.shared_memory is not None:
+                return SharedRingBuffer(shared_memory_name(self.shared_memory, field), capacity, sample_rate)
+            return RingBuffer(capacity, sample_rate)
+        return []
+
+    def release_shared_memory(self):
+        """
+        Copies the storage into private ring buffers and removes its shared memory blocks, so the samples and
+        windows can still be read and saved, call once the receiving thread has stopped.
+        :return: None.
+        """
+        if self.shared_memory is None:
+            return
+        for field in WINDOW_FIELDS:
+            shared = getattr(self, field)
+            private = RingBuffer(shared.capacity, shared.sample_rate)
+            with shared.view() as values:
+                private.extend(values)
+            private.total = shared.total
+            shared.close()
+            setattr(self, field, private)
+        self.stream_storage = {stream: (getattr(self, timestamp_field), tuple(getattr(self, field)
+                                                                               for field in value_fields))
+                               for stream, (timestamp_field, value_fields) in STREAM_FIELDS.items()}
+        self.data_handlers = self.create_data_handlers()
+        self.shared_memory = None
+
+    def create_data_handlers(self):
+        """
+        Builds the data handler of every data line tag, timed per stream if profiling is enabled.
+        :return: dict: data line tag to handler.
+        """
+        handlers = {tag: self.create_data_handler(stream) for tag, (stream, _) in EmpaticaDataStreams.DATA_TAGS.items()}
+        if self.profiler:
+            handlers = {tag: self.profiler.timed("dispatch:" + EmpaticaDataStreams.DATA_TAGS[tag][0], handler)
+                        for tag, handler in handlers.items()}
+        return handlers
+
+    def create_data_handler(self, stream):
+        """
+        Builds the function that parses a data line of a stream and saves it, bound to the stream's storage.
+        :param stream: str: stream name
+        :return: callable: takes the tokens of a data line.
+        """
+        timestamps, columns = self.stream_storage[stream]
+        if stream in self.gap_detectors:
+            # Gap detection may store filling samples ahead of the sample, which store_sample handles
+            store_sample = self.store_sample
+            width = len(columns)
+
+            def handle_checked(data):
+                store_sample(stream, float(data[1]), tuple(map(float, data[2:2 + width])))
+            return handle_checked
+        append_timestamp = timestamps.append
+        listeners = self.sample_listeners
+        publish_sample = self.publish_sample
+        device = self
+        if stream == "acc":
+            append_x, append_y, append_z = [column.append for column in columns]
+            extend_3d = self.acc_3d.extend
+
+            def handle_acc(data):
+                timestamp = float(data[1])
+                values = (float(data[2]), float(data[3]), float(data[4]))
+                device.sequence += 1
+                append_timestamp(timestamp)
+                append_x(values[0])
+                append_y(values[1])
+                append_z(values[2])
+                extend_3d(values)
+                device.sequence += 1
+                if listeners:
+                    publish_sample(stream, timestamp, values)
+            return handle_acc
+        append_value = columns[0].append
+        if stream == "gsr":
+            update_on_wrist = self.update_on_wrist
+
+            def handle_gsr(data):
+                timestamp = float(data[1])
+                value = float(data[2])
+                device.sequence += 1
+                append_timestamp(timestamp)
+                append_value(value)
+                device.sequence += 1
+                update_on_wrist(value, timestamp)
+                if listeners:
+                    publish_sample(stream, timestamp, (value,))
+            return handle_gsr
+
+        def handle_value(data):
+            timestamp = float(data[1])
+            value = float(data[2])
+            device.sequence += 1
+            append_timestamp(timestamp)
+            append_value(value)
+            device.sequence += 1
+            if listeners:
+                publish_sample(stream, timestamp, (value,))
+        return handle_value
+
+    def store_sample(self, stream, timestamp, values):
+        """
+        Saves a parsed sample to the storage of its stream, after the samples filling the gap before it if gap
+        detection fills the stream.
+        :param stream: str: stream name
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values in data line order
+        :return: None.
+        """
+        timestamps, columns = self.stream_storage[stream]
+        detector = self.gap_detectors.get(stream)
+        samples = detector.check(timestamp, values) if detector else []
+        samples.append((timestamp, values))
+        self.sequence += 1
+        try:
+            for sample_timestamp, sample_values in samples:
+                timestamps.append(sample_timestamp)
+                for column, value in zip(columns, sample_values):
+                    column.append(value)
+                if stream == "acc":
+                    self.acc_3d.extend(sample_values)
+        finally:
+            self.sequence += 1
+        if stream == "gsr":
+            self.update_on_wrist(values[0], timestamp)
+        if self.sample_listeners:
+            self.publish_sample(stream, timestamp, values)
+
+    def store_batch(self, stream, timestamps, columns):
+        """
+        Saves many parsed samples of one stream to its storage.
+        :param stream: str: stream name
+        :param timestamps: list or array: device timestamps
+        :param columns: list: one list or array of values per value in a data line
+        :return: None.
+        """
+        timestamp_storage, storage = self.stream_storage[stream]
+        detector = self.gap_detectors.get(stream)
+        # Filling samples are stored but not published, listeners see the received samples only
+        stored_timestamps, stored_columns = detector.check_batch(timestamps, columns) if detector else (
+            timestamps, columns)
+        if stream == "acc":
+            # Slices of an array can only be assigned arrays, so lists are interleaved into a list
+            if isinstance(stored_columns[0], array):
+                interleaved = array('d', bytes(24 * len(stored_timestamps)))
+            else:
+                interleaved = [0.0] * (3 * len(stored_timestamps))
+            for offset, column in enumerate(stored_columns):
+                interleaved[offset::3] = column
+        self.sequence += 1
+        try:
+            timestamp_storage.extend(stored_timestamps)
+            for values, column in zip(storage, stored_columns):
+                values.extend(column)
+            if stream == "acc":
+                self.acc_3d.extend(interleaved)
+        finally:
+            self.sequence += 1
+        if stream == "gsr":
+            for timestamp, value in zip(timestamps, columns[0]):
+                self.update_on_wrist(value, timestamp)
+        if self.sample_listeners:
+            for timestamp, values in zip(timestamps, zip(*columns)):
+                self.publish_sample(stream, timestamp, values)
+
+    def publish_sample(self, stream, timestamp, values):
+        """
+        Hands a saved sample to every sample listener, also used to publish the samples of derived streams.
+        :param stream: str: stream name
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values in data line order
+        :return: None.
+        """
+        for listener in self.sample_listeners:
+            listener(stream, timestamp, values)
+
+    def on(self, stream, callback, batch_size=None, batch_interval=None):
+        """
+        Calls the callback with the samples of a stream as they are saved, from the thread that receives the data, or
+        for batches due after batch_interval from the batcher's timer thread. Exceptions raised by the callback are
+        saved to callback_errors.
+        :param stream: bytes-like or str: stream, e.g. EmpaticaDataStreams.BVP, hr samples arrive on the "hr" stream
+        :param callback: callable: takes the timestamp and the tuple of values of a sample, or the list of
+        (timestamp, values) samples of a batch if batch_size or batch_interval is set
+        :param batch_size: int: samples per batch, default None calls the callback with every sample
+        :param batch_interval: float: most seconds the first sample of a batch waits, default None
+        :return: callable: handle to pass to off.
+        """
+        name = stream.decode("utf-8") if isinstance(stream, bytes) else stream
+        if batch_size is not None or batch_interval is not None:
+            handle = SampleBatcher(callback, batch_size, batch_interval, name, self.callback_errors).add
+        else:
+            handle = callback
+        with self.callback_lock:
+            # The dict is replaced rather than changed so the receiving thread never sees a partial update
+            callbacks = dict(self.stream_callbacks)
+            callbacks[name] = callbacks.get(name, ()) + (handle,)
+            self.stream_callbacks = callbacks
+            if self.dispatch_sample not in self.sample_listeners:
+                self.sample_listeners.append(self.dispatch_sample)
+        return handle
+
+    def off(self, handle):
+        """
+        Stops calling a callback added with on, a pending batch is delivered and the batch timer is stopped.
+        :param handle: callable: handle returned by on
+        :return: None.
+        """
+        with self.callback_lock:
+            callbacks = {name: tuple(callback for callback in stream_callbacks if callback != handle)
+                         for name, stream_callbacks in self.stream_callbacks.items()}
+            self.stream_callbacks = {name: stream_callbacks for name, stream_callbacks in callbacks.items()
+                                     if stream_callbacks}
+            if not self.stream_callbacks and self.dispatch_sample in self.sample_listeners:
+                self.sample_listeners.remove(self.dispatch_sample)
+        batcher = getattr(handle, "__self__", None)
+        if isinstance(batcher, SampleBatcher):
+            batcher.close()
+
+    def dispatch_sample(self, stream, timestamp, values):
+        """
+        Sample listener that calls the callbacks added with on for the sample's stream.
+        :param stream: str: stream name
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values
+        :return: None.
+        """
+        for callback in self.stream_callbacks.get(stream, ()):
+            try:
+                callback(timestamp, values)
+            except Exception as e:
+                self.callback_errors.append(f"{stream}: {e!r}")
+
+    def create_sample_queue(self, stream, maxsize=0, batch_size=None, batch_interval=None):
+        """
+        Creates a queue that receives the samples of a stream as they are saved, so another thread can block on
+        new data instead of polling the storage.
+        :param stream: bytes-like or str: stream, e.g. EmpaticaDataStreams.BVP
+        :param maxsize: int: items kept before the oldest is dropped, default 0 is unbounded
+        :param batch_size: int: samples per item, default None puts (timestamp, values) tuples, if batch_size or
+        batch_interval is set lists of them are put
+        :param batch_interval: float: most seconds the first sample of a batch waits, default None
+        :return: SampleQueue: queue.Queue with the number of dropped items in dropped.
+        """
+        name = stream.decode("utf-8") if isinstance(stream, bytes) else stream
+        sample_queue = SampleQueue(name, maxsize)
+        if batch_size is not None or batch_interval is not None:
+            sample_queue.handle = self.on(name, sample_queue.put_latest, batch_size, batch_interval)
+        else:
+            sample_queue.handle = self.on(name, sample_queue.put_sample)
+        return sample_queue
+
+    def remove_sample_queue(self, sample_queue):
+        """
+        Stops putting samples on a queue created with create_sample_queue.
+        :param sample_queue: SampleQueue: queue to remove
+        :return: None.
+        """
+        self.off(sample_queue.handle)
+
+    def enable_gap_detection(self, fill=None, streams=("acc", "bvp", "gsr", "tmp"), tolerance=0.5,
+                             max_fill_seconds=10.0):
+        """
+        Checks the device timestamps of fixed rate streams for lost samples as they are saved, optionally storing
+        samples in place of the lost ones so windows hold uniformly sampled data. Filling samples are not passed to
+        sample listeners or the on-wrist check. Call this before streaming starts or while it is suspended.
+        :param fill: str: None only counts gaps, "nan" fills them with NaN and "linear" interpolates the values,
+        except over an outage marked with mark_outage
+        :param streams: tuple: fixed rate streams to check, default ACC, BVP, GSR and temperature
+        :param tolerance: float: fraction of a period an interval may exceed the period before it is a gap
+        :param max_fill_seconds: float: longer gaps are counted but not filled, default 10
+        :return: None.
+        """
+        self.gap_detectors = {stream: GapDetector(EmpaticaDataStreams.SAMPLE_RATES[stream], fill, tolerance,
+                                                  max_fill_seconds) for stream in streams}
+        self.data_handlers = self.create_data_handlers()
+
+    def disable_gap_detection(self):
+        """
+        Stops checking for lost samples, the counts so far are discarded.
+        :return: None.
+        """
+        self.gap_detectors = {}
+        self.data_handlers = self.create_data_handlers()
+
+    def gap_stats(self):
+        """
+        Lost sample counts of the streams checked by enable_gap_detection.
+        :return: dict: stream name to the received, expected, missing and filled samples, the number of gaps, the
+        most recent (start, end, missing samples) gaps, out of order samples and the mean, standard deviation and
+        largest deviation of the sample intervals from the nominal period in seconds.
+        """
+        return {stream: detector.stats() for stream, detector in self.gap_detectors.items()}
+
+    def enable_profiling(self, profiler):
+        """
+        Times the storage stages with a StageProfiler: the handler of each data line by stream, store_batch by
+        stream, the on-wrist check, the sample listeners and split_window.
+        :param profiler: StageProfiler: profiler the timings are recorded to
+        :return: None.
+        """
+        self.disable_profiling()
+        self.profiler = profiler
+        self.store_batch = profiler.timed("store_batch", self.store_batch, per_stream=True)
+        self.update_on_wrist = profiler.timed("wrist", self.update_on_wrist)
+        self.publish_sample = profiler.timed("listeners", self.publish_sample)
+        self.split_window = profiler.timed("split_window", self.split_window)
+        self.data_handlers = self.create_data_handlers()
+
+    def disable_profiling(self):
+        """
+        Removes the timing wrappers added by enable_profiling.
+        :return: None.
+        """
+        for name in ("store_batch", "update_on_wrist", "publish_sample", "split_window"):
+            self.__dict__.pop(name, None)
+        self.profiler = None
+        self.data_handlers = self.create_data_handlers()
+
+    def mark_outage(self, start, stop):
+        """
+        Records an interruption of the connection to the Empatica Server, samples in it were not received. Gap
+        detection fills the gap over the outage with NaN, never interpolating it.
+        :param start: float: newest device timestamp received before the outage, None if there was none
+        :param stop: float: unix time the session resumed
+        :return: None.
+        """
+        self.outages.append((start, stop))
+        for detector in self.gap_detectors.values():
+            detector.mark_outage()
+
+    def update_on_wrist(self, value, timestamp):
+        """
+        Updates the on-wrist state in constant time from a running count of consecutive off wrist GSR samples.
+        The E4 is off wrist once the last wrist_sensitivity samples (or every sample so far) were off wrist.
+        :param value: float: GSR sample
+        :param timestamp: float: device timestamp of the sample
+        :return: None.
+        """
+        limit = self.wrist_threshold if self.on_wrist else self.wrist_threshold + self.wrist_hysteresis
+        if value <= limit:
+            self.off_wrist_samples += 1
+        else:
+            self.off_wrist_samples = 0
+        self.wrist_samples += 1
+        on_wrist = self.off_wrist_samples < min(self.wrist_sensitivity, self.wrist_samples)
+        if on_wrist != self.on_wrist:
+            self.on_wrist = on_wrist
+            for listener in self.wrist_listeners:
+                try:
+                    listener(on_wrist, timestamp)
+                except Exception as e:
+                    self.callback_errors.append(f"wrist: {e!r}")
+
+    def add_wrist_listener(self, listener):
+        """
+        Calls the listener on every on-wrist/off-wrist transition, from the thread that receives the data.
+        Exceptions raised by the listener are saved to callback_errors.
+        :param listener: callable: takes the new on_wrist state and the device timestamp of the transition
+        :return: None.
+        """
+        self.wrist_listeners.append(listener)
+
+    def remove_wrist_listener(self, listener):
+        """
+        Stops calling a listener added with add_wrist_listener.
+        :param listener: callable: listener to remove
+        :return: None.
+        """
+        self.wrist_listeners.remove(listener)
+
+    def notify_state_changed(self):
+        """
+        Wakes everything waiting for a connection or subscription change, called with state_changed held.
+        :return: None.
+        """
+        self.state_changed.notify_all()
+
+    def set_connected(self, connected):
+        """
+        Updates the connection state and wakes any thread waiting on it, called by the reading thread.
+        :param connected: bool: True if the Empatica E4 is connected
+        :return: None.
+        """
+        with self.state_changed:
+            self.connected = connected
+            self.notify_state_changed()
+
+    def set_subscribed(self, stream, subscribed):
+        """
+        Updates the subscription state of a stream and wakes any thread waiting on it, called by the reading thread.
+        :param stream: str: stream name
+        :param subscribed: bool: True if the stream is subscribed
+        :return: None.
+        """
+        with self.state_changed:
+            self.subscribed_streams[stream] = subscribed
+            self.notify_state_changed()
+
+    def confirm_subscription(self, stream):
+        """
+        Applies the requested subscription state of a stream once the Empatica Server acknowledges it.
+        :param stream: str: stream name
+        :return: None.
+        """
+        with self.state_changed:
+            self.subscribed_streams[stream] = self.pending_subscriptions.pop(
+                stream, not self.subscribed_streams.get(stream))
+            self.notify_state_changed()
+
+    def reject_subscription(self, stream, message):
+        """
+        Records the error the Empatica Server returned for a subscription request.
+        :param stream: str: stream name
+        :param message: str: error message
+        :return: None.
+        """
+        with self.state_changed:
+            self.pending_subscriptions.pop(stream, None)
+            self.subscription_errors[stream] = message
+            self.notify_state_changed()
+
+    def begin_subscriptions(self, streams, subscribe):
+        """
+        Marks the streams as waiting for a subscription acknowledgement and builds the pipelined command.
+        :param streams: list: bytes-like streams
+        :param subscribe: bool: True to subscribe, False to unsubscribe
+        :return: bytes-like: the device_subscribe commands for every stream.
+        """
+        state = b' ON\r\n' if subscribe else b' OFF\r\n'
+        with self.state_changed:
+            for stream in streams:
+                name = stream.decode("utf-8")
+                self.pending_subscriptions[name] = subscribe
+                self.subscription_errors.pop(name, None)
+        return b''.join(b'device_subscribe ' + stream + state for stream in streams)
+
+    def end_subscriptions(self, names):
+        """
+        Collects the result of a subscription request, streams still waiting are reported as timed out.
+        :param names: list: str stream names
+        :return: dict: error message for each stream that failed, empty on success.
+        """
+        failures = {}
+        with self.state_changed:
+            for name in names:
+                if name in self.subscription_errors:
+                    failures[name] = self.subscription_errors[name]
+                elif self.pending_subscriptions.pop(name, None) is not None:
+                    failures[name] = "No response from Empatica Server"
+        return failures
 
     @staticmethod
     def get_unix_timestamp(current_time=None):
@@ -297,111 +1241,151 @@ class EmpaticaE4:
         utc_time = dt.replace(tzinfo=timezone.utc)
         return utc_time.timestamp()
 
-    def start_window_timer(self):
+    def timestamp_range(self):
         """
-        Starts the window timer thread.
-        :return:
+        Device timestamps of the oldest and the newest sample stored over all streams.
+        :return: tuple: (first, last), None if no samples are stored.
         """
-        if self.window_size:
-            self.window_thread.start()
+        first = [timestamps[0] for timestamps, _ in self.stream_storage.values() if len(timestamps)]
+        if not first:
+            return None
+        return min(first), max(timestamps[-1] for timestamps, _ in self.stream_storage.values() if len(timestamps))
 
-    def timer_thread(self):
+    def window_range(self):
         """
-        Thread that will split window after window elapses.
-        :return:
+        Device timestamps the windows are saved by.
+        :return: tuple: (first, last, reached) the oldest and the newest sample stored over all streams and the
+        newest timestamp every subscribed continuous stream has reached, None if no samples are stored.
         """
-        if self.window_size:
-            while self.connected:
-                time.sleep(self.window_size - time.monotonic() % self.window_size)
-                self.split_window()
+        timestamp_range = self.timestamp_range()
+        if timestamp_range is None:
+            return None
+        subscribed = [stream for stream in EmpaticaDataStreams.CONTINUOUS_STREAMS
+                      if self.subscribed_streams.get(stream)]
+        # Devices that are not subscribed themselves, e.g. replays, wait for every continuous stream they hold
+        streams = [self.stream_storage[stream][0] for stream in subscribed or EmpaticaDataStreams.CONTINUOUS_STREAMS]
+        newest = [timestamps[-1] for timestamps in streams if len(timestamps)]
+        return timestamp_range + (min(newest) if newest else timestamp_range[1],)
 
-    def split_window(self):
+    def read_consistent(self, read, *args):
         """
-        Splits the current dataset into window and saves it to windowed_readings.
-        :return:
+        Calls a function that reads the storage until it runs without a sample being stored meanwhile, the
+        receiving thread is never blocked.
+        :param read: callable: reads the storage
+        :param args: arguments of read
+        :return: the result of read.
         """
-        # Save all the readings to our window
-        self.windowed_readings.append(
-            (self.acc_3d[-(32*3)*self.window_size:],
-             self.acc_x[-32*self.window_size:],
-             self.acc_y[-32*self.window_size:],
-             self.acc_z[-32*self.window_size:],
-             self.acc_timestamps[-32*self.window_size:],
-             self.bvp[-64*self.window_size:], self.bvp_timestamps[-64*self.window_size:],
-             self.gsr[-4*self.window_size:], self.gsr_timestamps[-4*self.window_size:],
-             self.tmp[-4*self.window_size:], self.tmp_timestamps[-4*self.window_size:],
-             self.tag, self.tag_timestamps,
-             self.ibi, self.ibi_timestamps,
-             self.bat, self.bat_timestamps,
-             self.hr, self.hr_timestamps)
-        )
-        # Clear all readings collected so far
-        self.tag, self.tag_timestamps = [], []
-        self.ibi, self.ibi_timestamps = [], []
-        self.bat, self.bat_timestamps = [], []
-        self.hr, self.hr_timestamps = [], []
+        while True:
+            sequence = self.sequence
+            if not sequence & 1:
+                try:
+                    result = read(*args)
+                except (IndexError, ValueError):
+                    # A read that overlapped a write can see the storage half updated
+                    if self.sequence == sequence:
+                        raise
+                    continue
+                if self.sequence == sequence:
+                    return result
+            # Gives the receiving thread the interpreter so it can finish its write
+            time.sleep(0)
 
-    def close(self):
+    def snapshot(self, seconds=None):
         """
-        Closes the socket connection.
-        :return: None.
+        Copies the samples of every stream at a single point in the received data.
+        :param seconds: float: only copy samples this many seconds older than the newest sample, default None copies
+        every stored sample
+        :return: tuple: sequence number of the snapshot, dict of stream name to a list of timestamps and a tuple with
+        a list of every value column.
         """
-        self.connected = False
-        self.client.close()
+        return self.read_consistent(self.copy_streams, seconds)
 
-    def send(self, command):
+    def copy_streams(self, seconds=None):
         """
-        Blocking method to send data to Empatica Server.
-        :param command: bytes-like: data to send
-        :return: None.
+        Copies the samples of every stream, call through snapshot to get a consistent copy.
+        :param seconds: float: only copy samples this many seconds older than the newest sample, default None
+        :return: tuple: sequence number and dict of stream name to timestamps and value columns.
         """
-        self.client.send(command)
+        sequence = self.sequence
+        timestamp_range = self.timestamp_range()
+        start = -math.inf if seconds is None or timestamp_range is None else timestamp_range[1] - seconds
+        streams = {}
+        for stream in self.stream_storage:
+            timestamps, columns = self.get_stream_window(stream, start, math.inf)
+            streams[stream] = timestamps.tolist(), tuple(column.tolist() for column in columns)
+        return sequence, streams
 
-    def receive(self):
+    def get_stream_window(self, stream, start, stop):
         """
-        Blocking method to receive data from Empatica Server.
-        :return: bytes-like: packet received.
+        Views of the samples of a stream with device timestamps from start up to stop, found by binary search.
+        :param stream: str: stream name
+        :param start: float: first device timestamp, inclusive
+        :param stop: float: last device timestamp, exclusive
+        :return: tuple: StreamView of the timestamps and a tuple with a StreamView of every value column.
         """
-        return self.client.recv()
+        timestamps, columns = self.stream_storage[stream]
+        low, high = window_bounds(timestamps, start, stop)
+        return StreamView(timestamps, low, high), tuple(StreamView(column, low, high) for column in columns)
 
-    def connect(self, device_name, timeout=5):
+    def get_window(self, start, stop):
         """
-        Sends the connect command packet to the Empatica Server.
-        :param timeout: int: seconds before EmpaticaServerConnectError raised
-        :param device_name: bytes-like: Empatica E4 to connect to
-        :return: None.
+        Views of the samples of every stream with device timestamps from start up to stop. RingBuffer storage
+        overwrites its oldest samples, so those samples are copied into arrays the window owns instead.
+        :param start: float: first device timestamp, inclusive
+        :param stop: float: last device timestamp, exclusive
+        :return: tuple: StreamViews of list storage and float64 arrays in the windowed_readings layout.
         """
-        command = b'device_connect ' + device_name + b'\r\n'
-        self.client.device = self
-        self.send(command)
-        start_time = time.time()
-        while not self.connected:
-            if time.time() - start_time > timeout:
-                raise EmpaticaServerConnectError(f"Could not connect to {device_name}!")
-            pass
+        acc_timestamps, (acc_x, acc_y, acc_z) = self.get_stream_window("acc", start, stop)
+        window = [StreamView(self.acc_3d, acc_timestamps.start * 3, acc_timestamps.stop * 3),
+                  acc_x, acc_y, acc_z, acc_timestamps]
+        for stream in ("bvp", "gsr", "tmp", "tag", "ibi", "bat", "hr"):
+            timestamps, (values,) = self.get_stream_window(stream, start, stop)
+            window += [values, timestamps]
+        return tuple(readings.copy() if isinstance(readings.storage, RingBuffer) else readings
+                     for readings in window)
 
-    def disconnect(self, timeout=5):
+    def split_window(self, final=False):
         """
-        Sends the disconnect command packet to the Empatica Server.
-        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        Saves every window that has elapsed in device time to windowed_readings, once every continuous stream has
+        passed its end or window_lateness has elapsed since.
+        Window starts are aligned to multiples of window_hop, so the windows of several devices line up.
+        :param final: bool: also save the window holding the newest samples even though it has not elapsed
         :return: None.
         """
-        command = b'device_disconnect\r\n'
-        self.send(command)
-        start_time = time.time()
-        while self.connected:
-            if time.time() - start_time > timeout:
-                raise EmpaticaServerConnectError(f"Could not disconnect from device!")
-            pass
-        self.client.stop_reading_thread()
+        window_range = self.read_consistent(self.window_range)
+        if window_range is None:
+            return
+        first, last, reached = window_range
+        hop = self.window_hop or self.window_size
+        if self.window_start is None:
+            self.window_start = first // hop * hop
+        while (self.window_start + self.window_size <= reached or
+               self.window_start + self.window_size + self.window_lateness <= last or
+               (final and self.window_start <= last)):
+            start, stop = self.window_start, self.window_start + self.window_size
+            window = self.read_consistent(self.get_window, start, stop)
+            self.windowed_readings.append(window)
+            self.window_times.append((start, stop))
+            for listener in self.window_listeners:
+                listener(window, start, stop)
+            self.window_start += hop
+            if stop > last:
+                break
 
     def save_readings(self, filename):
         """
-        Saves the readings currently collected to the specified filepath.
+        Saves the readings currently collected to the specified filepath, EmpaticaRecorder saves them while they are
+        received instead.
+        Windows are saved as a columnar archive read by EmpaticaWindowArchive if the filename ends with .npz, else
+        they are pickled. An existing file is replaced.
         :param filename: str: full path to file to save to
         :return: None.
         """
-        if self.windowed_readings:
+        if self.windowed_readings and filename.endswith(".npz"):
+            with EmpaticaWindowWriter(filename, append=False) as writer:
+                for window, (start, stop) in zip(self.windowed_readings, self.window_times):
+                    writer.append(window, start, stop)
+        elif self.windowed_readings:
             with open(filename, "wb") as file:
                 pickle.dump(self.windowed_readings, file)
         else:
@@ -460,17 +1444,139 @@ class EmpaticaE4:
 
     def clear_readings(self):
         """
-        Clears the readings collected.
+        Clears the readings collected, windows already saved are copied first since they view the storage.
+        Only the receiving thread writes the storage lock-free, so call this while streaming is suspended.
+        :return: None.
+        """
+        self.windowed_readings[:] = [tuple(readings.tolist() if isinstance(readings, StreamView) else readings
+                                           for readings in window) for window in self.windowed_readings]
+        self.window_start = None
+        for readings in (self.acc_3d, self.acc_x, self.acc_y, self.acc_z, self.acc_timestamps,
+                         self.bvp, self.bvp_timestamps, self.gsr, self.gsr_timestamps,
+                         self.tmp, self.tmp_timestamps, self.tag, self.tag_timestamps,
+                         self.ibi, self.ibi_timestamps, self.bat, self.bat_timestamps,
+                         self.hr, self.hr_timestamps):
+            readings.clear()
+
+
+class EmpaticaE4(EmpaticaDevice):
+    """
+    Class to wrap the client socket connection and configure the data streams.
+    """
+    def __init__(self, device_name, window_size=None, wrist_sensitivity=1, retention=None, client=None,
+                 wrist_threshold=0.0, wrist_hysteresis=0.0, shared_memory=False, timeout=5, window_hop=None,
+                 window_lateness=2.0):
+        """
+        Initializes the socket connection and connects the Empatica E4 specified.
+        :param device_name: str: The Empatica E4 to connect to
+        :param window_size: int: The size of windows in seconds, default None
+        :param wrist_sensitivity: int: The number of samples to determine if E4 is on wrist, default is one
+        :param retention: float: Seconds of samples kept per stream in fixed size ring buffers, default None keeps all
+        :param client: EmpaticaClient: connection to use, default None opens a new one
+        :param wrist_threshold: float: GSR at or below which a sample counts as off wrist, default zero
+        :param wrist_hysteresis: float: GSR above the threshold needed to count as back on wrist, default zero
+        :param shared_memory: bool: keep the ring buffers in shared memory that other processes attach to by device
+        name with EmpaticaSharedStreams, default False, needs retention
+        :param timeout: int: seconds to wait for the connection before EmpaticaServerConnectError is raised, default 5
+        :param window_hop: float: seconds between window starts, default None is window_size, a smaller hop gives
+        overlapping windows
+        :param window_lateness: float: seconds a continuous stream may lag behind the newest sample before its
+        windows are saved without its last samples, default 2
+        """
+        super().__init__(window_size, wrist_sensitivity, retention, wrist_threshold, wrist_hysteresis,
+                         device_name if shared_memory else None, window_hop, window_lateness)
+        self.device_name = device_name
+        self.window_thread = threading.Thread(target=self.timer_thread)
+        self.client = client if client else EmpaticaClient()
+        self.connect(device_name, timeout)
+        self.suspend_streaming()
+
+    def wait_for_state(self, predicate, timeout):
+        """
+        Blocks without spinning until the predicate is true or the timeout elapses.
+        :param predicate: callable: returns True once the expected state is reached
+        :param timeout: float: seconds to wait
+        :return: bool: the last value of the predicate.
+        """
+        with self.state_changed:
+            return self.state_changed.wait_for(predicate, timeout)
+
+    def start_window_timer(self):
+        """
+        Starts the window timer thread, windows of a managed client are split by its EmpaticaDeviceManager.
+        :return:
+        """
+        if self.window_size and not self.client.manager and not self.window_thread.is_alive():
+            # A thread starts once, so a device connected again gets a new one
+            if self.window_thread.ident is not None:
+                self.window_thread = threading.Thread(target=self.timer_thread)
+            self.window_thread.start()
+
+    def timer_thread(self):
+        """
+        Thread that will split window after window elapses.
+        :return:
+        """
+        if self.window_size:
+            while self.connected:
+                # Returns early if the device disconnects so the last window is split without delay
+                self.wait_for_state(lambda: not self.connected, self.window_hop - time.monotonic() % self.window_hop)
+                self.split_window(final=not self.connected)
+
+    def close(self):
+        """
+        Closes the socket connection, and moves the storage out of shared memory once the reading thread has stopped.
+        :return: None.
+        """
+        self.set_connected(False)
+        self.client.close()
+        if self.shared_memory is not None:
+            reading_thread = self.client.reading_thread
+            if reading_thread and reading_thread is not threading.current_thread():
+                reading_thread.join(1)
+            self.release_shared_memory()
+
+    def send(self, command):
+        """
+        Blocking method to send data to Empatica Server.
+        :param command: bytes-like: data to send
         :return: None.
         """
-        self.acc_3d[:], self.acc_x[:], self.acc_y[:], self.acc_z[:], self.acc_timestamps[:] = [], [], [], [], []
-        self.bvp[:], self.bvp_timestamps[:] = [], []
-        self.gsr[:], self.gsr_timestamps[:] = [], []
-        self.tmp[:], self.tmp_timestamps[:] = [], []
-        self.tag[:], self.tag_timestamps[:] = [], []
-        self.ibi[:], self.ibi_timestamps[:] = [], []
-        self.bat[:], self.bat_timestamps[:] = [], []
-        self.hr[:], self.hr_timestamps[:] = [], []
+        self.client.send(command)
+
+    def receive(self):
+        """
+        Blocking method to receive data from Empatica Server.
+        :return: bytes-like: packet received.
+        """
+        return self.client.recv()
+
+    def connect(self, device_name, timeout=5):
+        """
+        Sends the connect command packet to the Empatica Server.
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :param device_name: bytes-like: Empatica E4 to connect to
+        :return: None.
+        """
+        command = b'device_connect ' + device_name + b'\r\n'
+        self.client.device = self
+        if self.client.profiler:
+            self.enable_profiling(self.client.profiler)
+        self.send(command)
+        if not self.wait_for_state(lambda: self.connected, timeout):
+            raise EmpaticaServerConnectError(f"Could not connect to {device_name}!")
+
+    def disconnect(self, timeout=5):
+        """
+        Sends the disconnect command packet to the Empatica Server.
+        :param timeout: int: seconds before EmpaticaServerConnectError raised
+        :return: None.
+        """
+        command = b'device_disconnect\r\n'
+        self.send(command)
+        if not self.wait_for_state(lambda: not self.connected, timeout):
+            raise EmpaticaServerConnectError(f"Could not disconnect from device!")
+        self.client.stop_reading_thread()
 
     def subscribe_to_stream(self, stream, timeout=5):
         """
@@ -479,13 +1585,8 @@ class EmpaticaE4:
         :param stream: bytes-like: data to stream.
         :return: None.
         """
-        command = b'device_subscribe ' + stream + b' ON\r\n'
-        self.send(command)
-        start_time = time.time()
-        while not self.subscribed_streams.get(stream.decode("utf-8")):
-            if time.time() - start_time > timeout:
-                raise EmpaticaServerConnectError(f"Could not subscribe to {stream}!")
-            pass
+        if self.request_subscriptions([stream], True, timeout):
+            raise EmpaticaServerConnectError(f"Could not subscribe to {stream}!")
 
     def unsubscribe_from_stream(self, stream, timeout=5):
         """
@@ -494,13 +1595,39 @@ class EmpaticaE4:
         :param stream: bytes-like: data to stop streaming.
         :return: None.
         """
-        command = b'device_subscribe ' + stream + b' OFF\r\n'
-        self.send(command)
-        start_time = time.time()
-        while self.subscribed_streams.get(stream.decode("utf-8")):
-            if time.time() - start_time > timeout:
-                raise EmpaticaServerConnectError(f"Could not unsubscribe to {stream}!")
-            pass
+        if self.request_subscriptions([stream], False, timeout):
+            raise EmpaticaServerConnectError(f"Could not unsubscribe to {stream}!")
+
+    def subscribe_many(self, streams, timeout=5):
+        """
+        Subscribes to several data streams with a single send, blocks until the Empatica Server responds to all.
+        :param streams: list: bytes-like streams, e.g. EmpaticaDataStreams.ALL_STREAMS
+        :param timeout: int: seconds to wait for every response
+        :return: dict: error message for each stream that could not be subscribed, empty on success.
+        """
+        return self.request_subscriptions(streams, True, timeout)
+
+    def unsubscribe_many(self, streams, timeout=5):
+        """
+        Unsubscribes from several data streams with a single send, blocks until the Empatica Server responds to all.
+        :param streams: list: bytes-like streams, e.g. EmpaticaDataStreams.ALL_STREAMS
+        :param timeout: int: seconds to wait for every response
+        :return: dict: error message for each stream that could not be unsubscribed, empty on success.
+        """
+        return self.request_subscriptions(streams, False, timeout)
+
+    def request_subscriptions(self, streams, subscribe, timeout=5):
+        """
+        Pipelines the subscribe commands for the streams and waits for all the acknowledgements together.
+        :param streams: list: bytes-like streams
+        :param subscribe: bool: True to subscribe, False to unsubscribe
+        :param timeout: int: seconds to wait for every response
+        :return: dict: error message for each stream that failed, empty on success.
+        """
+        names = [stream.decode("utf-8") for stream in streams]
+        self.send(self.begin_subscriptions(streams, subscribe))
+        self.wait_for_state(lambda: not any(name in self.pending_subscriptions for name in names), timeout)
+        return self.end_subscriptions(names)
 
     def suspend_streaming(self):
         """
@@ -508,6 +1635,7 @@ class EmpaticaE4:
         :return: None.
         """
         command = b'pause ON\r\n'
+        self.streaming = False
         self.send(command)
 
     def start_streaming(self):
@@ -516,4 +1644,5 @@ class EmpaticaE4:
         :return: None.
         """
         command = b'pause OFF\r\n'
+        self.streaming = True
         self.send(command)
@@ -0,0 +1,228 @@
+import math
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from .empaticae4 import EmpaticaDataStreams, EmpaticaDevice
+from .ringbuffer import RingBuffer
+
+
+def stream_values(storage):
+    """
+    Values of a stream's storage that bisect and slicing work on without copying.
+    :param storage: RingBuffer, list or array: stream storage
+    :return: memoryview for RingBuffer storage, else the storage.
+    """
+    return storage.view() if isinstance(storage, RingBuffer) else storage
+
+
+class EmpaticaEventIndex:
+    """
+    Sorted index of the tag button presses of a device and of markers added by the application, kept for the whole
+    session rather than per window. Epochs of a stream around many events are cut out with one binary search of the
+    stream's timestamps per event and stacked into one array per value column.
+    """
+
+    def __init__(self, device=None, tags=True):
+        """
+        Initializes the index, indexing the device's tags as they are saved.
+        :param device: EmpaticaDevice: device whose storage epochs are cut from by default, default None
+        :param tags: bool: index the tags stored on the device and every tag saved from now on, default True
+        """
+        self.device = device
+        self.timestamps = array('d')
+        self.labels = []
+        self.lock = threading.Lock()
+        self.handle = None
+        if device is not None and tags:
+            for timestamp in device.read_consistent(lambda: list(stream_values(device.tag_timestamps))):
+                self.add(timestamp, "tag")
+            self.handle = device.on("tag", self.add_tag)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def close(self):
+        """
+        Stops indexing the device's tags.
+        :return: None.
+        """
+        if self.handle is not None:
+            self.device.off(self.handle)
+            self.handle = None
+
+    def add(self, timestamp, label):
+        """
+        Adds an event, events added out of order are inserted in place.
+        :param timestamp: float: device timestamp of the event
+        :param label: str: label of the event, tags are labeled "tag"
+        :return: None.
+        """
+        with self.lock:
+            timestamps = self.timestamps
+            if not timestamps or timestamp >= timestamps[-1]:
+                timestamps.append(timestamp)
+                self.labels.append(label)
+            else:
+                position = bisect_right(timestamps, timestamp)
+                timestamps.insert(position, timestamp)
+                self.labels.insert(position, label)
+
+    def add_tag(self, timestamp, values):
+        """
+        Callback that indexes a tag as it is saved.
+        :param timestamp: float: device timestamp of the tag
+        :param values: tuple: parsed values
+        :return: None.
+        """
+        self.add(timestamp, "tag")
+
+    def mark(self, label, timestamp=None):
+        """
+        Adds a marker from the application, e.g. a stimulus onset.
+        :param label: str: label of the marker
+        :param timestamp: float: device timestamp of the marker, default None is the current Unix time, which E4
+        timestamps are in
+        :return: float: timestamp of the marker.
+        """
+        if timestamp is None:
+            timestamp = EmpaticaDevice.get_unix_timestamp()
+        self.add(timestamp, label)
+        return timestamp
+
+    def find(self, start=None, stop=None, label=None):
+        """
+        Binary searches the events in a time range.
+        :param start: float: first device timestamp, inclusive, default None from the first event
+        :param stop: float: last device timestamp, exclusive, default None to the last event
+        :param label: str: only events with this label, default None every event
+        :return: list: (timestamp, label) events in time order.
+        """
+        with self.lock:
+            low = 0 if start is None else bisect_left(self.timestamps, start)
+            high = len(self.timestamps) if stop is None else bisect_left(self.timestamps, stop, low)
+            events = list(zip(self.timestamps[low:high], self.labels[low:high]))
+        if label is not None:
+            events = [event for event in events if event[1] == label]
+        return events
+
+    def resolve(self, events, label, start, stop):
+        """
+        Timestamps of the events epochs are cut around.
+        :param events: iterable: device timestamps, default None finds the indexed events
+        :param label: str: label of the indexed events
+        :param start: float: first device timestamp of the indexed events
+        :param stop: float: last device timestamp of the indexed events, exclusive
+        :return: array: event timestamps.
+        """
+        if events is None:
+            return array('d', [timestamp for timestamp, _ in self.find(start, stop, label)])
+        return array('d', events)
+
+    def read_storage(self, read, streams, *args):
+        """
+        Runs a read of stream storage, consistently with the receiving thread if it is the device's storage.
+        :param read: callable: takes the storage dict and args
+        :param streams: dict: stream name to timestamps and value columns, default None the device's storage
+        :return: the result of read.
+        """
+        if streams is None:
+            if self.device is None:
+                raise ValueError("EmpaticaEventIndex has no device to cut epochs from")
+            return self.device.read_consistent(read, self.device.stream_storage, *args)
+        return read(streams, *args)
+
+    def epochs(self, stream, pre, post, label=None, start=None, stop=None, events=None, streams=None):
+        """
+        Cuts the samples of a fixed rate stream from pre seconds before to post seconds after every event and
+        stacks them, an epoch per row. Epochs that are not fully stored, or hold a gap, are NaN.
+        :param stream: bytes-like or str: fixed rate stream, e.g. EmpaticaDataStreams.GSR
+        :param pre: float: seconds before the event
+        :param post: float: seconds after the event
+        :param label: str: only events with this label, default None every event
+        :param start: float: first device timestamp of the events, default None from the first event
+        :param stop: float: last device timestamp of the events, exclusive, default None to the last event
+        :param events: iterable: device timestamps to use instead of the indexed events, default None
+        :param streams: dict: stream name to timestamps and value columns to cut from, e.g. returned by
+        load_session or EmpaticaRecording, default None the device's storage
+        :return: tuple: array of event timestamps, array of the sample offsets from the event in seconds, a
+        float64 memoryview shaped (events, samples) per value column and a list of whether each epoch is complete.
+        """
+        stream = stream.decode("utf-8") if isinstance(stream, bytes) else stream
+        if stream in ("ibi", "tag"):
+            raise ValueError(f"{stream} is not a fixed rate stream, use segments")
+        rate = EmpaticaDataStreams.SAMPLE_RATES[stream]
+        count = int(round((pre + post) * rate))
+        offsets = array('d', [k / rate - pre for k in range(count)])
+        event_timestamps = self.resolve(events, label, start, stop)
+        columns, valid = self.read_storage(self.cut_epochs, streams, stream, event_timestamps, pre, rate, count)
+        if count and event_timestamps:
+            columns = tuple(memoryview(column).cast('B').cast('d', (len(event_timestamps), count))
+                            for column in columns)
+        else:
+            columns = tuple(memoryview(column) for column in columns)
+        return event_timestamps, offsets, columns, valid
+
+    @staticmethod
+    def cut_epochs(storage, stream, event_timestamps, pre, rate, count):
+        """
+        Copies the epochs of a stream into one flat array per value column.
+        :param storage: dict: stream name to timestamps and value columns
+        :param stream: str: stream name
+        :param event_timestamps: array: device timestamps of the events
+        :param pre: float: seconds before the event
+        :param rate: float: nominal sample rate of the stream
+        :param count: int: samples per epoch
+        :return: tuple: a tuple of arrays with the epochs of every value column, and a list of whether each epoch
+        is complete.
+        """
+        timestamps, value_columns = storage[stream]
+        timestamps = stream_values(timestamps)
+        value_columns = [stream_values(column) for column in value_columns]
+        columns = tuple(array('d') for _ in value_columns)
+        missing = array('d', [math.nan]) * count
+        # A complete epoch starts within a period of its start and spans its samples without a gap
+        period = 1 / rate
+        span = (count - 0.5) * period
+        valid = []
+        for event in event_timestamps:
+            first = event - pre
+            position = bisect_left(timestamps, first)
+            end = position + count
+            complete = (end <= len(timestamps) and count > 0 and timestamps[position] - first < period
+                        and timestamps[end - 1] - timestamps[position] < span)
+            valid.append(complete)
+            for column, values in zip(columns, value_columns):
+                column.extend(values[position:end] if complete else missing)
+        return columns, valid
+
+    def segments(self, stream, pre, post, label=None, start=None, stop=None, events=None, streams=None):
+        """
+        Copies the samples of any stream from pre seconds before to post seconds after every event, for streams
+        like IBI whose epochs differ in length.
+        :param stream: bytes-like or str: stream, e.g. EmpaticaDataStreams.IBI
+        :param pre: float: seconds before the event
+        :param post: float: seconds after the event
+        :param label: str: only events with this label, default None every event
+        :param start: float: first device timestamp of the events, default None from the first event
+        :param stop: float: last device timestamp of the events, exclusive, default None to the last event
+        :param events: iterable: device timestamps to use instead of the indexed events, default None
+        :param streams: dict: stream name to timestamps and value columns to cut from, default None the device's
+        storage
+        :return: list: per event, the event timestamp, an array of sample offsets from the event in seconds and a
+        tuple with an array of every value column.
+        """
+        stream = stream.decode("utf-8") if isinstance(stream, bytes) else stream
+        event_timestamps = self.resolve(events, label, start, stop)
+
+        def cut_segments(storage):
+            timestamps, value_columns = storage[stream]
+            timestamps = stream_values(timestamps)
+            value_columns = [stream_values(column) for column in value_columns]
+            segments = []
+            for event in event_timestamps:
+                low = bisect_left(timestamps, event - pre)
+                high = bisect_left(timestamps, event + post, low)
+                segments.append((event, array('d', [timestamp - event for timestamp in timestamps[low:high]]),
+                                 tuple(array('d', values[low:high]) for values in value_columns)))
+            return segments
+        return self.read_storage(cut_segments, streams)
@@ -0,0 +1,239 @@
+import math
+from array import array
+from operator import mul, sub
+from .windowing import WINDOW_FIELDS, window_bounds
+
+# Features computed for every window, NaN when the window has too few samples
+FEATURE_NAMES = ("gsr_mean", "gsr_std", "scr_peaks", "hr_mean", "hrv_rmssd", "hrv_sdnn", "acc_magnitude_mean",
+                 "acc_activity", "tmp_mean", "tmp_slope")
+# Signals whose statistics are accumulated over the whole session
+SESSION_SIGNALS = ("gsr", "tmp", "hr", "ibi", "acc_magnitude")
+# E4 accelerometer values are in 1/64 g
+ACC_SCALE = 1 / 64
+
+
+def finite_values(values):
+    """
+    Copies the values that are not NaN, gap filling stores NaN in place of lost samples.
+    :param values: iterable: floats
+    :return: array: float64 values.
+    """
+    return array('d', [value for value in values if value == value])
+
+
+def mean_std(values):
+    """
+    Mean and sample standard deviation, computed in two passes for accuracy.
+    :param values: array: floats
+    :return: tuple: mean and standard deviation, NaN if there are too few values.
+    """
+    count = len(values)
+    if not count:
+        return math.nan, math.nan
+    mean = math.fsum(values) / count
+    if count < 2:
+        return mean, math.nan
+    deviations = [value - mean for value in values]
+    return mean, math.sqrt(math.fsum(map(mul, deviations, deviations)) / (count - 1))
+
+
+def scr_peak_count(gsr, amplitude):
+    """
+    Counts skin conductance responses, peaks that rise at least the amplitude above the trough before them and
+    fall again. A rise still climbing at the end, e.g. a slow tonic drift, is not counted.
+    :param gsr: array: GSR values in microsiemens
+    :param amplitude: float: smallest rise counted as a response
+    :return: int.
+    """
+    peaks = 0
+    trough = peak = None
+    for value in gsr:
+        if trough is None or value < trough and peak is None:
+            trough = value
+        elif peak is None:
+            if value - trough >= amplitude:
+                peak = value
+        elif value > peak:
+            peak = value
+        elif value < peak:
+            peaks += 1
+            trough, peak = value, None
+    return peaks
+
+
+class RunningStats:
+    """
+    Count, mean and sum of squared deviations of a signal merged batch by batch (Welford and Chan's parallel
+    update), so adding a window costs the same however long the session has run.
+    """
+
+    def __init__(self):
+        """
+        Initializes empty statistics.
+        """
+        self.count = 0
+        self.mean = math.nan
+        self.m2 = 0.0
+
+    def add(self, values):
+        """
+        Merges a batch of values into the statistics.
+        :param values: array: floats
+        :return: None.
+        """
+        count = len(values)
+        if not count:
+            return
+        mean = math.fsum(values) / count
+        deviations = [value - mean for value in values]
+        m2 = math.fsum(map(mul, deviations, deviations))
+        if not self.count:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    @property
+    def std(self):
+        """
+        Sample standard deviation of every value added.
+        :return: float: NaN if fewer than two values were added.
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+    def __repr__(self):
+        return f"RunningStats(count={self.count}, mean={self.mean}, std={self.std})"
+
+
+class EmpaticaFeatureExtractor:
+    """
+    Computes physiological features from every window as split_window saves it: GSR mean and standard deviation
+    and skin conductance response count, mean HR, HRV RMSSD and SDNN in milliseconds from the IBI stream, mean ACC
+    magnitude and activity (mean absolute deviation of the magnitude) in g, and mean temperature and its slope in
+    degrees per second. Features are appended to one float64 array per feature in features, and running statistics
+    of the raw signals over the whole session are kept in session.
+    """
+
+    def __init__(self, device=None, scr_amplitude=0.01):
+        """
+        Initializes empty feature arrays and listens to the device's windows.
+        :param device: EmpaticaDevice: device whose windows are processed, default None only processes windows
+        passed to add_window
+        :param scr_amplitude: float: smallest GSR rise in microsiemens counted as a response, default 0.01
+        """
+        self.device = device
+        self.scr_amplitude = scr_amplitude
+        self.starts = array('d')
+        self.stops = array('d')
+        self.features = {name: array('d') for name in FEATURE_NAMES}
+        self.session = {signal: RunningStats() for signal in SESSION_SIGNALS}
+        self.listeners = []
+        self.session_stop = None
+        if device is not None:
+            device.window_listeners.append(self.add_window)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def close(self):
+        """
+        Stops processing the device's windows.
+        :return: None.
+        """
+        if self.device is not None and self.add_window in self.device.window_listeners:
+            self.device.window_listeners.remove(self.add_window)
+
+    def copy_window(self, window):
+        """
+        Copies the fields the features use out of the window's views of the storage.
+        :param window: tuple: window in WINDOW_FIELDS order
+        :return: dict: field name to float64 array.
+        """
+        fields = {}
+        for name in ("acc_x", "acc_y", "acc_z", "gsr", "gsr_timestamps", "tmp", "tmp_timestamps", "ibi",
+                     "ibi_timestamps", "hr", "hr_timestamps", "acc_timestamps"):
+            readings = window[WINDOW_FIELDS.index(name)]
+            values = readings.view() if hasattr(readings, "view") else readings
+            fields[name] = array('d', values)
+        return fields
+
+    def extract(self, window, start, stop):
+        """
+        Computes the features of a window.
+        :param window: tuple: window in WINDOW_FIELDS order
+        :param start: float: first device timestamp of the window
+        :param stop: float: device timestamp the window ends before
+        :return: dict: feature name to value and, under "session", the new samples of each signal.
+        """
+        if self.device is not None:
+            fields = self.device.read_consistent(self.copy_window, window)
+        else:
+            fields = self.copy_window(window)
+        gsr = finite_values(fields["gsr"])
+        gsr_mean, gsr_std = mean_std(gsr)
+        hr = finite_values(fields["hr"])
+        ibi = finite_values(fields["ibi"])
+        ibi_ms = array('d', [interval * 1000 for interval in ibi])
+        differences = list(map(sub, ibi_ms[1:], ibi_ms[:-1]))
+        rmssd = math.sqrt(math.fsum(map(mul, differences, differences)) / len(differences)) if differences else \
+            math.nan
+        magnitudes = finite_values([math.sqrt(x * x + y * y + z * z) * ACC_SCALE
+                                    for x, y, z in zip(fields["acc_x"], fields["acc_y"], fields["acc_z"])])
+        magnitude_mean = mean_std(magnitudes)[0]
+        activity = math.fsum([abs(m - magnitude_mean) for m in magnitudes]) / len(magnitudes) if magnitudes else \
+            math.nan
+        tmp_pairs = [(t, value) for t, value in zip(fields["tmp_timestamps"], fields["tmp"]) if value == value]
+        tmp = array('d', [value for _, value in tmp_pairs])
+        tmp_mean = mean_std(tmp)[0]
+        tmp_slope = math.nan
+        if len(tmp_pairs) > 1:
+            time_mean = math.fsum(t for t, _ in tmp_pairs) / len(tmp_pairs)
+            spread = math.fsum((t - time_mean) ** 2 for t, _ in tmp_pairs)
+            if spread:
+                tmp_slope = math.fsum((t - time_mean) * (value - tmp_mean) for t, value in tmp_pairs) / spread
+        features = {
+            "gsr_mean": gsr_mean,
+            "gsr_std": gsr_std,
+            "scr_peaks": float(scr_peak_count(gsr, self.scr_amplitude)) if len(gsr) else math.nan,
+            "hr_mean": mean_std(hr)[0],
+            "hrv_rmssd": rmssd,
+            "hrv_sdnn": mean_std(ibi_ms)[1],
+            "acc_magnitude_mean": magnitude_mean,
+            "acc_activity": activity,
+            "tmp_mean": tmp_mean,
+            "tmp_slope": tmp_slope
+        }
+        # Overlapping windows share samples, only those after the previous window are new to the session
+        fresh = self.session_stop if self.session_stop is not None and self.session_stop > start else start
+        signals = {"gsr": (fields["gsr_timestamps"], fields["gsr"]), "tmp": (fields["tmp_timestamps"], fields["tmp"]),
+                   "hr": (fields["hr_timestamps"], fields["hr"]), "ibi": (fields["ibi_timestamps"], fields["ibi"])}
+        features["session"] = {signal: finite_values(values[window_bounds(timestamps, fresh, stop)[0]:])
+                               for signal, (timestamps, values) in signals.items()}
+        new_acc = window_bounds(fields["acc_timestamps"], fresh, stop)[0]
+        features["session"]["acc_magnitude"] = finite_values(
+            [math.sqrt(x * x + y * y + z * z) * ACC_SCALE for x, y, z in
+             zip(fields["acc_x"][new_acc:], fields["acc_y"][new_acc:], fields["acc_z"][new_acc:])])
+        return features
+
+    def add_window(self, window, start, stop):
+        """
+        Window listener that computes a window's features, appends them to the feature arrays and updates the
+        session statistics, then calls every listener with the features and the window's start and stop.
+        :param window: tuple: window in WINDOW_FIELDS order
+        :param start: float: first device timestamp of the window
+        :param stop: float: device timestamp the window ends before
+        :return: None.
+        """
+        features = self.extract(window, start, stop)
+        for signal, values in features.pop("session").items():
+            self.session[signal].add(values)
+        self.session_stop = stop if self.session_stop is None else max(self.session_stop, stop)
+        self.starts.append(start)
+        self.stops.append(stop)
+        for name, value in features.items():
+            self.features[name].append(value)
+        for listener in self.listeners:
+            listener(features, start, stop)
@@ -0,0 +1,183 @@
+import math
+from array import array
+from collections import deque
+
+
+class GapDetector:
+    """
+    Checks the device timestamps of a fixed rate stream as they arrive for samples lost over BLE, and builds the
+    samples that fill a gap if filling is enabled.
+    """
+
+    def __init__(self, sample_rate, fill=None, tolerance=0.5, max_fill_seconds=10.0, max_gaps=100):
+        """
+        Initializes the counters.
+        :param sample_rate: float: nominal samples per second
+        :param fill: str: None only detects gaps, "nan" fills them with NaN and "linear" interpolates the values
+        :param tolerance: float: fraction of a period an interval may exceed the period before it is a gap
+        :param max_fill_seconds: float: longer gaps are counted but not filled, default 10
+        :param max_gaps: int: most recent gaps kept in gaps, default 100
+        """
+        if fill not in (None, "nan", "linear"):
+            raise ValueError("fill must be None, 'nan' or 'linear'")
+        self.period = 1 / sample_rate
+        self.fill = fill
+        self.limit = self.period * (1 + tolerance)
+        self.max_fill = int(max_fill_seconds * sample_rate)
+        self.first = None
+        self.last = None
+        self.last_values = None
+        self.received = 0
+        self.missing = 0
+        self.filled = 0
+        self.gap_count = 0
+        self.out_of_order = 0
+        # Set by mark_outage until the next interval, which spans an interruption of the connection
+        self.outage = False
+        # Start, end and missing samples of the most recent gaps
+        self.gaps = deque(maxlen=max_gaps)
+        # Sums of the deviation of the regular intervals from the period
+        self.jitter_count = 0
+        self.jitter_sum = 0.0
+        self.jitter_squares = 0.0
+        self.jitter_max = 0.0
+
+    def check(self, timestamp, values):
+        """
+        Checks the interval to the previous sample.
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values
+        :return: list: (timestamp, values) samples filling the gap before this sample, empty if there is none.
+        """
+        previous, previous_values = self.last, self.last_values
+        self.last, self.last_values = timestamp, values
+        self.received += 1
+        if previous is None:
+            self.first = timestamp
+            self.outage = False
+            return []
+        interval = timestamp - previous
+        if 0 < interval <= self.limit:
+            self.outage = False
+            deviation = interval - self.period
+            self.jitter_count += 1
+            self.jitter_sum += deviation
+            self.jitter_squares += deviation * deviation
+            if abs(deviation) > self.jitter_max:
+                self.jitter_max = abs(deviation)
+            return []
+        return self.handle_gap(previous, previous_values, timestamp, values)
+
+    def check_batch(self, timestamps, columns):
+        """
+        Checks the intervals of many samples of the stream.
+        :param timestamps: list or array: device timestamps
+        :param columns: list: one list or array of values per value in a data line
+        :return: tuple: timestamps and columns, new arrays with the filling samples inserted if any gap was filled.
+        """
+        if not len(timestamps):
+            return timestamps, columns
+        if self.last is None:
+            self.first, self.last, self.last_values = timestamps[0], timestamps[0], tuple(c[0] for c in columns)
+            self.received += 1
+            begin = 1
+        else:
+            begin = 0
+        stamps = array('d', (self.last,))
+        stamps.extend(timestamps[begin:])
+        intervals = [b - a for a, b in zip(stamps, stamps[1:])]
+        deviations = [interval - self.period for interval in intervals if 0 < interval <= self.limit]
+        if deviations:
+            self.jitter_count += len(deviations)
+            self.jitter_sum += sum(deviations)
+            self.jitter_squares += sum(deviation * deviation for deviation in deviations)
+            self.jitter_max = max(self.jitter_max, max(deviations), -min(deviations))
+        irregular = [begin + i for i, interval in enumerate(intervals) if not 0 < interval <= self.limit]
+        if not irregular or irregular[0]:
+            self.outage = False
+        self.received += len(intervals)
+        fills = []
+        for index in irregular:
+            previous_values = tuple(c[index - 1] for c in columns) if index else self.last_values
+            previous = timestamps[index - 1] if index else self.last
+            values = tuple(c[index] for c in columns)
+            samples = self.handle_gap(previous, previous_values, timestamps[index], values)
+            if samples:
+                fills.append((index, samples))
+        self.last, self.last_values = timestamps[-1], tuple(c[-1] for c in columns)
+        if not fills:
+            return timestamps, columns
+        filled_timestamps, filled_columns = array('d'), [array('d') for _ in columns]
+        start = 0
+        for index, samples in fills:
+            filled_timestamps.extend(timestamps[start:index])
+            filled_timestamps.extend(timestamp for timestamp, _ in samples)
+            for channel, (filled, column) in enumerate(zip(filled_columns, columns)):
+                filled.extend(column[start:index])
+                filled.extend(values[channel] for _, values in samples)
+            start = index
+        filled_timestamps.extend(timestamps[start:])
+        for filled, column in zip(filled_columns, columns):
+            filled.extend(column[start:])
+        return filled_timestamps, filled_columns
+
+    def mark_outage(self):
+        """
+        Marks an interruption of the connection, the gap up to the next sample is filled with NaN even if values are
+        interpolated, as nothing was received meanwhile.
+        :return: None.
+        """
+        self.outage = True
+
+    def handle_gap(self, previous, previous_values, timestamp, values):
+        """
+        Counts an interval longer than the tolerance or out of order, and builds the samples that fill it. A gap
+        over an outage is filled with NaN.
+        :param previous: float: timestamp of the sample before the gap
+        :param previous_values: tuple: values of the sample before the gap
+        :param timestamp: float: timestamp of the sample after the gap
+        :param values: tuple: values of the sample after the gap
+        :return: list: (timestamp, values) samples filling the gap, empty if it is not filled.
+        """
+        outage, self.outage = self.outage, False
+        interval = timestamp - previous
+        if interval <= 0:
+            self.out_of_order += 1
+            return []
+        missing = round(interval / self.period) - 1
+        if missing < 1:
+            return []
+        self.missing += missing
+        self.gap_count += 1
+        self.gaps.append((previous, timestamp, missing))
+        if not self.fill or missing > self.max_fill:
+            return []
+        self.filled += missing
+        step = interval / (missing + 1)
+        if self.fill == "nan" or outage:
+            nan = (math.nan,) * len(values)
+            return [(previous + step * k, nan) for k in range(1, missing + 1)]
+        return [(previous + step * k, tuple(a + (b - a) * k / (missing + 1) for a, b in zip(previous_values, values)))
+                for k in range(1, missing + 1)]
+
+    def stats(self):
+        """
+        Counts and jitter of the stream so far.
+        :return: dict: received, expected and missing samples, filled samples, gaps, recent gaps, out of order
+        samples and the mean, standard deviation and largest deviation of the regular intervals in seconds.
+        """
+        expected = round((self.last - self.first) / self.period) + 1 if self.first is not None else 0
+        mean = self.jitter_sum / self.jitter_count if self.jitter_count else 0.0
+        variance = self.jitter_squares / self.jitter_count - mean * mean if self.jitter_count else 0.0
+        return {
+            "received": self.received,
+            "expected": expected,
+            "missing": self.missing,
+            "filled": self.filled,
+            "gaps": self.gap_count,
+            "recent_gaps": list(self.gaps),
+            "out_of_order": self.out_of_order,
+            "jitter_mean": mean,
+            "jitter_std": math.sqrt(max(variance, 0.0)),
+            "jitter_max": self.jitter_max
+        }
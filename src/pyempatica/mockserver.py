@@ -0,0 +1,289 @@
+import math
+import socket
+import threading
+import time
+from .empaticae4 import EmpaticaDataStreams
+
+
+def synthetic_lines(start=None, duration=None):
+    """
+    Generates E4 data lines at the nominal stream rates in timestamp order: BVP at 64 Hz, ACC at 32 Hz, GSR and
+    temperature at 4 Hz, a heartbeat (IBI and HR) every 50 BVP samples, the battery level once a second and a tag
+    button press every ten seconds.
+    :param start: float: device timestamp of the first sample, default None is the current time
+    :param duration: float: seconds of samples, default None never ends
+    :return: generator of tuples: (timestamp, stream name, data line).
+    """
+    start = time.time() if start is None else start
+    i = 0
+    while duration is None or i < duration * 64:
+        timestamp = start + i / 64
+        yield timestamp, "bvp", b'E4_Bvp %.6f %.6f\n' % (timestamp, 50 * math.sin(i / 10))
+        if i % 2 == 0:
+            yield timestamp, "acc", b'E4_Acc %.6f %d %d %d\n' % (timestamp, i % 64 - 32, 1 - i % 3, 64)
+        if i % 16 == 0:
+            yield timestamp, "gsr", b'E4_Gsr %.6f %.6f\n' % (timestamp, 0.5 + 0.1 * math.sin(i / 640))
+            yield timestamp, "tmp", b'E4_Temperature %.6f %.2f\n' % (timestamp, 32 + math.sin(i / 6400))
+        if i % 50 == 0 and i:
+            yield timestamp, "ibi", b'E4_Ibi %.6f %.6f\n' % (timestamp, 50 / 64)
+            yield timestamp, "hr", b'E4_Hr %.6f %.6f\n' % (timestamp, 64 * 60 / 50)
+        if i % 64 == 0:
+            yield timestamp, "bat", b'E4_Battery %.6f %.2f\n' % (timestamp, 1 - i / 64 / 36000 % 1)
+        if i % 640 == 0 and i:
+            yield timestamp, "tag", b'E4_Tag %.6f 1\n' % timestamp
+        i += 1
+
+
+def recorded_lines(lines):
+    """
+    Prepares recorded E4 data lines for replay.
+    :param lines: iterable: bytes-like data lines in timestamp order, e.g. read from a capture of the Empatica Server
+    :return: generator of tuples: (timestamp, stream name, data line).
+    """
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) > 1 and tokens[0] in EmpaticaDataStreams.DATA_TAGS:
+            yield float(tokens[1]), EmpaticaDataStreams.DATA_TAGS[tokens[0]][0], b' '.join(tokens) + b'\n'
+
+
+class EmpaticaMockConnection:
+    """
+    State of one connection to the EmpaticaMockServer, every connection streams its own copy of the data.
+    """
+
+    def __init__(self, server, sock):
+        """
+        Initializes the connection state.
+        :param server: EmpaticaMockServer: server that accepted the connection
+        :param sock: socket: accepted socket
+        """
+        self.server = server
+        self.socket_conn = sock
+        self.send_lock = threading.Lock()
+        self.state_changed = threading.Condition()
+        self.device_name = None
+        self.paused = False
+        self.streams = set()
+        self.streaming_thread = None
+
+    def send(self, packet):
+        """
+        Sends a packet in full, replies and data are sent from different threads.
+        :param packet: bytes-like: data to send
+        :return: bool: False once the connection is closed.
+        """
+        try:
+            with self.send_lock:
+                self.socket_conn.sendall(packet)
+            return True
+        except OSError:
+            return False
+
+    def handle_commands(self):
+        """
+        Answers the commands of the client until it disconnects.
+        :return: None.
+        """
+        received = b''
+        while self.server.serving:
+            try:
+                data = self.socket_conn.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            received += data
+            *commands, received = received.split(b'\n')
+            for command in commands:
+                tokens = command.split()
+                if tokens:
+                    self.send(self.handle_command(tokens) + b'\r\n')
+        self.set_device(None)
+        self.socket_conn.close()
+
+    def handle_command(self, tokens):
+        """
+        Applies a command and builds the reply of the Empatica Server.
+        :param tokens: list: whitespace separated tokens of the command
+        :return: bytes: reply without the line ending.
+        """
+        command = tokens[0]
+        if command == b'device_list':
+            return b'R device_list %d' % len(self.server.devices) + b''.join(
+                b' | ' + device + b' Empatica_E4' for device in self.server.devices)
+        if command == b'device_connect':
+            if len(tokens) < 2 or tokens[1] not in self.server.devices:
+                return b'R device_connect ERR The device requested for connection is not available.'
+            self.set_device(tokens[1])
+            return b'R device_connect OK'
+        if command == b'device_disconnect':
+            if self.device_name is None:
+                return b'R device_disconnect ERR No connected device.'
+            self.set_device(None)
+            return b'R device_disconnect OK'
+        if command == b'device_subscribe':
+            if len(tokens) < 3 or tokens[1] not in EmpaticaDataStreams.ALL_STREAMS:
+                return b'R device_subscribe ' + b' '.join(tokens[1:2]) + b' ERR Wrong stream name.'
+            if self.device_name is None:
+                return b'R device_subscribe ' + tokens[1] + b' ERR You are not connected to any device'
+            with self.state_changed:
+                if tokens[2] == b'ON':
+                    self.streams.add(tokens[1].decode("utf-8"))
+                else:
+                    self.streams.discard(tokens[1].decode("utf-8"))
+                self.state_changed.notify_all()
+            return b'R device_subscribe ' + tokens[1] + b' OK'
+        if command == b'pause':
+            with self.state_changed:
+                self.paused = len(tokens) > 1 and tokens[1] == b'ON'
+                self.state_changed.notify_all()
+            return b'R pause ' + (b'ON' if self.paused else b'OFF')
+        return b'R ' + command + b' ERR Unknown command.'
+
+    def set_device(self, device_name):
+        """
+        Connects or disconnects the device, starting or stopping its data stream.
+        :param device_name: bytes-like: device to connect, None disconnects
+        :return: None.
+        """
+        with self.state_changed:
+            self.device_name = device_name
+            if device_name is None:
+                self.streams.clear()
+            self.state_changed.notify_all()
+        if device_name is not None and not self.streaming_thread:
+            self.streaming_thread = threading.Thread(target=self.handle_streaming, daemon=True)
+            self.streaming_thread.start()
+
+    def wait_for_streaming(self):
+        """
+        Blocks while the connection is paused or has no subscriptions.
+        :return: bool: False once the device disconnects or the server closes.
+        """
+        with self.state_changed:
+            self.state_changed.wait_for(lambda: self.device_name is None or not self.server.serving or (
+                self.streams and not self.paused), 0.1)
+            return self.device_name is not None and self.server.serving
+
+    def handle_streaming(self):
+        """
+        Sends the subscribed data lines at the server's speed while the device is connected.
+        Lines that fall due while streaming is paused are dropped, like the Empatica Server does.
+        :return: None.
+        """
+        lines = None
+        timestamp = start_time = start_timestamp = None
+        skipping = False
+        while (lines is None or timestamp is not None) and self.wait_for_streaming():
+            if self.paused or not self.streams:
+                skipping = lines is not None
+                continue
+            speed = self.server.speed
+            if lines is None:
+                # Synthetic timestamps start at the current time, so at real time speed they match the send time
+                lines = self.server.create_source()
+                timestamp, stream, line = next(lines, (None, None, None))
+                start_time, start_timestamp = time.monotonic(), timestamp
+            target = start_timestamp + (time.monotonic() - start_time) * speed if speed else math.inf
+            while skipping and speed and timestamp is not None and timestamp < target:
+                timestamp, stream, line = next(lines, (None, None, None))
+            skipping = False
+            chunk = []
+            streams = self.streams
+            while timestamp is not None and timestamp <= target and len(chunk) < self.server.chunk_lines:
+                if stream in streams or (stream == "hr" and "ibi" in streams):
+                    chunk.append(line)
+                timestamp, stream, line = next(lines, (None, None, None))
+            if chunk:
+                if not self.send(b''.join(chunk)):
+                    break
+                self.server.lines_sent += len(chunk)
+            elif speed:
+                time.sleep(self.server.tick)
+        self.streaming_thread = None
+
+
+class EmpaticaMockServer:
+    """
+    Local stand-in for the Empatica Streaming Server that replays synthetic or recorded data lines, so the clients
+    can be tested and benchmarked without an Empatica E4.
+    """
+
+    def __init__(self, host='127.0.0.1', port=28000, devices=(b'MOCK01',), speed=1.0, duration=None, lines=None,
+                 tick=0.002, chunk_lines=512):
+        """
+        Starts listening and accepting connections.
+        :param host: str: address to listen on, default the loopback address used by the clients
+        :param port: int: port to listen on, default the Empatica Server port
+        :param devices: tuple: bytes-like names of the devices listed and accepted
+        :param speed: float: device seconds streamed per second, default 1 is real time, None streams flat out
+        :param duration: float: seconds of synthetic samples per connection, default None never ends
+        :param lines: list: recorded data lines replayed instead of synthetic samples, default None
+        :param tick: float: seconds between checks for due lines when nothing is due, default 0.002
+        :param chunk_lines: int: most lines sent in one send, default 512
+        """
+        self.devices = [device.encode("utf-8") if isinstance(device, str) else device for device in devices]
+        self.speed = speed
+        self.duration = duration
+        self.lines = lines
+        self.tick = tick
+        self.chunk_lines = chunk_lines
+        self.lines_sent = 0
+        self.connections = []
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen()
+        self.serving = True
+        self.accept_thread = threading.Thread(target=self.handle_accept, daemon=True)
+        self.accept_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def create_source(self):
+        """
+        Creates the data lines streamed on one connection.
+        :return: generator of tuples: (timestamp, stream name, data line).
+        """
+        if self.lines is not None:
+            return recorded_lines(self.lines)
+        return synthetic_lines(duration=self.duration)
+
+    def handle_accept(self):
+        """
+        Accepts connections and answers each on its own thread.
+        :return: None.
+        """
+        while self.serving:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = EmpaticaMockConnection(self, sock)
+            self.connections.append(connection)
+            threading.Thread(target=connection.handle_commands, daemon=True).start()
+
+    def close(self):
+        """
+        Stops accepting connections and closes every open connection.
+        :return: None.
+        """
+        self.serving = False
+        try:
+            # Wakes the accepting thread, closing alone leaves it blocked and the port bound on Linux
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server_socket.close()
+        self.accept_thread.join()
+        for connection in self.connections:
+            try:
+                connection.socket_conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class StageProfiler:
+    """
+    Times the stages of the receive, parse and store pipeline. Every stage keeps its call count, total and
+    largest duration and its most recent durations for percentiles, and the calls can be kept as trace events in
+    the Chrome trace format read by chrome://tracing, Perfetto and speedscope.
+    Stages are timed by wrapping the functions that run them with timed, so nothing is timed until a client or
+    device installs the wrappers.
+    """
+
+    def __init__(self, max_samples=10000, trace_events=0):
+        """
+        Initializes empty timings.
+        :param max_samples: int: most recent durations kept per stage for percentiles, default 10000
+        :param trace_events: int: most recent calls kept as trace events, default 0 keeps none
+        """
+        self.max_samples = max_samples
+        self.stages = {}
+        self.trace = deque(maxlen=trace_events) if trace_events else None
+        self.origin = time.perf_counter_ns()
+
+    def record(self, stage, start, end):
+        """
+        Records a call of a stage.
+        :param stage: str: stage name
+        :param start: int: perf_counter_ns when the call started
+        :param end: int: perf_counter_ns when the call returned
+        :return: None.
+        """
+        timing = self.stages.get(stage)
+        if timing is None:
+            # Count, total and largest duration and the recent durations, in nanoseconds
+            timing = self.stages[stage] = [0, 0, 0, deque(maxlen=self.max_samples)]
+        duration = end - start
+        timing[0] += 1
+        timing[1] += duration
+        if duration > timing[2]:
+            timing[2] = duration
+        timing[3].append(duration)
+        if self.trace is not None:
+            self.trace.append((stage, start, duration, threading.get_ident()))
+
+    def timed(self, stage, function, per_stream=False):
+        """
+        Wraps a function so every call is recorded as a stage.
+        :param stage: str: stage name
+        :param function: callable: function to time
+        :param per_stream: bool: record the call under the stage name and the function's first argument, e.g.
+        "store_batch:bvp", default False
+        :return: callable: the wrapper, with the wrapped function in its wrapped attribute.
+        """
+        record = self.record
+        clock = time.perf_counter_ns
+        if per_stream:
+            def timed_stream(*args, **kwargs):
+                start = clock()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    record(stage + ":" + args[0], start, clock())
+            timed_stream.wrapped = function
+            return timed_stream
+
+        def timed_call(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(stage, start, clock())
+        timed_call.wrapped = function
+        return timed_call
+
+    def stats(self):
+        """
+        Timings of every stage in microseconds, percentiles are over the most recent calls.
+        :return: dict: stage name to count, total, mean, p50, p90, p99 and max.
+        """
+        stats = {}
+        for stage, (count, total, largest, durations) in list(self.stages.items()):
+            recent = sorted(durations)
+
+            def percentile(p):
+                return recent[min(int(len(recent) * p / 100), len(recent) - 1)] / 1000 if recent else 0.0
+            stats[stage] = {
+                "count": count,
+                "total": total / 1000,
+                "mean": total / count / 1000 if count else 0.0,
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": largest / 1000
+            }
+        return stats
+
+    def reset(self):
+        """
+        Discards every timing and trace event.
+        :return: None.
+        """
+        self.stages = {}
+        if self.trace is not None:
+            self.trace.clear()
+
+    def dump_trace(self, filename):
+        """
+        Writes the trace events as a Chrome trace JSON file, one complete event per call.
+        :param filename: str: full path to file to write
+        :return: None.
+        """
+        if self.trace is None:
+            raise ValueError("StageProfiler was created without trace_events")
+        pid = os.getpid()
+        events = [{"name": stage, "cat": stage.split(":")[0], "ph": "X", "ts": (start - self.origin) / 1000,
+                   "dur": duration / 1000, "pid": pid, "tid": thread}
+                  for stage, start, duration, thread in list(self.trace)]
+        with open(filename, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ns"}, file)
@@ -0,0 +1,287 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from .empaticae4 import EmpaticaDataStreams, EmpaticaDataError
+
+RECORDING_MAGIC = b'PYE4REC1'
+# Stream index, sample count, first and last device timestamp of a chunk
+CHUNK_HEADER = struct.Struct('<B3xIdd')
+
+
+class EmpaticaRecorder:
+    """
+    Appends the samples of an Empatica E4 to a binary file while they are received.
+    The file starts with a header naming the device and the rate and channel count of every stream, followed by
+    chunks that hold the float64 timestamps and then each float64 value column of one stream, in native byte order.
+    The E4 streams are recorded, and the device's derived streams, e.g. reduced streams, registered before the
+    recorder is created, samples of other streams are ignored. A write that fails, e.g. on a full disk, stops the
+    recording instead of raising in the thread that receives the data, write_errors counts them and last_error holds
+    the reason.
+    """
+
+    def __init__(self, filename, device, chunk_size=4096, flush_interval=1.0, fsync=False):
+        """
+        Creates the file, writes its header and starts recording the device's samples.
+        :param filename: str: full path to file to record to
+        :param device: EmpaticaDevice: device to record
+        :param chunk_size: int: buffered samples over all streams that trigger a write, default 4096
+        :param flush_interval: float: maximum seconds samples are buffered before they are written, default 1
+        :param fsync: bool: also ask the OS to commit every write to disk, default False
+        """
+        self.device = device
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        derived_streams = dict(device.derived_streams)
+        self.streams = list(EmpaticaDataStreams.SAMPLE_RATES) + list(derived_streams)
+        self.stream_index = {stream: index for index, stream in enumerate(self.streams)}
+        self.rates = dict(EmpaticaDataStreams.SAMPLE_RATES)
+        self.channels = {stream: channels for stream, channels in EmpaticaDataStreams.DATA_TAGS.values()}
+        for stream, (rate, channels) in derived_streams.items():
+            self.rates[stream], self.channels[stream] = rate, channels
+        self.pending = {stream: (array('d'), tuple(array('d') for _ in range(self.channels[stream])))
+                        for stream in self.streams}
+        self.pending_samples = 0
+        self.samples_written = 0
+        self.flush_deadline = time.monotonic() + flush_interval
+        self.recording = True
+        self.write_errors = 0
+        self.last_error = None
+        self.stopped = threading.Event()
+        device_id = getattr(device, "device_name", None)
+        header = json.dumps({
+            "device_id": device_id.decode("utf-8") if isinstance(device_id, bytes) else device_id,
+            "created": time.time(),
+            "byteorder": sys.byteorder,
+            "streams": {stream: {"rate": self.rates[stream], "channels": self.channels[stream]}
+                        for stream in self.streams}
+        }).encode("utf-8")
+        # Pads the header so the float64 data of every chunk is 8 byte aligned
+        header += b' ' * (-(len(RECORDING_MAGIC) + 4 + len(header)) % 8)
+        self.file = self.open_file(filename)
+        self.file.write(RECORDING_MAGIC + struct.pack('<I', len(header)) + header)
+        self.file.flush()
+        self.device.sample_listeners.append(self.record_sample)
+        self.flush_thread = threading.Thread(target=self.handle_flushing, daemon=True)
+        self.flush_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_file(self, filename):
+        """
+        Opens the file the header and chunks are written to.
+        :param filename: str: full path to file to record to
+        :return: binary file object.
+        """
+        return open(filename, "wb")
+
+    def record_sample(self, stream, timestamp, values):
+        """
+        Sample listener that buffers a sample and writes the buffered samples when a chunk is full or due.
+        :param stream: str: stream name
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values
+        :return: None.
+        """
+        with self.lock:
+            pending = self.pending.get(stream)
+            if pending is None or not self.recording:
+                return
+            timestamps, columns = pending
+            timestamps.append(timestamp)
+            for column, value in zip(columns, values):
+                column.append(value)
+            self.pending_samples += 1
+            if self.pending_samples >= self.chunk_size or time.monotonic() >= self.flush_deadline:
+                self.write_chunks()
+
+    def handle_flushing(self):
+        """
+        Thread that writes the buffered samples once they are due, so samples buffered before the streaming is
+        suspended are written without waiting for the next sample.
+        :return: None.
+        """
+        while not self.stopped.wait(self.flush_interval):
+            with self.lock:
+                if self.pending_samples and time.monotonic() >= self.flush_deadline:
+                    self.write_chunks()
+
+    def flush(self):
+        """
+        Writes every buffered sample to the file.
+        :return: None.
+        """
+        with self.lock:
+            self.write_chunks()
+
+    def write_chunks(self):
+        """
+        Writes one chunk per stream with buffered samples, the lock must be held.
+        :return: None.
+        """
+        if self.file.closed or not self.recording:
+            return
+        try:
+            for stream, (timestamps, columns) in self.pending.items():
+                if not timestamps:
+                    continue
+                self.file.write(CHUNK_HEADER.pack(self.stream_index[stream], len(timestamps), timestamps[0],
+                                                  timestamps[-1]))
+                for values in (timestamps,) + columns:
+                    self.file.write(values)
+                    del values[:]
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+        except OSError as e:
+            self.stop_recording(e)
+            return
+        self.samples_written += self.pending_samples
+        self.pending_samples = 0
+        self.flush_deadline = time.monotonic() + self.flush_interval
+
+    def stop_recording(self, error):
+        """
+        Stops recording after a failed write and drops the buffered samples, the lock must be held. A chunk the
+        write cut short is ignored by EmpaticaRecording.
+        :param error: OSError: the error of the write
+        :return: None.
+        """
+        self.recording = False
+        self.write_errors += 1
+        self.last_error = str(error)
+        for timestamps, columns in self.pending.values():
+            for values in (timestamps,) + columns:
+                del values[:]
+        self.pending_samples = 0
+
+    def close(self):
+        """
+        Stops recording, writes the buffered samples and closes the file.
+        :return: None.
+        """
+        self.stopped.set()
+        self.flush_thread.join()
+        if self.record_sample in self.device.sample_listeners:
+            self.device.sample_listeners.remove(self.record_sample)
+        with self.lock:
+            self.write_chunks()
+            try:
+                self.file.close()
+            except OSError as e:
+                self.write_errors += 1
+                self.last_error = str(e)
+
+
+class EmpaticaRecording:
+    """
+    Memory-maps a file written by EmpaticaRecorder and reads any time range of a stream without loading the file.
+    """
+
+    def __init__(self, filename):
+        """
+        Opens the file and indexes its chunks, a chunk cut short by a crash is ignored.
+        :param filename: str: full path to the recording
+        """
+        self.file = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise EmpaticaDataError(f"{filename} is empty")
+        if self.map[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            self.close()
+            raise EmpaticaDataError(f"{filename} is not an Empatica recording")
+        offset = len(RECORDING_MAGIC)
+        header_size = struct.unpack_from('<I', self.map, offset)[0]
+        offset += 4
+        self.header = json.loads(self.map[offset:offset + header_size].decode("utf-8"))
+        offset += header_size
+        if self.header["byteorder"] != sys.byteorder:
+            self.close()
+            raise EmpaticaDataError(f"{filename} was recorded with {self.header['byteorder']} endian floats")
+        self.device_id = self.header["device_id"]
+        self.streams = self.header["streams"]
+        names = list(self.streams)
+        # Offset and sample count of every chunk of a stream, with the last timestamps for binary search
+        self.chunks = {stream: [] for stream in names}
+        self.chunk_ends = {stream: [] for stream in names}
+        self.chunk_starts = {stream: [] for stream in names}
+        while offset + CHUNK_HEADER.size <= len(self.map):
+            index, count, first, last = CHUNK_HEADER.unpack_from(self.map, offset)
+            stream = names[index]
+            size = 8 * count * (1 + self.streams[stream]["channels"])
+            if offset + CHUNK_HEADER.size + size > len(self.map):
+                break
+            self.chunks[stream].append((offset + CHUNK_HEADER.size, count))
+            self.chunk_starts[stream].append(first)
+            self.chunk_ends[stream].append(last)
+            offset += CHUNK_HEADER.size + size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps and closes the file.
+        :return: None.
+        """
+        self.map.close()
+        self.file.close()
+
+    def samples(self, stream):
+        """
+        Number of samples of a stream in the recording.
+        :param stream: str: stream name
+        :return: int.
+        """
+        return sum(count for _, count in self.chunks[stream])
+
+    def time_range(self, stream):
+        """
+        Device timestamps of the first and last sample of a stream.
+        :param stream: str: stream name
+        :return: tuple: (first, last), None if the stream has no samples.
+        """
+        if not self.chunks[stream]:
+            return None
+        return self.chunk_starts[stream][0], self.chunk_ends[stream][-1]
+
+    def read(self, stream, start=None, stop=None):
+        """
+        Reads the samples of a stream with device timestamps from start up to stop, only the chunks overlapping the
+        range are touched.
+        :param stream: str: stream name
+        :param start: float: first device timestamp, inclusive, default None is the start of the recording
+        :param stop: float: last device timestamp, exclusive, default None is the end of the recording
+        :return: tuple: array of timestamps and a tuple with an array of every value column.
+        """
+        channels = self.streams[stream]["channels"]
+        timestamps, columns = array('d'), tuple(array('d') for _ in range(channels))
+        chunks = self.chunks[stream]
+        index = 0 if start is None else bisect_left(self.chunk_ends[stream], start)
+        for index in range(index, len(chunks)):
+            if stop is not None and self.chunk_starts[stream][index] >= stop:
+                break
+            offset, count = chunks[index]
+            with memoryview(self.map)[offset:offset + 8 * count * (1 + channels)] as data:
+                with data[:8 * count].cast('d') as chunk_timestamps:
+                    low = 0 if start is None else bisect_left(chunk_timestamps, start)
+                    high = count if stop is None else bisect_left(chunk_timestamps, stop, low)
+                for channel, values in enumerate((timestamps,) + columns):
+                    values.frombytes(data[8 * (channel * count + low):8 * (channel * count + high)])
+        return timestamps, columns
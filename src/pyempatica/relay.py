@@ -0,0 +1,337 @@
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from .empaticae4 import EmpaticaDevice, EmpaticaDataError, EmpaticaServerConnectError
+from .recorder import EmpaticaRecorder, RECORDING_MAGIC, CHUNK_HEADER
+
+
+def create_relay_socket(host, port, path):
+    """
+    Creates the socket a relay listens on or a subscriber connects with.
+    :param host: str: address of a TCP socket
+    :param port: int: port of a TCP socket
+    :param path: str: path of a Unix domain socket, used instead of the host and port if set
+    :return: tuple: socket and the address to bind or connect to.
+    """
+    if path is not None:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), path
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM), (host, port)
+
+
+class EmpaticaRelaySubscriber:
+    """
+    Connection of one subscriber to an EmpaticaRelay, sent from its own thread so a slow subscriber never blocks
+    the thread that receives from the Empatica Server.
+    """
+
+    def __init__(self, sock, header, max_backlog):
+        """
+        Starts the sending thread.
+        :param sock: socket: accepted socket
+        :param header: bytes: stream header sent before any chunk
+        :param max_backlog: int: most flushed batches waiting to be sent before the oldest is dropped
+        """
+        self.socket_conn = sock
+        self.outbox = deque([header])
+        self.max_backlog = max_backlog
+        self.dropped = 0
+        self.sending = True
+        self.ready = threading.Condition()
+        self.sending_thread = threading.Thread(target=self.handle_sending, daemon=True)
+        self.sending_thread.start()
+
+    def put(self, data):
+        """
+        Queues a batch of whole chunks, dropping the oldest batch (never the header) if the backlog is full.
+        :param data: bytes: chunks
+        :return: None.
+        """
+        with self.ready:
+            if len(self.outbox) > self.max_backlog:
+                del self.outbox[1 if self.outbox[0][:len(RECORDING_MAGIC)] == RECORDING_MAGIC else 0]
+                self.dropped += 1
+            self.outbox.append(data)
+            self.ready.notify()
+
+    def handle_sending(self):
+        """
+        Sends queued batches until the subscriber disconnects or the relay closes.
+        :return: None.
+        """
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.outbox or not self.sending)
+                if not self.outbox:
+                    break
+                data = self.outbox.popleft()
+            try:
+                self.socket_conn.sendall(data)
+            except OSError:
+                break
+        self.sending = False
+        self.socket_conn.close()
+
+    def close(self):
+        """
+        Sends what is queued and closes the connection.
+        :return: None.
+        """
+        with self.ready:
+            self.sending = False
+            self.ready.notify()
+
+
+class EmpaticaRelayOutput:
+    """
+    File-like fan-out the relay's recorder writes to, every flush is queued for each subscriber.
+    """
+
+    def __init__(self, max_backlog):
+        """
+        Initializes an output without subscribers.
+        :param max_backlog: int: most batches queued for a subscriber before its oldest is dropped
+        """
+        self.max_backlog = max_backlog
+        self.header = b''
+        self.batch = []
+        self.subscribers = []
+        self.closed = False
+
+    def write(self, data):
+        """
+        Collects data written by the recorder until it is flushed, the first write is the stream header.
+        :param data: bytes-like: header, chunk header or column
+        :return: None.
+        """
+        if not self.header:
+            self.header = bytes(data)
+        else:
+            self.batch.append(bytes(data))
+
+    def flush(self):
+        """
+        Queues every chunk written since the last flush for each subscriber.
+        :return: None.
+        """
+        if self.batch:
+            data = b''.join(self.batch)
+            self.batch = []
+            self.subscribers = [subscriber for subscriber in self.subscribers if subscriber.sending]
+            for subscriber in self.subscribers:
+                subscriber.put(data)
+
+    def add_subscriber(self, sock):
+        """
+        Starts sending the header and then every flushed chunk to a subscriber.
+        :param sock: socket: accepted socket
+        :return: None.
+        """
+        self.subscribers.append(EmpaticaRelaySubscriber(sock, self.header, self.max_backlog))
+
+    def close(self):
+        """
+        Disconnects every subscriber once its queued chunks are sent.
+        :return: None.
+        """
+        self.closed = True
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+
+class EmpaticaRelay(EmpaticaRecorder):
+    """
+    Republishes the samples an Empatica E4 client parses to any number of local subscribers, so several processes
+    share one connection to the Empatica Server and every line is parsed once. The samples are framed like an
+    EmpaticaRecorder file: subscribers receive the header and then chunks of float64 timestamps and value columns
+    from the moment they connect.
+    """
+
+    def __init__(self, device, host='127.0.0.1', port=28001, path=None, chunk_size=256, flush_interval=0.02,
+                 max_backlog=256):
+        """
+        Starts listening for subscribers and relaying the device's samples.
+        :param device: EmpaticaDevice: device whose samples are relayed
+        :param host: str: address to listen on, default the loopback address
+        :param port: int: port to listen on, default 28001
+        :param path: str: path of a Unix domain socket to listen on instead, default None
+        :param chunk_size: int: buffered samples over all streams that trigger a send, default 256
+        :param flush_interval: float: maximum seconds samples are buffered before they are sent, default 0.02
+        :param max_backlog: int: most batches queued for a subscriber before its oldest is dropped, default 256
+        """
+        self.max_backlog = max_backlog
+        self.path = path
+        self.server_socket, address = create_relay_socket(host, port, path)
+        if path is None:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(address)
+        self.server_socket.listen()
+        super().__init__(None, device, chunk_size, flush_interval)
+        self.accept_thread = threading.Thread(target=self.handle_accept, daemon=True)
+        self.accept_thread.start()
+
+    def open_file(self, filename):
+        """
+        Creates the fan-out to the subscribers in place of a file.
+        :param filename: None
+        :return: EmpaticaRelayOutput.
+        """
+        return EmpaticaRelayOutput(self.max_backlog)
+
+    def handle_accept(self):
+        """
+        Accepts subscribers, each is added between two writes so it starts on a chunk boundary.
+        :return: None.
+        """
+        while not self.file.closed:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                return
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.file.add_subscriber(sock)
+
+    def close(self):
+        """
+        Stops relaying, sends the buffered samples and disconnects every subscriber.
+        :return: None.
+        """
+        super().close()
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server_socket.close()
+        self.accept_thread.join()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    @property
+    def subscribers(self):
+        """
+        Connected subscribers.
+        :return: list: EmpaticaRelaySubscriber.
+        """
+        return [subscriber for subscriber in self.file.subscribers if subscriber.sending]
+
+    @property
+    def dropped(self):
+        """
+        Batches dropped for subscribers that fell behind.
+        :return: int.
+        """
+        return sum(subscriber.dropped for subscriber in self.file.subscribers)
+
+
+class EmpaticaRelayDevice(EmpaticaDevice):
+    """
+    Subscribes to an EmpaticaRelay and stores the relayed samples like an EmpaticaE4 stores the samples it parses,
+    with the same stream attributes, windows, listeners and callbacks. Derived streams of the relayed device, e.g.
+    reduced streams, are published to the listeners and callbacks without being stored.
+    """
+
+    def __init__(self, host='127.0.0.1', port=28001, path=None, window_size=None, wrist_sensitivity=1,
+                 retention=None, wrist_threshold=0.0, wrist_hysteresis=0.0, window_hop=None, window_lateness=2.0):
+        """
+        Connects to the relay and starts receiving.
+        :param host: str: address of the relay, default the loopback address
+        :param port: int: port of the relay, default 28001
+        :param path: str: path of the relay's Unix domain socket, used instead of the host and port if set
+        :param window_size: int: The size of windows in seconds, default None
+        :param wrist_sensitivity: int: The number of samples to determine if E4 is on wrist, default is one
+        :param retention: float: Seconds of samples kept per stream in fixed size ring buffers, default None keeps all
+        :param wrist_threshold: float: GSR at or below which a sample counts as off wrist, default zero
+        :param wrist_hysteresis: float: GSR above the threshold needed to count as back on wrist, default zero
+        :param window_hop: float: seconds between window starts, default None is window_size, a smaller hop gives
+        overlapping windows
+        :param window_lateness: float: seconds a continuous stream may lag behind the newest sample before its
+        windows are saved without its last samples, default 2
+        """
+        super().__init__(window_size, wrist_sensitivity, retention, wrist_threshold, wrist_hysteresis,
+                         window_hop=window_hop, window_lateness=window_lateness)
+        self.socket_conn, address = create_relay_socket(host, port, path)
+        try:
+            self.socket_conn.connect(address)
+        except OSError as e:
+            raise EmpaticaServerConnectError(e)
+        self.reader = self.socket_conn.makefile("rb")
+        magic = self.reader.read(len(RECORDING_MAGIC) + 4)
+        if magic[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            self.socket_conn.close()
+            raise EmpaticaDataError("Not an Empatica relay")
+        header = json.loads(self.reader.read(struct.unpack('<I', magic[len(RECORDING_MAGIC):])[0]).decode("utf-8"))
+        if header["byteorder"] != sys.byteorder:
+            self.socket_conn.close()
+            raise EmpaticaDataError(f"Relay sends {header['byteorder']} endian floats")
+        self.device_name = header["device_id"].encode("utf-8") if header["device_id"] else None
+        self.relay_streams = [(stream, info["channels"]) for stream, info in header["streams"].items()]
+        self.derived_streams = {stream: (info["rate"], info["channels"]) for stream, info in header["streams"].items()
+                                if stream not in self.stream_storage}
+        self.samples_received = 0
+        self.set_connected(True)
+        self.reading_thread = threading.Thread(target=self.handle_reading_receive, daemon=True)
+        self.reading_thread.start()
+        self.window_thread = threading.Thread(target=self.timer_thread, daemon=True)
+        if window_size:
+            self.window_thread.start()
+
+    def handle_reading_receive(self):
+        """
+        Stores every relayed chunk with store_batch until the relay disconnects.
+        :return: None.
+        """
+        try:
+            while True:
+                header = self.reader.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    break
+                index, count, _, _ = CHUNK_HEADER.unpack(header)
+                stream, channels = self.relay_streams[index]
+                data = self.reader.read(8 * count * (1 + channels))
+                if len(data) < 8 * count * (1 + channels):
+                    break
+                values = array('d')
+                values.frombytes(data)
+                columns = [values[channel * count:(channel + 1) * count] for channel in range(1, channels + 1)]
+                if stream in self.stream_storage:
+                    self.store_batch(stream, values[:count], columns)
+                else:
+                    for timestamp, sample in zip(values[:count], zip(*columns)):
+                        self.publish_sample(stream, timestamp, sample)
+                self.samples_received += count
+        except (OSError, ValueError):
+            pass
+        self.set_connected(False)
+
+    def timer_thread(self):
+        """
+        Thread that will split window after window elapses.
+        :return:
+        """
+        while self.connected:
+            with self.state_changed:
+                self.state_changed.wait_for(lambda: not self.connected,
+                                            self.window_hop - time.monotonic() % self.window_hop)
+            self.split_window(final=not self.connected)
+
+    def close(self):
+        """
+        Disconnects from the relay.
+        :return: None.
+        """
+        try:
+            self.socket_conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket_conn.close()
+        self.reading_thread.join()
@@ -0,0 +1,200 @@
+import pickle
+import time
+from array import array
+from bisect import bisect_left
+from .empaticae4 import EmpaticaProtocol, EmpaticaDataError
+from .windowing import WINDOW_FIELDS
+from .windowarchive import EmpaticaWindowArchive
+from .recorder import EmpaticaRecording, RECORDING_MAGIC
+from .sharedmemory import STREAM_FIELDS
+
+# Rows of the text file save_readings writes when there are no windows, the tag stream is not saved
+TEXT_DUMP_FIELDS = ("acc_3d", "acc_x", "acc_y", "acc_z", "acc_timestamps", "gsr", "gsr_timestamps", "bvp",
+                    "bvp_timestamps", "tmp", "tmp_timestamps", "hr", "hr_timestamps", "ibi", "ibi_timestamps", "bat",
+                    "bat_timestamps")
+
+
+def merge_windows(windows):
+    """
+    Joins the samples of saved windows into one run per stream, samples shared by overlapping windows are kept once.
+    :param windows: iterable: dicts of field name to values, in window order
+    :return: dict: stream name to an array of timestamps and a tuple with an array of every value column.
+    """
+    streams = {stream: (array('d'), tuple(array('d') for _ in columns))
+               for stream, (_, columns) in STREAM_FIELDS.items()}
+    for window in windows:
+        for stream, (timestamp_field, value_fields) in STREAM_FIELDS.items():
+            timestamps, columns = streams[stream]
+            window_timestamps = window[timestamp_field]
+            # Windows are in time order, so only samples after the newest one kept are new
+            new = bisect_left(window_timestamps, timestamps[-1]) if timestamps else 0
+            while new < len(window_timestamps) and timestamps and window_timestamps[new] <= timestamps[-1]:
+                new += 1
+            timestamps.extend(window_timestamps[new:])
+            for column, field in zip(columns, value_fields):
+                column.extend(window[field][new:])
+    return streams
+
+
+def load_session(filename):
+    """
+    Reads the samples of a session saved by EmpaticaRecorder, or by save_readings as pickled windows, a .npz window
+    archive or the text dump written when there are no windows.
+    :param filename: str: full path to the file
+    :return: dict: stream name to an array of timestamps and a tuple with an array of every value column.
+    """
+    with open(filename, "rb") as file:
+        magic = file.read(len(RECORDING_MAGIC))
+    if magic == RECORDING_MAGIC:
+        with EmpaticaRecording(filename) as recording:
+            return {stream: recording.read(stream) for stream in recording.streams}
+    if magic.startswith(b'PK'):
+        with EmpaticaWindowArchive(filename) as archive:
+            return merge_windows(archive[index] for index in range(len(archive)))
+    if magic.startswith(b'\x80'):
+        with open(filename, "rb") as file:
+            windows = pickle.load(file)
+        return merge_windows(dict(zip(WINDOW_FIELDS, window)) for window in windows)
+    with open(filename, "r") as file:
+        rows = [line.rstrip("\n").rstrip(",") for line in file]
+    if len(rows) < len(TEXT_DUMP_FIELDS):
+        raise EmpaticaDataError(f"{filename} is not a saved session")
+    fields = {field: array('d', map(float, row.split(","))) if row else array('d')
+              for field, row in zip(TEXT_DUMP_FIELDS, rows)}
+    fields["tag"], fields["tag_timestamps"] = array('d'), array('d')
+    return {stream: (fields[timestamp_field], tuple(fields[field] for field in value_fields))
+            for stream, (timestamp_field, value_fields) in STREAM_FIELDS.items()}
+
+
+def is_raw_capture(filename):
+    """
+    Checks if a file holds lines received from the Empatica Server rather than a saved session.
+    :param filename: str: full path to the file
+    :return: bool.
+    """
+    with open(filename, "rb") as file:
+        start = file.read(3)
+    return start in (b'E4_', b'R d', b'R p')
+
+
+class EmpaticaReplay(EmpaticaProtocol):
+    """
+    Feeds a recorded session through a device's parsing, storage and windowing, on simulated time instead of the
+    wall clock: windows are split as soon as the replayed device timestamps pass their end, so a session replays as
+    fast as it can be parsed, or paced at a multiple of real time, and gives the windows a live capture gives.
+    """
+
+    def __init__(self, device, source, speed=None, batch_parsing=True, chunk_lines=4096, chunk_seconds=1.0):
+        """
+        Prepares the replay.
+        :param device: EmpaticaDevice: device the samples are stored to, one that is not streaming live
+        :param source: str or iterable: file of raw Empatica Server lines or saved by EmpaticaRecorder or
+        save_readings, or an iterable of bytes-like raw lines
+        :param speed: float: device seconds replayed per second, default None replays as fast as possible
+        :param batch_parsing: bool: decode raw lines in bulk with handle_data_batch, default True
+        :param chunk_lines: int: raw lines handled between window splits, default 4096
+        :param chunk_seconds: float: device seconds of saved samples stored between window splits, default one
+        """
+        super().__init__()
+        self.device = device
+        self.source = source
+        self.speed = speed
+        self.batch_parsing = batch_parsing
+        self.chunk_lines = chunk_lines
+        self.chunk_seconds = chunk_seconds
+        self.clock = None
+        self.started = None
+        self.start_clock = None
+
+    def advance(self, clock):
+        """
+        Moves simulated time to a device timestamp, waiting for it at the replay speed, and splits the windows due.
+        :param clock: float: newest device timestamp replayed
+        :return: None.
+        """
+        if clock is None:
+            return
+        if self.start_clock is None:
+            self.started, self.start_clock = time.perf_counter(), clock
+        self.clock = clock
+        if self.speed:
+            delay = self.started + (clock - self.start_clock) / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if self.device.window_size:
+            self.device.split_window()
+
+    def replay_lines(self, lines):
+        """
+        Parses raw Empatica Server lines in chunks, through the same handlers as a live client.
+        :param lines: iterable: bytes-like lines
+        :return: None.
+        """
+        chunk = []
+        for line in lines:
+            line = bytes(line).strip()
+            if line:
+                chunk.append(line)
+            if len(chunk) >= self.chunk_lines:
+                self.handle_chunk(chunk)
+                chunk = []
+        self.handle_chunk(chunk)
+
+    def handle_chunk(self, lines):
+        """
+        Handles a chunk of raw lines and advances simulated time to the newest sample.
+        :param lines: list: bytes-like lines without line endings
+        :return: None.
+        """
+        if not lines:
+            return
+        data_lines = [line for line in lines if line.startswith(b'E4_')]
+        if self.batch_parsing:
+            self.handle_data_batch(data_lines)
+        else:
+            self.handle_data_lines(data_lines)
+        self.bytes_received += sum(map(len, lines))
+        timestamp_range = self.device.read_consistent(self.device.timestamp_range)
+        self.advance(timestamp_range[1] if timestamp_range else None)
+
+    def replay_samples(self, streams):
+        """
+        Stores saved samples in slices of device time, every stream up to the end of a slice before the next. Derived
+        streams of a recording are skipped, a downsampler on the device reduces the replayed samples again.
+        :param streams: dict: stream name to an array of timestamps and a tuple with an array of every value column
+        :return: None.
+        """
+        streams = {stream: samples for stream, samples in streams.items()
+                   if stream in self.device.stream_storage and len(samples[0])}
+        if not streams:
+            return
+        first = min(timestamps[0] for timestamps, _ in streams.values())
+        last = max(timestamps[-1] for timestamps, _ in streams.values())
+        positions = dict.fromkeys(streams, 0)
+        stop = first
+        while stop <= last:
+            stop += self.chunk_seconds
+            for stream, (timestamps, columns) in streams.items():
+                start, end = positions[stream], bisect_left(timestamps, stop, positions[stream])
+                if end > start:
+                    self.device.store_batch(stream, timestamps[start:end], [column[start:end] for column in columns])
+                    self.readings += end - start
+                    positions[stream] = end
+            self.advance(min(stop, last))
+
+    def run(self):
+        """
+        Replays the whole source, then saves the window holding the newest samples.
+        :return: EmpaticaDevice: the device holding the replayed samples and windows.
+        """
+        source = self.source
+        if isinstance(source, str) and not is_raw_capture(source):
+            self.replay_samples(load_session(source))
+        elif isinstance(source, str):
+            with open(source, "rb") as file:
+                self.replay_lines(file)
+        else:
+            self.replay_lines(source)
+        if self.device.window_size:
+            self.device.split_window(final=True)
+        return self.device
@@ -0,0 +1,136 @@
+from array import array
+
+
+class RingBuffer:
+    """
+    Fixed capacity float64 ring buffer with list-compatible access for bounded per-stream storage.
+    Every value is written into both halves of a buffer twice the capacity, so the newest samples are always
+    contiguous and can be viewed without copying.
+    """
+
+    def __init__(self, capacity, sample_rate=None):
+        """
+        Preallocates the buffer.
+        :param capacity: int: maximum number of values kept
+        :param sample_rate: float: nominal values per second, used by last_seconds, default None
+        """
+        if capacity < 1:
+            raise ValueError("RingBuffer capacity must be at least 1")
+        self.capacity = int(capacity)
+        self.sample_rate = sample_rate
+        self.buffer = array('d', bytes(16 * self.capacity))
+        self.index = 0
+        self.length = 0
+        self.total = 0
+
+    def append(self, value):
+        """
+        Appends a value, overwriting the oldest value once the buffer is full.
+        :param value: float: value to append
+        :return: None.
+        """
+        index = self.index
+        self.buffer[index] = value
+        self.buffer[index + self.capacity] = value
+        index += 1
+        self.index = 0 if index == self.capacity else index
+        if self.length < self.capacity:
+            self.length += 1
+        self.total += 1
+
+    def extend(self, values):
+        """
+        Appends every value in an iterable, copying in at most two contiguous blocks per half of the buffer.
+        :param values: iterable: values to append
+        :return: None.
+        """
+        if not isinstance(values, array) or values.typecode != 'd':
+            values = array('d', values)
+        count = len(values)
+        self.total += count
+        if count > self.capacity:
+            values = values[-self.capacity:]
+        written = len(values)
+        first = min(written, self.capacity - self.index)
+        for offset in (self.index, self.index + self.capacity):
+            self.buffer[offset:offset + first] = values[:first]
+        rest = written - first
+        if rest:
+            self.buffer[:rest] = values[first:]
+            self.buffer[self.capacity:self.capacity + rest] = values[first:]
+        self.index = (self.index + written) % self.capacity
+        self.length = min(self.length + written, self.capacity)
+
+    def clear(self):
+        """
+        Empties the buffer without releasing its memory.
+        :return: None.
+        """
+        self.index = 0
+        self.length = 0
+
+    def offset(self):
+        """
+        Position of the oldest value in the underlying buffer.
+        :return: int.
+        """
+        return self.index - self.length + self.capacity
+
+    def view(self, start=0, stop=None):
+        """
+        Zero-copy view of the values between two logical indices, oldest value is index 0.
+        :param start: int: first index, negative values count from the newest value
+        :param stop: int: index after the last value, default None is the newest value
+        :return: memoryview: float64 view into the buffer, only valid until the buffer is appended to.
+        """
+        start, stop, _ = slice(start, stop).indices(self.length)
+        stop = max(start, stop)
+        offset = self.offset()
+        return memoryview(self.buffer)[offset + start:offset + stop]
+
+    def last(self, count):
+        """
+        Zero-copy view of the newest values.
+        :param count: int: number of values
+        :return: memoryview.
+        """
+        return self.view(max(self.length - int(count), 0))
+
+    def last_seconds(self, seconds):
+        """
+        Zero-copy view of the values received in the last number of seconds, based on the nominal sample rate.
+        :param seconds: float: length of the view in seconds
+        :return: memoryview.
+        """
+        if not self.sample_rate:
+            raise ValueError("RingBuffer has no sample rate")
+        return self.last(seconds * self.sample_rate)
+
+    def tolist(self):
+        """
+        Copies the values into a list, oldest first.
+        :return: list.
+        """
+        return self.view().tolist()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __getitem__(self, item):
+        offset = self.offset()
+        if isinstance(item, slice):
+            indices = range(*item.indices(self.length))
+            if indices.step == 1:
+                return self.buffer[offset + indices.start:offset + max(indices.start, indices.stop)].tolist()
+            return [self.buffer[offset + i] for i in indices]
+        if item < 0:
+            item += self.length
+        if not 0 <= item < self.length:
+            raise IndexError("RingBuffer index out of range")
+        return self.buffer[offset + item]
+
+    def __repr__(self):
+        return "RingBuffer(" + str(self.tolist()) + ")"
@@ -0,0 +1,270 @@
+import os
+import time
+from array import array
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+from .ringbuffer import RingBuffer
+from .windowing import WINDOW_FIELDS
+
+# Sequence, write index, length, total values appended, capacity and the pid of the creating process's resource
+# tracker, then the sample rate as a float64
+HEADER_SIZE = 64
+SEQUENCE, INDEX, LENGTH, TOTAL, CAPACITY, TRACKER = range(6)
+# Timestamp storage and value storage fields of every stream, in the order of the values in a data line
+STREAM_FIELDS = {
+    "acc": ("acc_timestamps", ("acc_x", "acc_y", "acc_z")),
+    "bvp": ("bvp_timestamps", ("bvp",)),
+    "gsr": ("gsr_timestamps", ("gsr",)),
+    "tmp": ("tmp_timestamps", ("tmp",)),
+    "tag": ("tag_timestamps", ("tag",)),
+    "ibi": ("ibi_timestamps", ("ibi",)),
+    "bat": ("bat_timestamps", ("bat",)),
+    "hr": ("hr_timestamps", ("hr",))
+}
+
+
+def resource_tracker_pid():
+    """
+    Process id of the resource tracker that unlinks this process's shared memory blocks when it exits.
+    :return: int: pid, zero if there is no tracker, e.g. on Windows.
+    """
+    try:
+        return resource_tracker._resource_tracker._pid or 0
+    except AttributeError:
+        return 0
+
+
+def shared_memory_name(device_name, field):
+    """
+    Name of the shared memory block holding a storage field of a device.
+    :param device_name: bytes-like or str: device name
+    :param field: str: storage field in WINDOW_FIELDS
+    :return: str.
+    """
+    if isinstance(device_name, bytes):
+        device_name = device_name.decode("utf-8")
+    return "pye4_" + device_name + "_" + field
+
+
+class SharedRingBuffer(RingBuffer):
+    """
+    RingBuffer in a multiprocessing.shared_memory block that other processes attach to by name and read without
+    copying. A header before the values holds the write index, length and total with a sequence number that is odd
+    while a write is in progress, so readers detect reads that overlapped a write.
+    """
+
+    def __init__(self, name, capacity=None, sample_rate=None, create=True):
+        """
+        Creates or attaches to the shared memory block.
+        :param name: str: name of the block
+        :param capacity: int: maximum number of values kept, needed to create the block
+        :param sample_rate: float: nominal values per second, used by last_seconds, default None
+        :param create: bool: create the block, replacing a stale block of the same name, False attaches to it
+        """
+        if shared_memory is None:
+            raise RuntimeError("Shared memory buffers need Python 3.8 or newer")
+        self.owner = create
+        if create:
+            if capacity is None or capacity < 1:
+                raise ValueError("RingBuffer capacity must be at least 1")
+            size = HEADER_SIZE + 16 * int(capacity)
+            try:
+                self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a process that did not close its device
+                stale = shared_memory.SharedMemory(name)
+                stale.close()
+                stale.unlink()
+                self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+        else:
+            try:
+                self.memory = shared_memory.SharedMemory(name, track=False)
+            except TypeError:
+                # Before Python 3.13 attaching registers the block with this process's tracker, which would unlink
+                # it when this process exits, so the registration is dropped unless the creating process shares
+                # the tracker, e.g. a multiprocessing child, where it is the creator's own registration
+                self.memory = shared_memory.SharedMemory(name)
+                with self.memory.buf[:HEADER_SIZE - 8] as header, header.cast('q') as slots:
+                    shared_tracker = slots[TRACKER] == resource_tracker_pid()
+                if not shared_tracker:
+                    try:
+                        resource_tracker.unregister(self.memory._name, "shared_memory")
+                    except Exception:
+                        pass
+        self.name = name
+        self.header = self.memory.buf[:HEADER_SIZE - 8].cast('q')
+        self.rate = self.memory.buf[HEADER_SIZE - 8:HEADER_SIZE].cast('d')
+        if create:
+            self.header[SEQUENCE] = self.header[INDEX] = self.header[LENGTH] = self.header[TOTAL] = 0
+            self.header[CAPACITY] = int(capacity)
+            self.header[TRACKER] = resource_tracker_pid()
+            self.rate[0] = sample_rate or 0.0
+        self.capacity = self.header[CAPACITY]
+        self.sample_rate = self.rate[0] or None
+        self.buffer = self.memory.buf[HEADER_SIZE:HEADER_SIZE + 16 * self.capacity].cast('d')
+
+    @property
+    def index(self):
+        return self.header[INDEX]
+
+    @index.setter
+    def index(self, value):
+        self.header[INDEX] = value
+
+    @property
+    def length(self):
+        return self.header[LENGTH]
+
+    @length.setter
+    def length(self, value):
+        self.header[LENGTH] = value
+
+    @property
+    def total(self):
+        return self.header[TOTAL]
+
+    @total.setter
+    def total(self, value):
+        self.header[TOTAL] = value
+
+    @property
+    def sequence(self):
+        return self.header[SEQUENCE]
+
+    def append(self, value):
+        """
+        Appends a value, overwriting the oldest value once the buffer is full.
+        :param value: float: value to append
+        :return: None.
+        """
+        header = self.header
+        capacity = self.capacity
+        header[SEQUENCE] += 1
+        index = header[INDEX]
+        self.buffer[index] = value
+        self.buffer[index + capacity] = value
+        index += 1
+        header[INDEX] = 0 if index == capacity else index
+        if header[LENGTH] < capacity:
+            header[LENGTH] += 1
+        header[TOTAL] += 1
+        header[SEQUENCE] += 1
+
+    def extend(self, values):
+        """
+        Appends every value in an iterable.
+        :param values: iterable: values to append
+        :return: None.
+        """
+        self.header[SEQUENCE] += 1
+        try:
+            super().extend(values)
+        finally:
+            self.header[SEQUENCE] += 1
+
+    def clear(self):
+        """
+        Empties the buffer, the total is kept so attached readers see the values were dropped.
+        :return: None.
+        """
+        self.header[SEQUENCE] += 1
+        super().clear()
+        self.header[SEQUENCE] += 1
+
+    def read(self, count=None):
+        """
+        Copies the newest values, retrying reads that overlapped a write.
+        :param count: int: number of values, default None copies every value kept
+        :return: tuple: total values appended when the copy was taken and an array of the values, oldest first.
+        """
+        header = self.header
+        while True:
+            sequence = header[SEQUENCE]
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            total = header[TOTAL]
+            values = array('d')
+            with self.last(self.length if count is None else count) as view:
+                values.frombytes(view.cast('B'))
+            if header[SEQUENCE] == sequence:
+                return total, values
+
+    def close(self):
+        """
+        Releases this process's mapping of the block, the creating process also removes the block.
+        :return: None.
+        """
+        for view in (self.buffer, self.header, self.rate):
+            view.release()
+        self.memory.close()
+        if self.owner:
+            if os.name == "posix":
+                # A process sharing the tracker may have dropped the registration when it attached, unlink drops
+                # it again, registering is idempotent so the tracker always has one to drop
+                resource_tracker.register(self.memory._name, "shared_memory")
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class EmpaticaSharedStreams:
+    """
+    Attaches to the shared memory storage of an Empatica E4 created with shared_memory=True in another process.
+    Every storage field is a SharedRingBuffer attribute with the same name as on EmpaticaE4, e.g. bvp and
+    bvp_timestamps, whose views read the live buffers without copying while the other process keeps appending.
+    """
+
+    def __init__(self, device_name, fields=WINDOW_FIELDS):
+        """
+        Attaches to the device's buffers.
+        :param device_name: bytes-like or str: name of the device streamed by the other process
+        :param fields: tuple: storage fields to attach, default every field in WINDOW_FIELDS
+        """
+        self.device_name = device_name
+        self.buffers = {}
+        try:
+            for field in fields:
+                self.buffers[field] = SharedRingBuffer(shared_memory_name(device_name, field), create=False)
+                setattr(self, field, self.buffers[field])
+        except FileNotFoundError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, stream, seconds=None):
+        """
+        Copies the newest samples of a stream, with the timestamps and every value column cut to the same samples.
+        :param stream: str: stream name, e.g. "bvp"
+        :param seconds: float: seconds of samples at the nominal rate, default None copies every sample kept
+        :return: tuple: array of timestamps and a tuple with an array of every value column.
+        """
+        timestamp_field, value_fields = STREAM_FIELDS[stream]
+        buffers = [self.buffers[field] for field in (timestamp_field,) + value_fields]
+        count = None if seconds is None else int(seconds * buffers[0].sample_rate)
+        reads = [buffer.read(count) for buffer in buffers]
+        # The buffers are written one after another, so line them up on the samples every copy holds
+        end = min(total for total, _ in reads)
+        start = max(total - len(values) for total, values in reads)
+        if count is not None:
+            start = max(start, end - count)
+        start = min(start, end)
+        copies = [values[len(values) - (total - start):len(values) - (total - end)] for total, values in reads]
+        return copies[0], tuple(copies[1:])
+
+    def close(self):
+        """
+        Detaches from the device's buffers.
+        :return: None.
+        """
+        for buffer in self.buffers.values():
+            buffer.close()
+        self.buffers = {}
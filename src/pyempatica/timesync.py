@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import deque
+
+
+class EmpaticaClockSync:
+    """
+    Estimates how a device's timestamps map to host monotonic time as its samples arrive. Delivery only ever adds
+    delay, so the smallest difference between arrival time and device timestamp in every bucket of device time is
+    the best estimate of the offset then, and a least squares line through the recent minima gives the offset and
+    the drift of the device clock.
+    """
+
+    def __init__(self, device=None, bucket_seconds=5.0, history=60):
+        """
+        Initializes the estimate and listens to the device's samples.
+        :param device: EmpaticaDevice: device whose samples are timed, default None only uses observe
+        :param bucket_seconds: float: device seconds per minimum, default 5
+        :param history: int: most recent minima the offset and drift are fitted to, default 60
+        """
+        self.device = device
+        self.bucket_seconds = bucket_seconds
+        self.minima = deque(maxlen=history)
+        self.bucket_end = None
+        self.bucket_min = math.inf
+        self.bucket_time = None
+        self.offset = None
+        self.drift = 0.0
+        self.reference = 0.0
+        self.samples = 0
+        # Unix time at host monotonic time zero, for timestamps comparable with get_unix_timestamp
+        self.unix_offset = time.time() - time.monotonic()
+        if device is not None:
+            device.sample_listeners.append(self.add_sample)
+
+    def close(self):
+        """
+        Stops listening to the device's samples.
+        :return: None.
+        """
+        if self.device is not None and self.add_sample in self.device.sample_listeners:
+            self.device.sample_listeners.remove(self.add_sample)
+
+    def add_sample(self, stream, timestamp, values):
+        """
+        Sample listener that observes the sample's arrival time.
+        :param stream: str: stream name
+        :param timestamp: float: device timestamp
+        :param values: tuple: parsed values
+        :return: None.
+        """
+        self.observe(timestamp, time.monotonic())
+
+    def observe(self, device_time, host_time):
+        """
+        Adds a pair of device timestamp and host arrival time to the estimate.
+        :param device_time: float: device timestamp of a sample
+        :param host_time: float: time.monotonic() when the sample arrived
+        :return: None.
+        """
+        self.samples += 1
+        difference = host_time - device_time
+        if difference < self.bucket_min:
+            self.bucket_min, self.bucket_time = difference, device_time
+            if not self.minima:
+                # Until the first bucket closes the smallest difference so far is the estimate
+                self.offset, self.reference = difference, device_time
+        if self.bucket_end is None:
+            self.bucket_end = device_time + self.bucket_seconds
+        elif device_time >= self.bucket_end:
+            self.minima.append((self.bucket_time, self.bucket_min))
+            self.fit()
+            self.bucket_end = device_time + self.bucket_seconds
+            self.bucket_min, self.bucket_time = math.inf, None
+
+    def fit(self):
+        """
+        Fits the offset and drift to the recent minima.
+        :return: None.
+        """
+        count = len(self.minima)
+        reference = math.fsum(t for t, _ in self.minima) / count
+        offset = math.fsum(d for _, d in self.minima) / count
+        spread = math.fsum((t - reference) ** 2 for t, _ in self.minima)
+        drift = math.fsum((t - reference) * (d - offset) for t, d in self.minima) / spread if spread else 0.0
+        # The line runs through the mean of the minima, lowered so no minimum lies below it
+        offset = min(d - drift * (t - reference) for t, d in self.minima)
+        self.reference, self.offset, self.drift = reference, offset, drift
+
+    def to_host(self, device_time):
+        """
+        Maps a device timestamp to host monotonic time.
+        :param device_time: float: device timestamp
+        :return: float: time.monotonic() the sample was taken at, None before any sample has arrived.
+        """
+        if self.offset is None:
+            return None
+        return device_time + self.offset + self.drift * (device_time - self.reference)
+
+    def to_unix(self, device_time):
+        """
+        Maps a device timestamp to host Unix time.
+        :param device_time: float: device timestamp
+        :return: float: Unix time the sample was taken at, None before any sample has arrived.
+        """
+        host_time = self.to_host(device_time)
+        return None if host_time is None else host_time + self.unix_offset
+
+    def stats(self):
+        """
+        Current estimate.
+        :return: dict: offset in seconds at the reference device timestamp, drift in parts per million, samples
+        observed and minima fitted.
+        """
+        return {
+            "offset": self.offset,
+            "reference": self.reference,
+            "drift_ppm": self.drift * 1e6,
+            "samples": self.samples,
+            "minima": len(self.minima)
+        }
+
+
+class EmpaticaTimeline:
+    """
+    Merges the samples of several devices into one stream ordered by host monotonic time, aligning each device with
+    an EmpaticaClockSync. Samples wait in a heap until they are older than the lateness, so samples of every device
+    that were taken before them have arrived, then leave it in time order.
+    """
+
+    def __init__(self, devices, streams=None, lateness=0.25, max_pending=100000, bucket_seconds=5.0):
+        """
+        Starts listening to the devices' samples.
+        :param devices: list: EmpaticaDevice of every device to merge, its index identifies its samples
+        :param streams: tuple: stream names merged, default None merges every stream
+        :param lateness: float: seconds a sample is held for samples of other devices taken before it, default 0.25
+        :param max_pending: int: most samples held, the oldest leaves early once more are waiting, default 100000
+        :param bucket_seconds: float: device seconds per minimum of the clock estimates, default 5
+        """
+        self.devices = list(devices)
+        self.streams = None if streams is None else set(streams)
+        self.lateness = lateness
+        self.max_pending = max_pending
+        self.heap = []
+        self.counter = itertools.count()
+        self.ready = threading.Condition()
+        self.emitted_until = -math.inf
+        self.late_samples = 0
+        self.clocks = [EmpaticaClockSync(bucket_seconds=bucket_seconds) for _ in self.devices]
+        self.listeners = [self.create_listener(index) for index in range(len(self.devices))]
+        for device, listener in zip(self.devices, self.listeners):
+            device.sample_listeners.append(listener)
+
+    def create_listener(self, index):
+        """
+        Builds the sample listener of a device, which times the sample and adds it to the heap.
+        :param index: int: device index
+        :return: callable: sample listener.
+        """
+        clock = self.clocks[index]
+        streams = self.streams
+        heap = self.heap
+        counter = self.counter
+        ready = self.ready
+
+        def add_sample(stream, timestamp, values):
+            clock.observe(timestamp, time.monotonic())
+            if streams is not None and stream not in streams:
+                return
+            with ready:
+                heapq.heappush(heap, (clock.to_host(timestamp), next(counter), index, stream, timestamp, values))
+                if len(heap) == 1 or len(heap) > self.max_pending:
+                    ready.notify()
+        return add_sample
+
+    def close(self):
+        """
+        Stops listening to the devices' samples and wakes a blocked reader.
+        :return: None.
+        """
+        for device, listener in zip(self.devices, self.listeners):
+            if listener in device.sample_listeners:
+                device.sample_listeners.remove(listener)
+        with self.ready:
+            self.listeners = []
+            self.ready.notify_all()
+
+    def pop_due(self, flush=False):
+        """
+        Removes the samples that are due in time order, the lock must be held.
+        :param flush: bool: remove every held sample
+        :return: list: (host time, device index, stream, device timestamp, values) samples.
+        """
+        heap = self.heap
+        due = time.monotonic() - self.lateness
+        samples = []
+        while heap and (flush or heap[0][0] <= due or len(heap) > self.max_pending):
+            host_time, _, index, stream, timestamp, values = heapq.heappop(heap)
+            if host_time < self.emitted_until:
+                # Arrived after samples taken later were emitted, the lateness is too small for this delay
+                self.late_samples += 1
+            else:
+                self.emitted_until = host_time
+            samples.append((host_time, index, stream, timestamp, values))
+        return samples
+
+    def poll(self, flush=False):
+        """
+        Returns the samples that are due without blocking.
+        :param flush: bool: also return the samples still held, e.g. once the devices have stopped
+        :return: list: (host time, device index, stream, device timestamp, values) samples in time order.
+        """
+        with self.ready:
+            return self.pop_due(flush)
+
+    def samples(self, timeout=None):
+        """
+        Yields the merged samples as they fall due, until the timeline is closed.
+        :param timeout: float: most seconds to wait for a sample, default None waits until the timeline is closed
+        :return: generator of tuples: (host time, device index, stream, device timestamp, values).
+        """
+        while True:
+            with self.ready:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while True:
+                    samples = self.pop_due(not self.listeners)
+                    if samples or not self.listeners:
+                        break
+                    wait = self.heap[0][0] - time.monotonic() + self.lateness if self.heap else None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self.ready.wait(wait)
+            yield from samples
+            if not samples:
+                return
@@ -0,0 +1,137 @@
+import ast
+import struct
+import sys
+import zipfile
+from array import array
+from .windowing import WINDOW_FIELDS, StreamView
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_DESCR = '<f8' if sys.byteorder == "little" else '>f8'
+
+
+def npy_bytes(values, shape):
+    """
+    Encodes float64 values as a .npy file, so archives load with numpy.load as well as EmpaticaWindowArchive.
+    :param values: bytes-like: native float64 values
+    :param shape: tuple: array shape
+    :return: bytes.
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %s, }" % (NPY_DESCR, repr(shape))
+    # The header is padded with spaces and a newline so the data starts on a 64 byte boundary
+    header += ' ' * (-(len(NPY_MAGIC) + 2 + len(header) + 1) % 64) + '\n'
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header.encode("latin1") + bytes(values)
+
+
+def npy_values(data):
+    """
+    Decodes a float64 .npy file written by npy_bytes.
+    :param data: bytes: file contents
+    :return: array: flat float64 values in native byte order.
+    """
+    header_size = struct.unpack_from('<H', data, len(NPY_MAGIC))[0]
+    header = ast.literal_eval(data[len(NPY_MAGIC) + 2:len(NPY_MAGIC) + 2 + header_size].decode("latin1"))
+    values = array('d')
+    values.frombytes(data[len(NPY_MAGIC) + 2 + header_size:])
+    if header["descr"] != NPY_DESCR:
+        values.byteswap()
+    return values
+
+
+class EmpaticaWindowWriter:
+    """
+    Appends windows to a zip archive of .npy arrays named window_<index>/<field>, the layout of a numpy .npz file.
+    Opening an existing archive for appending continues its window numbering.
+    """
+
+    def __init__(self, filename, compression=zipfile.ZIP_STORED, append=True):
+        """
+        Opens the archive.
+        :param filename: str: full path to the archive, .npz lets numpy.load open it
+        :param compression: int: zipfile compression method, default ZIP_STORED keeps reads fast
+        :param append: bool: add to the windows of an existing archive, False replaces it, default True
+        """
+        self.archive = zipfile.ZipFile(filename, "a" if append else "w", compression)
+        self.windows = sum(1 for name in self.archive.namelist() if name.endswith("/bounds.npy"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, window, start=float("nan"), stop=float("nan")):
+        """
+        Writes a window as one array per stream field plus its bounds.
+        :param window: tuple: StreamViews or lists in the windowed_readings layout
+        :param start: float: first device timestamp of the window, default nan
+        :param stop: float: device timestamp after the window, default nan
+        :return: int: index of the window in the archive.
+        """
+        prefix = "window_%06d/" % self.windows
+        for field, values in zip(WINDOW_FIELDS, window):
+            values = values.view() if isinstance(values, StreamView) else values
+            if not isinstance(values, (memoryview, array)):
+                values = array('d', values)
+            shape = (len(values) // 3, 3) if field == "acc_3d" else (len(values),)
+            self.archive.writestr(prefix + field + ".npy", npy_bytes(values, shape))
+        self.archive.writestr(prefix + "bounds.npy", npy_bytes(array('d', (start, stop)), (2,)))
+        self.windows += 1
+        return self.windows - 1
+
+    def close(self):
+        """
+        Writes the archive directory and closes the file.
+        :return: None.
+        """
+        self.archive.close()
+
+
+class EmpaticaWindowArchive:
+    """
+    Lazily reads the windows of an archive written by EmpaticaWindowWriter, only the arrays requested are read.
+    """
+
+    def __init__(self, filename):
+        """
+        Opens the archive and reads its directory.
+        :param filename: str: full path to the archive
+        """
+        self.archive = zipfile.ZipFile(filename, "r")
+        self.windows = sorted(name[:-len("/bounds.npy")] for name in self.archive.namelist()
+                              if name.endswith("/bounds.npy"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, index):
+        return {field: self.read(index, field) for field in WINDOW_FIELDS}
+
+    def read(self, index, field):
+        """
+        Reads one array of a window.
+        :param index: int: window index, negative values count from the last window
+        :param field: str: name in WINDOW_FIELDS, e.g. "bvp" or "bvp_timestamps", acc_3d is interleaved x, y, z
+        :return: array: float64 values.
+        """
+        return npy_values(self.archive.read(self.windows[index] + "/" + field + ".npy"))
+
+    def bounds(self, index):
+        """
+        Device timestamps the window starts at and ends before.
+        :param index: int: window index
+        :return: tuple: (start, stop).
+        """
+        return tuple(npy_values(self.archive.read(self.windows[index] + "/bounds.npy")))
+
+    def close(self):
+        """
+        Closes the archive.
+        :return: None.
+        """
+        self.archive.close()
@@ -0,0 +1,119 @@
+from array import array
+from bisect import bisect_left
+from .ringbuffer import RingBuffer
+
+# Name of every stream field of a window, in the order of the windowed_readings tuples
+WINDOW_FIELDS = ("acc_3d", "acc_x", "acc_y", "acc_z", "acc_timestamps", "bvp", "bvp_timestamps", "gsr",
+                 "gsr_timestamps", "tmp", "tmp_timestamps", "tag", "tag_timestamps", "ibi", "ibi_timestamps", "bat",
+                 "bat_timestamps", "hr", "hr_timestamps")
+
+
+def stream_base(storage):
+    """
+    Number of values appended to a stream's storage before its oldest retained value.
+    :param storage: RingBuffer or list: stream storage
+    :return: int.
+    """
+    if isinstance(storage, RingBuffer):
+        return storage.total - storage.length
+    return 0
+
+
+def window_bounds(timestamps, start, stop):
+    """
+    Binary searches a stream's timestamps for the samples in a time range.
+    :param timestamps: RingBuffer or list: sorted device timestamps of a stream
+    :param start: float: first device timestamp of the range, inclusive
+    :param stop: float: last device timestamp of the range, exclusive
+    :return: tuple: positions of the first sample and the sample after the last, counted from the first sample
+    ever appended.
+    """
+    values = timestamps.view() if isinstance(timestamps, RingBuffer) else timestamps
+    low = bisect_left(values, start)
+    high = bisect_left(values, stop, low)
+    base = stream_base(timestamps)
+    return low + base, high + base
+
+
+class StreamView:
+    """
+    Read-only range of a stream's storage that references the storage instead of copying it.
+    Positions are counted from the first value ever appended, so a view stays valid while the storage grows and
+    raises IndexError once a RingBuffer has overwritten its values.
+    """
+
+    def __init__(self, storage, start, stop):
+        """
+        Initializes the view.
+        :param storage: RingBuffer or list: stream storage
+        :param start: int: position of the first value
+        :param stop: int: position after the last value
+        """
+        self.storage = storage
+        self.start = start
+        self.stop = stop
+
+    def view(self):
+        """
+        The values of the view, zero-copy for RingBuffer storage.
+        :return: memoryview for RingBuffer storage, else a list.
+        """
+        base = stream_base(self.storage)
+        if self.start < base:
+            raise IndexError("StreamView values were overwritten in the RingBuffer")
+        if isinstance(self.storage, RingBuffer):
+            return self.storage.view(self.start - base, self.stop - base)
+        return self.storage[self.start:self.stop]
+
+    def copy(self):
+        """
+        Copies the values into a float64 array of their own, which stays valid once the storage moves on.
+        :return: array.
+        """
+        values = array('d')
+        if isinstance(self.storage, RingBuffer):
+            with self.view() as view:
+                values.frombytes(view.cast('B'))
+        else:
+            values.extend(self.view())
+        return values
+
+    def tolist(self):
+        """
+        Copies the values into a list.
+        :return: list.
+        """
+        values = self.view()
+        return values if isinstance(values, list) else values.tolist()
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        if isinstance(self.storage, RingBuffer):
+            return iter(self.view())
+        return map(self.storage.__getitem__, range(self.start, self.stop))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.tolist()[item]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("StreamView index out of range")
+        if isinstance(self.storage, RingBuffer):
+            return self.view()[item]
+        return self.storage[self.start + item]
+
+    def __eq__(self, other):
+        try:
+            return self.tolist() == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __reduce__(self):
+        # Pickled as a plain list so saved windows do not depend on the live storage
+        return list, (self.tolist(),)
+
+    def __repr__(self):
+        return "StreamView(" + str(self.tolist()) + ")"
@@ -0,0 +1,81 @@
+from pyempatica import EmpaticaClient, EmpaticaE4, EmpaticaDataStreams, EmpaticaMockServer, synthetic_lines
+import threading
+import time
+
+DURATION = 1800
+CONSUMERS = 4
+# Seconds between the samples of the synthetic streams that arrive at a fixed rate
+PERIODS = {"bvp": 1 / 64, "acc": 2 / 64, "gsr": 16 / 64, "tmp": 16 / 64, "bat": 1}
+
+
+def check_stream(stream, timestamps, columns):
+    # Every column holds one value per timestamp and no sample is missing or repeated
+    assert all(len(column) == len(timestamps) for column in columns), stream
+    period = PERIODS.get(stream)
+    if period:
+        assert all(abs(b - a - period) < 1e-5 for a, b in zip(timestamps, timestamps[1:])), stream
+
+
+def consume(e4, results, stop):
+    snapshots, last_sequence = 0, -1
+    try:
+        while not stop.is_set():
+            sequence, streams = e4.snapshot(seconds=2)
+            assert sequence % 2 == 0 and sequence >= last_sequence
+            for stream, (timestamps, columns) in streams.items():
+                check_stream(stream, timestamps, columns)
+            # BVP is sent first at every timestamp, so a snapshot taken at one point in the data holds every other
+            # stream up to the newest BVP sample and no further
+            newest = streams["bvp"][0][-1] if streams["bvp"][0] else None
+            for stream, period in PERIODS.items():
+                if newest is not None and streams[stream][0]:
+                    assert newest - period - 1e-5 <= streams[stream][0][-1] <= newest + 1e-5, stream
+            last_sequence = sequence
+            snapshots += 1
+    except Exception as e:
+        results.append(e)
+    results.append(snapshots)
+
+
+def stress(name, batch_parsing=True, retention=None):
+    expected = {}
+    for _, stream, _ in synthetic_lines(0, DURATION):
+        expected[stream] = expected.get(stream, 0) + 1
+    with EmpaticaMockServer(speed=None, duration=DURATION):
+        client = EmpaticaClient(batch_parsing=batch_parsing)
+        e4 = EmpaticaE4(b'MOCK01', window_size=30, retention=retention, client=client, window_hop=30)
+        e4.subscribe_many(EmpaticaDataStreams.ALL_STREAMS)
+        stop, results = threading.Event(), []
+        consumers = [threading.Thread(target=consume, args=(e4, results, stop)) for _ in range(CONSUMERS)]
+        for consumer in consumers:
+            consumer.start()
+        start = time.perf_counter()
+        e4.start_streaming()
+        while client.readings < sum(expected.values()) and time.perf_counter() - start < 120:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for consumer in consumers:
+            consumer.join()
+        errors = [result for result in results if isinstance(result, Exception)]
+        assert not errors, f"inconsistent snapshot after {len(results) - len(errors)} snapshots: {errors[0]!r}"
+        e4.disconnect()
+        e4.close()
+    e4.split_window(final=True)
+    _, streams = e4.snapshot()
+    for stream, (timestamps, columns) in streams.items():
+        check_stream(stream, timestamps, columns)
+        if not retention:
+            assert len(timestamps) == expected.get(stream, 0), (stream, len(timestamps), expected.get(stream, 0))
+    assert e4.acc_3d[0::3] == e4.acc_x[:] and e4.acc_3d[2::3] == e4.acc_z[:]
+    if not retention:
+        # Windows that do not overlap hold every sample exactly once
+        windowed = [timestamp for window in e4.windowed_readings for timestamp in window[6]]
+        assert windowed == e4.bvp_timestamps, "windows lost or repeated samples"
+    print(f"{name:>24}: {client.readings} lines in {elapsed:.2f} s, {sum(results)} consistent snapshots by "
+          f"{CONSUMERS} threads, {len(e4.windowed_readings)} windows, no lost or repeated samples")
+
+
+stress("EmpaticaE4")
+stress("EmpaticaE4, line by line", batch_parsing=False)
+stress("EmpaticaE4, retention", retention=60)
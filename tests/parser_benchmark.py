@@ -0,0 +1,117 @@
+from pyempatica import EmpaticaProtocol, EmpaticaDevice
+import random
+import time
+
+
+class LegacyProtocol(EmpaticaProtocol):
+    def handle_data_stream(self, data):
+        # The if/elif parser used before the dispatch table, kept as the baseline. It does the same counting,
+        # storage, sequence, wrist and listener work as the dispatch handlers, so only the dispatch differs
+        try:
+            self.readings += 1
+            device = self.device
+            data_type = data[0][3:]
+            if data_type == b'Acc':
+                timestamp = float(data[1])
+                values = (float(data[2]), float(data[3]), float(data[4]))
+                device.sequence += 1
+                device.acc_timestamps.append(timestamp)
+                device.acc_x.append(values[0])
+                device.acc_y.append(values[1])
+                device.acc_z.append(values[2])
+                device.acc_3d.extend(values)
+                device.sequence += 1
+                stream = "acc"
+            elif data_type == b'Bvp':
+                timestamp = float(data[1])
+                values = (float(data[2]),)
+                device.sequence += 1
+                device.bvp_timestamps.append(timestamp)
+                device.bvp.append(values[0])
+                device.sequence += 1
+                stream = "bvp"
+            elif data_type == b'Gsr':
+                timestamp = float(data[1])
+                values = (float(data[2]),)
+                device.sequence += 1
+                device.gsr_timestamps.append(timestamp)
+                device.gsr.append(values[0])
+                device.sequence += 1
+                device.update_on_wrist(values[0], timestamp)
+                stream = "gsr"
+            elif data_type == b'Temperature':
+                timestamp = float(data[1])
+                values = (float(data[2]),)
+                device.sequence += 1
+                device.tmp_timestamps.append(timestamp)
+                device.tmp.append(values[0])
+                device.sequence += 1
+                stream = "tmp"
+            else:
+                self.malformed_lines += 1
+                self.record_error("EmpaticaDataError", data)
+                return
+            if device.sample_listeners:
+                device.publish_sample(stream, timestamp, values)
+        except Exception as e:
+            self.malformed_lines += 1
+            self.record_error("EmpaticaDataError", str(data) + str(e))
+
+
+def synthetic_lines(seconds):
+    lines = []
+    for i in range(seconds * 64):
+        timestamp = 1600000000 + i / 64
+        lines.append(b'E4_Bvp %.6f %.6f' % (timestamp, random.uniform(-100, 100)))
+        if i % 2 == 0:
+            lines.append(b'E4_Acc %.6f %d %d %d' % (timestamp, random.randint(-64, 64),
+                                                    random.randint(-64, 64), random.randint(-64, 64)))
+        if i % 16 == 0:
+            lines.append(b'E4_Gsr %.6f %.6f' % (timestamp, random.uniform(0.1, 2)))
+            lines.append(b'E4_Temperature %.6f %.2f' % (timestamp, random.uniform(30, 35)))
+    return lines
+
+
+def run(name, parse, lines, retention=None, repeats=15):
+    # Best of several runs on fresh storage, the first run also warms up the interpreter
+    rates = []
+    for _ in range(repeats):
+        device = EmpaticaDevice(retention=retention)
+        start = time.perf_counter()
+        parse(device, lines)
+        rates.append(len(lines) / (time.perf_counter() - start))
+    print(f"{name:>20}: {max(rates):12,.0f} lines/s")
+    return device
+
+
+def parse_legacy(device, lines):
+    protocol = LegacyProtocol()
+    protocol.device = device
+    for line in lines:
+        protocol.handle_data_stream(line.split())
+
+
+def parse_dispatch(device, lines):
+    protocol = EmpaticaProtocol()
+    protocol.device = device
+    for line in lines:
+        protocol.handle_data_stream(line.split())
+
+
+def parse_batch(device, lines):
+    protocol = EmpaticaProtocol()
+    protocol.device = device
+    for i in range(0, len(lines), 256):
+        protocol.handle_data_batch(lines[i:i + 256])
+
+
+lines = synthetic_lines(600)
+print(len(lines), "lines, 10 minutes of ACC, BVP, GSR and TMP")
+legacy_device = run("legacy", parse_legacy, lines)
+run("dispatch", parse_dispatch, lines)
+batch_device = run("batch", parse_batch, lines)
+assert batch_device.bvp == legacy_device.bvp and batch_device.acc_3d == legacy_device.acc_3d
+legacy_device = run("legacy, retention", parse_legacy, lines, retention=600)
+run("dispatch, retention", parse_dispatch, lines, retention=600)
+batch_device = run("batch, retention", parse_batch, lines, retention=600)
+assert batch_device.bvp[:] == legacy_device.bvp[:] and batch_device.acc_3d[:] == legacy_device.acc_3d[:]
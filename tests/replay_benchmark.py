@@ -0,0 +1,20 @@
+from pyempatica import EmpaticaDevice, EmpaticaReplay, synthetic_lines
+import time
+
+DURATION = 2 * 3600
+WINDOW = 30
+
+lines = [line for _, _, line in synthetic_lines(1.7e9, DURATION)]
+print(f"{DURATION / 3600:.0f} hour session, {len(lines)} lines, {WINDOW} s windows")
+reference = None
+for name, batch_parsing in (("batch parsing", True), ("line by line", False)):
+    device = EmpaticaDevice(window_size=WINDOW)
+    started = time.perf_counter()
+    EmpaticaReplay(device, lines, batch_parsing=batch_parsing).run()
+    elapsed = time.perf_counter() - started
+    windows = [[list(field) for field in window] for window in device.windowed_readings]
+    if reference is None:
+        reference = windows
+    assert windows == reference, "replays gave different windows"
+    print(f"{name:>16}: {elapsed:6.2f} s, {DURATION / elapsed:8.0f}x real time, {len(lines) / elapsed:12,.0f} lines/s, "
+          f"{len(windows)} windows")
@@ -0,0 +1,177 @@
+from pyempatica import (EmpaticaClockSync, EmpaticaDevice, EmpaticaEventIndex, EmpaticaFeatureExtractor,
+                        EmpaticaReplay, synthetic_lines)
+from pyempatica.downsampling import Decimator, Envelope
+from pyempatica.features import scr_peak_count
+from pyempatica.gaps import GapDetector
+from pyempatica.windowing import WINDOW_FIELDS
+from array import array
+import math
+import random
+
+
+def same(a, b, tolerance=1e-9):
+    return all(x == y or abs(x - y) <= tolerance or x != x and y != y for x, y in zip(a, b)) and len(a) == len(b)
+
+
+def gap_fill():
+    timestamps = [0.0, 0.25, 0.5, 1.25, 1.5]
+    values = [0.0, 1.0, 2.0, 5.0, 6.0]
+    for fill, expected in (("linear", [3.0, 4.0]), ("nan", [math.nan, math.nan])):
+        # Sample by sample and in one batch the two lost samples are filled the same
+        detector = GapDetector(4, fill)
+        filled = [sample for t, v in zip(timestamps, values) for sample in detector.check(t, (v,))]
+        assert same([t for t, _ in filled], [0.75, 1.0]) and same([v for _, (v,) in filled], expected), fill
+        filled_timestamps, (filled_values,) = GapDetector(4, fill).check_batch(array('d', timestamps),
+                                                                              [array('d', values)])
+        assert same(filled_timestamps, [0.0, 0.25, 0.5, 0.75, 1.0, 1.25, 1.5]), fill
+        assert same(filled_values, values[:3] + expected + values[3:]), fill
+        assert detector.stats()["missing"] == 2 and detector.stats()["expected"] == 7, fill
+    # Gaps longer than max_fill_seconds are counted but not filled
+    detector = GapDetector(4, "linear", max_fill_seconds=0.25)
+    assert [detector.check(t, (v,)) for t, v in zip(timestamps, values)][3] == []
+    assert detector.stats()["missing"] == 2 and detector.stats()["filled"] == 0
+    print("gap fill: linear and NaN values in place of lost samples, gaps too long to fill are only counted")
+
+
+def outage_fill():
+    timestamps = [0.0, 0.25, 0.5]
+    values = [0.0, 1.0, 2.0]
+    # A gap over a reconnect is never interpolated, an ordinary gap after it is
+    detector = GapDetector(4, "linear")
+    for t, v in zip(timestamps, values):
+        detector.check(t, (v,))
+    detector.mark_outage()
+    assert all(v != v for _, (v,) in detector.check(1.25, (5.0,)))
+    assert same([v for _, (v,) in detector.check(2.0, (8.0,))], [6.0, 7.0])
+    print("outages: the gap over a reconnect is filled with NaN even when interpolating")
+
+
+def heart_rate_variability():
+    intervals = [0.8, 0.9, 0.7, 0.8]
+    window = {field: [] for field in WINDOW_FIELDS}
+    window["ibi"], window["ibi_timestamps"] = intervals, [1.0, 1.9, 2.6, 3.4]
+    features = EmpaticaFeatureExtractor().extract(tuple(window[field] for field in WINDOW_FIELDS), 0.0, 5.0)
+    # Successive differences 100, -200 and 100 ms, deviations from the 800 ms mean 0, 100, -100 and 0 ms
+    assert abs(features["hrv_rmssd"] - math.sqrt(20000)) < 1e-9, features["hrv_rmssd"]
+    assert abs(features["hrv_sdnn"] - math.sqrt(20000 / 3)) < 1e-9, features["hrv_sdnn"]
+    # A slow tonic rise is not a response, a rise that falls again is
+    assert scr_peak_count([0.1 + 0.001 * i for i in range(240)], 0.01) == 0
+    assert scr_peak_count([0.1, 0.1, 0.15, 0.2, 0.18, 0.17, 0.17, 0.3], 0.01) == 1
+    print("features: RMSSD and SDNN of known intervals, skin conductance responses")
+
+
+def clock_offset():
+    rng = random.Random(1)
+    clock = EmpaticaClockSync()
+    offset, drift = -1.7e9 + 1000, 40e-6
+    start = 1.7e9
+    for i in range(64 * 600):
+        device_time = start + i / 64
+        # Delivery only ever adds delay, usually a few milliseconds, sometimes much more
+        delay = rng.expovariate(1 / 0.004) + (0.2 if rng.random() < 0.01 else 0)
+        clock.observe(device_time, device_time + offset + drift * (device_time - start) + delay)
+    for device_time in (start + 300, start + 590):
+        true_time = device_time + offset + drift * (device_time - start)
+        assert abs(clock.to_host(device_time) - true_time) < 0.001, (clock.to_host(device_time) - true_time)
+    assert abs(clock.drift - drift) < 5e-6, clock.drift
+    print(f"clock sync: offset within 1 ms, drift {clock.drift * 1e6:.1f} ppm of {drift * 1e6:.0f} ppm")
+
+
+def clock_alignment():
+    # Two devices whose clocks are 100 s apart and drift the other way map the same instant to the same host time
+    rng = random.Random(2)
+    clocks = [EmpaticaClockSync(), EmpaticaClockSync()]
+    skews = [(-1.7e9 + 1000, 30e-6), (-1.7e9 + 900, -30e-6)]
+    start = 1.7e9
+    for i in range(4 * 600):
+        host_time = 1000 + i / 4
+        for clock, (offset, drift) in zip(clocks, skews):
+            device_time = start + (host_time - start - offset) / (1 + drift)
+            clock.observe(device_time, host_time + rng.expovariate(1 / 0.004))
+    for host_time in (1300, 1590):
+        mapped = [clock.to_host(start + (host_time - start - offset) / (1 + drift))
+                  for clock, (offset, drift) in zip(clocks, skews)]
+        assert abs(mapped[0] - mapped[1]) < 0.002, mapped
+    print("clock sync: devices with different offsets and drifts are aligned within 2 ms")
+
+
+def decimator_response(frequency, rate=64, factor=8, seconds=60):
+    decimator = Decimator(factor)
+    timestamps = [i / rate for i in range(rate * seconds)]
+    output_timestamps, (outputs,) = decimator.process(timestamps, [[math.sin(2 * math.pi * frequency * t)
+                                                                    for t in timestamps]])
+    # The filter history fills during the first quarter
+    start = len(outputs) // 4
+    output_timestamps, outputs = output_timestamps[start:], outputs[start:]
+    amplitude = math.sqrt(2 * math.fsum(value * value for value in outputs) / len(outputs))
+    error = max(abs(value - amplitude * math.sin(2 * math.pi * frequency * t))
+                for t, value in zip(output_timestamps, outputs))
+    return amplitude, error
+
+
+def decimator():
+    # 64 Hz to 8 Hz: the output Nyquist frequency is 4 Hz and the cutoff 3.2 Hz
+    for frequency in (0.25, 0.5, 1.0):
+        amplitude, error = decimator_response(frequency)
+        assert abs(amplitude - 1) < 0.01, (frequency, amplitude)
+        # Outputs are timestamped at the middle of the filter, so the passband is not delayed
+        assert error < 0.01, (frequency, error)
+    for frequency in (5.0, 6.0, 7.0, 9.0, 15.0, 20.0):
+        amplitude, _ = decimator_response(frequency)
+        assert amplitude < 0.01, (frequency, amplitude)
+    # Blocks of any size decimate the same as one block
+    timestamps = [i / 64 for i in range(1000)]
+    values = [math.sin(i / 7) + (i % 5) for i in range(1000)]
+    whole = Decimator(8).process(timestamps, [values])
+    blocks, parts = Decimator(8), ([], [])
+    for start in range(0, 1000, 37):
+        part_timestamps, (part_values,) = blocks.process(timestamps[start:start + 37], [values[start:start + 37]])
+        parts[0].extend(part_timestamps)
+        parts[1].extend(part_values)
+    assert parts[0] == whole[0] and same(parts[1], whole[1][0], 1e-12)
+    print("decimator: passband within 1% and aliases attenuated more than 40 dB")
+
+
+def envelope():
+    # Runs of four samples reduce to their minimum and maximum, stamped with their first sample
+    reducer = Envelope(4)
+    values = [(-1) ** i * i for i in range(10)]
+    timestamps, (minimums, maximums) = reducer.process([i / 64 for i in range(10)], [values])
+    assert same(timestamps, [0, 4 / 64]) and minimums == [-3, -7] and maximums == [2, 6]
+    # The two samples that don't fill a run wait for the next block
+    timestamps, (minimums, maximums) = reducer.process([10 / 64, 11 / 64], [[10, -11]])
+    assert same(timestamps, [8 / 64]) and minimums == [-11] and maximums == [10]
+    print("envelope: minimum and maximum of every run, partial runs carried to the next block")
+
+
+def epochs():
+    # GSR at 4 Hz for 100 s, with the samples from 50 s to 52 s lost
+    timestamps = array('d', [i / 4 for i in range(400) if not 200 <= i < 208])
+    values = array('d', [t * 10 for t in timestamps])
+    index = EmpaticaEventIndex()
+    events, offsets, (columns,), valid = index.epochs("gsr", 1, 2, events=[10, 51, 0.5, 99.5],
+                                                      streams={"gsr": (timestamps, (values,))})
+    assert valid == [True, False, False, False], valid
+    assert same(offsets, [k / 4 - 1 for k in range(12)])
+    rows = columns.tolist()
+    assert same(rows[0], [(9 + k / 4) * 10 for k in range(12)])
+    assert all(all(value != value for value in row) for row in rows[1:])
+    # Tags of the mock data are indexed as they are saved and cut the same epochs
+    device = EmpaticaDevice()
+    index = EmpaticaEventIndex(device)
+    EmpaticaReplay(device, [line for _, _, line in synthetic_lines(1.7e9, 60)]).run()
+    tags = [timestamp for timestamp, _ in index.find(label="tag")]
+    assert same(tags, [1.7e9 + 10 * k for k in range(1, 6)], 1e-6), tags
+    _, _, (gsr,), valid = index.epochs("gsr", 2, 5)
+    assert valid == [True] * 5 and len(gsr.tolist()[0]) == 28, valid
+    print("epochs: complete epochs hold their samples, epochs over a gap or past the data are NaN")
+
+
+gap_fill()
+outage_fill()
+heart_rate_variability()
+clock_offset()
+clock_alignment()
+decimator()
+envelope()
+epochs()
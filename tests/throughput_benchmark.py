@@ -0,0 +1,95 @@
+from pyempatica import EmpaticaClient, EmpaticaE4, EmpaticaDataStreams, synthetic_lines
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DURATION = 600
+PORT = 28000
+# Client settings of every configuration, each is measured in a process of its own
+CONFIGURATIONS = {
+    "EmpaticaE4": {},
+    "EmpaticaE4, line by line": {"batch_parsing": False},
+    "EmpaticaE4, retention": {"retention": DURATION},
+    "line by line, retention": {"batch_parsing": False, "retention": DURATION}
+}
+
+
+def start_server(speed, duration=None):
+    # The server runs in its own process so its CPU time is not counted against the client
+    code = ("from pyempatica import EmpaticaMockServer\n"
+            f"server = EmpaticaMockServer(port={PORT}, speed={speed}, duration={duration})\n"
+            "print('listening', flush=True)\n"
+            "server.accept_thread.join()\n")
+    server = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+    server.stdout.readline()
+    return server
+
+
+def peak_memory():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    divisor = 1024 if sys.platform != "darwin" else 1024 * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+
+
+def throughput(name, batch_parsing=True, retention=None):
+    expected = sum(1 for _ in synthetic_lines(0, DURATION))
+    server = start_server(None, DURATION)
+    # ru_maxrss never goes down, so the growth over the memory in use before connecting is the client's own
+    start_memory = peak_memory()
+    try:
+        client = EmpaticaClient(batch_parsing=batch_parsing)
+        e4 = EmpaticaE4(b'MOCK01', retention=retention, client=client)
+        e4.subscribe_many(EmpaticaDataStreams.ALL_STREAMS)
+        wall, cpu = time.perf_counter(), time.process_time()
+        e4.start_streaming()
+        while client.readings < expected and time.perf_counter() - wall < 60:
+            time.sleep(0.005)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        memory = "n/a" if start_memory is None else (f"{peak_memory():.1f} MB, "
+                                                      f"{peak_memory() - start_memory:+.1f} MB while streaming")
+        print(f"{name:>24}: {client.readings / wall:12,.0f} lines/s, {cpu / wall:6.1%} CPU, "
+              f"{cpu / client.readings * 1e6:5.2f} us CPU/line, peak RSS {memory}")
+        if client.readings != expected:
+            print(f"{'':>24}  received {client.readings} of {expected} lines")
+        e4.disconnect()
+        e4.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def latency(seconds=10):
+    server = start_server(1)
+    try:
+        e4 = EmpaticaE4(b'MOCK01')
+        latencies = []
+        # Synthetic timestamps are the time the mock server schedules each sample at real time speed
+        e4.sample_listeners.append(lambda stream, timestamp, values: latencies.append(time.time() - timestamp))
+        e4.subscribe_many(EmpaticaDataStreams.ALL_STREAMS)
+        e4.start_streaming()
+        time.sleep(seconds)
+        e4.disconnect()
+        e4.close()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    percentiles = ", ".join(f"p{p} {latencies[int(len(latencies) * p / 100)] * 1000:.2f} ms" for p in (50, 95, 99))
+    print(f"{'latency':>24}: {len(latencies)} samples, {percentiles}, max {latencies[-1] * 1000:.2f} ms")
+
+
+if len(sys.argv) > 1:
+    throughput(sys.argv[1], **CONFIGURATIONS[sys.argv[1]])
+else:
+    print(DURATION, "seconds of ACC, BVP, GSR, TMP, IBI, HR, battery and tag lines streamed flat out")
+    for configuration in CONFIGURATIONS:
+        # A fresh process per configuration, so no peak RSS includes the storage of an earlier run
+        subprocess.run([sys.executable, __file__, configuration], check=True)
+    latency()